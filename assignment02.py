@@ -5,17 +5,30 @@ Assignment 02
 The goal of this assignment is to implement synchronous scraping using standard python modules,
 and compare the scraping speed to asynchronous mode.
 
+scrape_descriptions_threaded() is synchronous scraper for environments without aiohttp:
+threads share keep-alive connections (ConnectionPool per host) and write pages
+the same way as yahoo.scrape_descriptions_async().
+
 Run this code with
 
     > invoke run assignment02.py
+    > invoke run "assignment02:scrape_descriptions_threaded(workers=8)"
 """
 
-from yahoo import read_symbols, YAHOO_HTMLS
+import concurrent.futures
+import http.client
+import queue
+import threading
+from urllib.parse import urlsplit
+
+import contentcoding
+import htmlreduce
+from yahoo import read_symbols, YAHOO_HTMLS, YAHOO_SECTIONS, YAHOO_URL
 from urllib import request
 from tqdm import tqdm
 import sys
 
-def scrape_descriptions_sync():
+def scrape_descriptions_sync(symbols=None, url=YAHOO_URL, dst=YAHOO_HTMLS):
     """DZ Scrape companies descriptions. sync"""
     # прочитать Symbols, for symbol in tqdm(symbols)
     # исользовать urllib get запросы на yahoo и полученное записывать в файл с помощью
@@ -25,13 +38,13 @@ def scrape_descriptions_sync():
         'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/75.0.3770.142 Safari/537.36'
     }
 
-    symbols = read_symbols()
-    YAHOO_HTMLS.mkdir(parents=True, exist_ok=True)
+    symbols = symbols or read_symbols()
+    dst.mkdir(parents=True, exist_ok=True)
 
 
     for symbol in tqdm(symbols):
         #Example myurl = "https://finance.yahoo.com/quote/AAPL/profile?p=AAPL"
-        myurl = f'https://finance.yahoo.com/quote/{symbol}/profile?p={symbol}'
+        myurl = url.format(symbol=symbol)
 
         try:
             req = request.Request(myurl, headers=myheader)
@@ -42,12 +55,104 @@ def scrape_descriptions_sync():
         except Exception:
             print("Error occuried during web request!!")
             print(sys.exc_info()[1])
+            continue
 
-        f = open(YAHOO_HTMLS / f'{symbol}.html', 'wb')
+        f = open(dst / f'{symbol}.html', 'wb')
         f.write(text)
         f.close()
 
 
+class ConnectionPool:
+    """Keep-alive HTTP connections to one host, shared by threads."""
+
+    def __init__(self, scheme, host, timeout=30):
+        self.connection = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        self.host = host
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+        self.opened = 0
+
+    def get(self, path, headers):
+        """Send GET request, return response and its body."""
+
+        try:
+            conn, reused = self.idle.get_nowait(), True
+        except queue.Empty:
+            conn, reused = self.connection(self.host, timeout=self.timeout), False
+            self.opened += 1
+
+        try:
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+            body = response.read()
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            if reused:  # idle connection may be closed by server, retry with another one
+                return self.get(path, headers)
+            raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            self.idle.put(conn)
+        return response, body
+
+    def close(self):
+        """Close idle connections."""
+        while not self.idle.empty():
+            self.idle.get_nowait().close()
+
+
+def scrape_descriptions_threaded(workers=8, reduce=False, raw=False, symbols=None, url=YAHOO_URL, dst=YAHOO_HTMLS):
+    """Scrape companies descriptions synchronously by pool of threads reusing connections.
+
+    Options are the same as of yahoo.scrape_descriptions_async().
+    """
+
+    if reduce and raw:
+        raise ValueError('Raw pages can not be reduced')
+
+    symbols = symbols or read_symbols()
+    dst.mkdir(parents=True, exist_ok=True)
+
+    headers = {
+        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/75.0.3770.142 Safari/537.36',
+        'Connection': 'keep-alive',
+        }
+    if raw:
+        headers['Accept-Encoding'] = contentcoding.accept_encoding()
+
+    pools = {}
+    lock = threading.Lock()
+
+    def fetch(symbol):
+        parts = urlsplit(url.format(symbol=symbol))
+        with lock:
+            pool = pools.get((parts.scheme, parts.netloc))
+            if pool is None:
+                pool = pools[parts.scheme, parts.netloc] = ConnectionPool(parts.scheme, parts.netloc)
+
+        response, text = pool.get(parts.path + (f'?{parts.query}' if parts.query else ''), headers)
+        codec = contentcoding.normalize(response.getheader('Content-Encoding'))
+        if not raw:
+            text = contentcoding.decode(text, codec)
+        if reduce:
+            text = htmlreduce.reduce_html(text, YAHOO_SECTIONS)
+        name = contentcoding.filename(symbol, codec) if raw else f'{symbol}.html'
+        with open(dst / name, 'wb') as f:
+            f.write(text)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(fetch, symbol) for symbol in symbols]
+        for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures), file=sys.stdout):
+            if future.exception() is not None:
+                print(f'Error occured during web request: {future.exception()}')
+
+    for pool in pools.values():
+        pool.close()
+    return sum(pool.opened for pool in pools.values())
+
+
 def main():
     scrape_descriptions_sync()
 
@@ -0,0 +1,356 @@
+"""
+Benchmarks
+==========
+
+Every benchmark runs compared variants, prints timings and writes them to
+build/benchmarks/<benchmark>.json.
+
+Run this code with
+
+    > invoke run "benchmarks:spark_session()"
+    > invoke run "benchmarks:scrapers()"
+    > invoke run "benchmarks:http2_fetching()"
+    > invoke run "benchmarks:fused_scraping()"
+    > invoke run "benchmarks:partial_parsing()"
+    > invoke run "benchmarks:state_extraction()"
+"""
+
+import asyncio
+import contextlib
+import http.server
+import json
+from pathlib import Path
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import config as cfg
+
+
+BENCHMARKS_DIR = cfg.BUILDDIR / 'benchmarks'
+
+
+def save(name, results):
+    """Print and save benchmark results."""
+
+    BENCHMARKS_DIR.mkdir(parents=True, exist_ok=True)
+    (BENCHMARKS_DIR / f'{name}.json').write_text(json.dumps(results, indent=2))
+    for variant, result in results.items():
+        print(f'{variant:>20}: ' + ', '.join(f'{k}={v:.3f}' if isinstance(v, float) else f'{k}={v}' for k, v in result.items()))
+
+
+def naics_workload(tuned, profile=None):
+    """Prepare features and fit sector classifier like naics.train_full(), print timings as JSON."""
+
+    from pyspark.ml.classification import LogisticRegression
+    import naics
+    import sparksession
+
+    timings = {}
+    last = time.perf_counter()
+
+    def lap(name):
+        nonlocal last
+        now = time.perf_counter()
+        timings[name] = now - last
+        last = now
+
+    sparksession.session(profile=profile, app_name='benchmark_naics', tuned=tuned)
+    lap('session')
+
+    data = naics.read_yahoo().select(['symbol', 'sector', 'description']).dropna()
+    prepared = naics.prepare_full(data)[0].cache()
+    prepared.count()
+    lap('prepare')
+
+    LogisticRegression(featuresCol='words_count', labelCol='label').fit(prepared)
+    lap('fit')
+
+    # pandas conversion goes through Arrow in tuned session
+    prepared.select('symbol', 'sector', 'label').toPandas()
+    lap('to_pandas')
+
+    timings['total'] = sum(timings.values())
+    print(json.dumps(timings))
+
+
+def spark_session(profile='local', repeat=3):
+    """Compare naics.py workload in default and tuned Spark session.
+
+    Every run is a separate python process, because session settings are fixed
+    when JVM starts. The best of repeated runs is reported.
+    """
+
+    results = {}
+    for variant, tuned in (('default', False), ('tuned', True)):
+        runs = []
+        for _ in range(repeat):
+            output = subprocess.run(
+                [sys.executable, '-c', f'import benchmarks; benchmarks.naics_workload({tuned}, {profile!r})'],
+                check=True, stdout=subprocess.PIPE, text=True).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+        results[variant] = min(runs, key=lambda r: r['total'])
+    results['speedup'] = {'total': results['default']['total'] / results['tuned']['total']}
+    save('spark_session', results)
+
+
+@contextlib.contextmanager
+def local_server(page, latency=0.02):
+    """Serve the page for any path over keep-alive HTTP/1.1 on local port, yield URL template."""
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            time.sleep(latency)  # network and server time of real site
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(page)))
+            self.end_headers()
+            self.wfile.write(page)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_address[1]}/quote/{{symbol}}/profile?p={{symbol}}'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def scrapers(pages=300, page_kb=200, latency=0.02, workers=8):
+    """Compare throughput of sync, threaded sync and async scrapers on local server."""
+
+    import assignment02
+    import yahoo
+
+    page = b'<html><body>' + b'<p>Company description.</p>' * (page_kb * 1024 // 27) + b'</body></html>'
+    symbols = [f'S{i:05d}' for i in range(pages)]
+    variants = {
+        'sync': lambda url, dst: assignment02.scrape_descriptions_sync(symbols=symbols, url=url, dst=dst),
+        'threaded': lambda url, dst: assignment02.scrape_descriptions_threaded(workers=workers, symbols=symbols, url=url, dst=dst),
+        'async': lambda url, dst: yahoo.scrape_descriptions_async(symbols=symbols, url=url, dst=dst),
+        }
+
+    results = {}
+    with local_server(page, latency) as url:
+        for variant, scrape in variants.items():
+            with tempfile.TemporaryDirectory() as tmp:
+                started = time.perf_counter()
+                scrape(url, Path(tmp))
+                elapsed = time.perf_counter() - started
+                results[variant] = {
+                    'seconds': elapsed,
+                    'pages_per_second': len(list(Path(tmp).iterdir())) / elapsed,
+                    }
+    save('scrapers', results)
+
+
+@contextlib.contextmanager
+def local_tls_server(page, latency=0.02):
+    """Serve the page for any path over TLS with HTTP/2 or HTTP/1.1 (by ALPN) on local port.
+
+    Yields URL template, certificate to trust and set of client connections (address, port)
+    seen by the server. Requires hypercorn and openssl command.
+    """
+
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    connections = set()
+
+    async def app(scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        connections.add(tuple(scope['client']))
+        await asyncio.sleep(latency)  # network and server time of real site
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/html; charset=utf-8'), (b'content-length', str(len(page)).encode())]})
+        await send({'type': 'http.response.body', 'body': page})
+
+    with tempfile.TemporaryDirectory() as tmp, socket.socket() as probe:
+        cert, key = Path(tmp) / 'cert.pem', Path(tmp) / 'key.pem'
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=127.0.0.1',
+            '-addext', 'subjectAltName=IP:127.0.0.1', '-keyout', str(key), '-out', str(cert)], check=True, capture_output=True)
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+
+        config = Config()
+        config.bind = [f'127.0.0.1:{port}']
+        config.certfile, config.keyfile = str(cert), str(key)
+        config.alpn_protocols = ['h2', 'http/1.1']
+        config.backlog = 1024
+        loop = asyncio.new_event_loop()
+        stop = None
+        started = threading.Event()
+
+        async def run():
+            nonlocal stop
+            stop = asyncio.Event()
+            started.set()
+            await serve(app, config, shutdown_trigger=stop.wait)
+
+        thread = threading.Thread(target=loop.run_until_complete, args=(run(),), daemon=True)
+        thread.start()
+        started.wait()
+        for _ in range(100):  # wait until server listens
+            with contextlib.suppress(OSError), socket.create_connection(('127.0.0.1', port)):
+                break
+            time.sleep(0.05)
+        try:
+            yield f'https://127.0.0.1:{port}/quote/{{symbol}}/profile?p={{symbol}}', str(cert), connections
+        finally:
+            loop.call_soon_threadsafe(stop.set)
+            thread.join()
+            loop.close()
+
+
+def http2_fetching(pages=1000, page_kb=50, latency=0.05):
+    """Compare HTTP/1.1 and multiplexed HTTP/2 fetch backends of async scraper on local TLS server."""
+
+    import yahoo
+
+    page = b'<html><body>' + b'<p>Company description.</p>' * (page_kb * 1024 // 27) + b'</body></html>'
+    symbols = [f'S{i:05d}' for i in range(pages)]
+
+    results = {}
+    for protocol in ('http1', 'http2'):
+        with local_tls_server(page, latency) as (url, cert, connections), tempfile.TemporaryDirectory() as tmp:
+            started = time.perf_counter()
+            yahoo.scrape_descriptions_async(symbols=symbols, url=url, dst=Path(tmp), protocol=protocol, cafile=cert)
+            elapsed = time.perf_counter() - started
+            results[protocol] = {
+                'seconds': elapsed,
+                'pages_per_second': len(list(Path(tmp).iterdir())) / elapsed,
+                'connections': len(connections),
+                }
+    save('http2_fetching', results)
+
+
+def fused_scraping(pages=300, page_kb=300, latency=0.05, fetchers=50, parsers=None):
+    """Compare fused scraping with parsing in event loop and in pool of processes."""
+
+    import extractors
+    import scrapeparse
+
+    rows = ''.join(f'<p><span>Field {i}</span><span>{i}</span></p>' for i in range(page_kb * 1024 // 60))
+    page = (f'<html><body><section><h2><span>Description</span></h2><p>Company description.</p></section>'
+            f'<div class="asset-profile-container">{rows}</div></body></html>').encode()
+    symbols = [f'S{i:05d}' for i in range(pages)]
+    columns = ('symbol', 'sector', 'industry', 'employees', 'description')
+
+    results = {}
+    with local_server(page, latency) as url:
+        for variant, workers in (('in_loop', 0), ('process_pool', parsers)):
+            with tempfile.TemporaryDirectory() as tmp:
+                results[variant] = scrapeparse.scrape_parsed(symbols, url, extractors.yahoo_profile, columns,
+                    Path(tmp) / 'data.parquet', fetchers=fetchers, parsers=workers)
+    save('fused_scraping', results)
+
+
+def synthetic_page(site, position='start', page_kb=2000):
+    """Page with profile or comments at the start or at the end of large markup."""
+
+    filler = ''.join(f'<div class="row"><span>{i}</span><a href="#">link</a></div>' for i in range(page_kb * 1024 // 50))
+    if site == 'yahoo':
+        target = ('<section><div class="asset-profile-container"><p><span>Sector</span>: <span>Technology</span><br>'
+            '<span>Industry</span>: <span>Software</span><br><span>Full Time Employees</span>: <span><span>1,234</span></span></p></div>'
+            '<section><h2><span>Description</span></h2><p>Company description.</p></section></section>')
+    else:
+        target = '<div class="feed">' + ''.join(
+            f'<article id="elComment_{i}"><strong class="cAuthorPane_author">user{i}</strong><time datetime="2019-01-01T10:00:00Z"></time>'
+            f'<div data-role="commentContent"><p>Comment {i}</p></div></article>' for i in range(25)) + '</div>'
+    body = target + filler if position == 'start' else filler + target
+    return f'<html><body>{body}</body></html>'
+
+
+def parsing_workload(site, position, partial, pages=20):
+    """Parse synthetic pages, print time and peak memory as JSON."""
+
+    import resource
+    import extractors
+
+    extract = extractors.yahoo_profile if site == 'yahoo' else extractors.forum_comments
+    page = synthetic_page(site, position)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    for _ in range(pages):
+        extract(page, partial=partial)
+    print(json.dumps({
+        'ms_per_page': (time.perf_counter() - started) / pages * 1000,
+        'peak_mb': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) / 1024,
+        }))
+
+
+def partial_parsing(pages=20):
+    """Compare full and partial parsing of large pages, every variant in separate process."""
+
+    results = {}
+    for site in ('yahoo', 'project_main'):
+        for position in ('start', 'end'):
+            for partial in (False, True):
+                output = subprocess.run(
+                    [sys.executable, '-c', f'import benchmarks; benchmarks.parsing_workload({site!r}, {position!r}, {partial}, {pages})'],
+                    check=True, stdout=subprocess.PIPE, text=True).stdout
+                results[f'{site}_{position}_{"partial" if partial else "full"}'] = json.loads(output.strip().splitlines()[-1])
+    save('partial_parsing', results)
+
+
+def synthetic_yahoo_page(i, state_kb=300):
+    """Yahoo profile page with embedded page state and the same profile in markup."""
+
+    profile = {
+        'sector': 'Technology', 'industry': 'Software', 'fullTimeEmployees': 1000 + i,
+        'longBusinessSummary': f'Company {i} develops software. ' * 20,
+        }
+    stores = {f'Store{j}': {'values': list(range(50)), 'name': f'store {j}'} for j in range(state_kb * 1024 // 250)}
+    stores['QuoteSummaryStore'] = {'assetProfile': profile}
+    state = json.dumps({'context': {'dispatcher': {'stores': stores}}})
+    filler = ''.join(f'<div class="row"><span>{j}</span></div>' for j in range(5000))
+    return (f'<html><head><script>(function (root) {{\nroot.App.main = {state};\n}}(this));</script></head><body>{filler}'
+        f'<section><div class="asset-profile-container"><p><span>Sector</span>: <span>{profile["sector"]}</span><br>'
+        f'<span>Industry</span>: <span>{profile["industry"]}</span><br><span>Full Time Employees</span>: '
+        f'<span><span>{profile["fullTimeEmployees"]:,}</span></span></p></div>'
+        f'<section><h2><span>Description</span></h2><p>{profile["longBusinessSummary"]}</p></section></section></body></html>').encode()
+
+
+def state_extraction(pages=50):
+    """Compare profile extraction from page state (orjson, json) and from markup (XPath)."""
+
+    import extractors
+
+    corpus = [synthetic_yahoo_page(i) for i in range(pages)]
+    fast = extractors.orjson
+    variants = {
+        'state_orjson': lambda page: extractors.yahoo_profile(page),
+        'state_json': lambda page: extractors.yahoo_profile(page),
+        'xpath': lambda page: extractors.yahoo_profile(page, state=False),
+        }
+
+    results = {}
+    for variant, extract in variants.items():
+        if variant == 'state_orjson' and fast is None:
+            continue
+        extractors.orjson = None if variant == 'state_json' else fast
+        started = time.perf_counter()
+        rows = [extract(page) for page in corpus]
+        results[variant] = {
+            'ms_per_page': (time.perf_counter() - started) / pages * 1000,
+            'profiles': sum(1 for row in rows if row.get('sector')),
+            }
+    extractors.orjson = fast
+    save('state_extraction', results)
@@ -0,0 +1,150 @@
+"""
+Tables of build outputs in Spark metastore
+==========================================
+
+Parsed datasets are registered in metastore (local Derby metastore_db, Hive
+metastore on Dataproc) as partitioned Parquet tables with statistics, so Spark
+prunes partitions and chooses broadcast joins by cost:
+
+* yahoo_profiles – symbol, industry, employees, description, partitioned by sector,
+* nasdaq_symbols – symbol, name, last_sale, market_cap, ipo_year, sector, industry, partitioned by exchange,
+* forum_comments – parsed forum comments, partitioned by comment_day.
+
+Comments are added incrementally: only delta partitions of project_main.parse_descriptions(),
+which are not registered yet, are inserted, see refresh_comments(). After full parse of
+comments the table is recreated.
+
+Run this code with
+
+    > invoke run "catalog:refresh()"
+    > invoke run "catalog:sectors()"
+"""
+
+import json
+
+import pyspark.sql.functions as F
+
+import config as cfg
+import project_main
+import sparksession
+import yahoo
+
+
+NASDAQ_DIR = cfg.DATADIR / 'nasdaq'
+WAREHOUSE = cfg.BUILDDIR / 'warehouse'
+COMMENTS_STATE = cfg.BUILDDIR / 'catalog_comments.json'
+
+
+def table_exists(spark, name):
+    """Check that table is registered in metastore."""
+    return name in {t.name for t in spark.catalog.listTables()}
+
+
+def analyze(spark, name, columns):
+    """Compute table and column statistics for cost based optimizer."""
+    spark.sql(f'ANALYZE TABLE {name} COMPUTE STATISTICS')
+    spark.sql(f'ANALYZE TABLE {name} COMPUTE STATISTICS FOR COLUMNS {", ".join(columns)}')
+
+
+def register_yahoo(spark):
+    """(Re)create table of parsed Yahoo profiles."""
+
+    if yahoo.YAHOO_DATA_PARQUET.exists():
+        data = spark.read.parquet(str(yahoo.YAHOO_DATA_PARQUET))
+    else:
+        data = (spark.read.csv(str(yahoo.YAHOO_DATA), header=True, multiLine=True, escape='"')
+            .withColumn('employees', F.col('employees').cast('int')))
+    # companies without sector go to default (null) partition
+    (data
+        .select('symbol', 'industry', 'employees', 'description', F.when(F.col('sector') != '', F.col('sector')).alias('sector'))
+        .write.partitionBy('sector').format('parquet').mode('overwrite').saveAsTable('yahoo_profiles'))
+    analyze(spark, 'yahoo_profiles', ['symbol', 'industry', 'employees'])
+
+
+def register_nasdaq(spark):
+    """(Re)create table of NASDAQ, NYSE and AMEX listings."""
+
+    def money(column):
+        """Convert $1.2M, $3.4B to number."""
+        value = F.regexp_extract(column, r'\$([0-9.]+)', 1).cast('double')
+        unit = F.regexp_extract(column, r'([MB])$', 1)
+        return F.when(unit == 'B', value * 1e9).when(unit == 'M', value * 1e6).otherwise(value)
+
+    listings = None
+    for path in sorted(NASDAQ_DIR.glob('*.csv')):
+        data = spark.read.csv(str(path), header=True).select(
+            F.trim('Symbol').alias('symbol'),
+            F.col('Name').alias('name'),
+            F.col('LastSale').cast('double').alias('last_sale'),
+            money(F.col('MarketCap')).alias('market_cap'),
+            F.col('IPOyear').cast('int').alias('ipo_year'),
+            F.col('Sector').alias('sector'),
+            F.col('industry'),
+            F.lit(path.stem).alias('exchange'),
+            )
+        listings = data if listings is None else listings.unionByName(data)
+    listings.write.partitionBy('exchange').format('parquet').mode('overwrite').saveAsTable('nasdaq_symbols')
+    analyze(spark, 'nasdaq_symbols', ['symbol', 'last_sale', 'market_cap', 'ipo_year', 'sector'])
+
+
+def refresh_comments(spark, full=False):
+    """Insert delta partitions of parsed comments, which are not in forum_comments table yet.
+
+    Table is recreated after full parse of comments (new deltas generation), see project_main.generation().
+    """
+
+    generation = project_main.generation()
+    state = json.loads(COMMENTS_STATE.read_text()) if COMMENTS_STATE.exists() and not full else {}
+    registered = set(state['partitions']) if isinstance(state, dict) and state.get('generation') == generation else set()
+    if not table_exists(spark, 'forum_comments'):
+        registered = set()
+    parts = sorted(p for p in project_main.PROJECT_DELTAS.glob('part-*.csv') if p.name not in registered)
+    if not parts:
+        print('Comments table is up to date')
+        return
+
+    comments = (spark.read.csv([str(p) for p in parts], header=True, multiLine=True, escape='"')
+        .withColumn('page_number', F.col('page_number').cast('int'))
+        .withColumn('comment_date', F.to_timestamp('comment_date'))
+        .withColumn('comment_day', F.to_date('comment_date'))
+        )
+    if registered:
+        # new comments are appended to day partitions, columns are matched by position
+        comments.select(spark.table('forum_comments').columns).write.insertInto('forum_comments')
+    else:
+        comments.write.partitionBy('comment_day').format('parquet').mode('overwrite').saveAsTable('forum_comments')
+
+    COMMENTS_STATE.write_text(json.dumps({'generation': generation, 'partitions': sorted(registered | {p.name for p in parts})}))
+    analyze(spark, 'forum_comments', ['symbol', 'comment_date', 'comment_author'])
+    print(f'Registered {len(parts)} comment partitions')
+
+
+def refresh(full=False, profiles=True, comments=True):
+    """Register parsed datasets, comments are added incrementally.
+
+    profiles=False or comments=False skips (re)creating profile and listing tables or comments table.
+    """
+
+    spark = sparksession.session(app_name='catalog')
+    if profiles:
+        register_yahoo(spark)
+        register_nasdaq(spark)
+    if comments:
+        refresh_comments(spark, full=full)
+
+
+def sectors(sector=None):
+    """Companies per sector and exchange, plan shows pruned partitions and broadcast join."""
+
+    spark = sparksession.session(app_name='catalog')
+    profiles = spark.table('yahoo_profiles')
+    if sector is not None:
+        profiles = profiles.filter(F.col('sector') == sector)
+    result = (profiles.alias('y')
+        .join(spark.table('nasdaq_symbols').alias('n'), F.col('y.symbol') == F.col('n.symbol'))
+        .groupBy('y.sector', 'n.exchange')
+        .agg(F.count('*').alias('companies'), F.sum('n.market_cap').alias('market_cap'))
+        .orderBy(F.desc('market_cap'))
+        )
+    result.explain('cost')
+    result.show(50, truncate=False)
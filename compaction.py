@@ -0,0 +1,225 @@
+"""
+Compaction of Parquet build outputs
+===================================
+
+Writers of scraped pages append small and uneven row groups without dictionary
+encoding and sort order, so column statistics do not help to find a symbol.
+compact() rewrites dataset sorted by symbol (out of core, by merging sorted runs)
+into row groups of target size with:
+
+* dictionary encoding of columns with few distinct values,
+* min/max statistics,
+* page index (per-page statistics), sorting columns in row group metadata and
+  bloom filters of the key column, if pyarrow writer supports them.
+
+read_symbol() reads rows of one symbol from row groups whose statistics may
+contain it. Sorted key has tight min/max ranges, so it is usually one row group.
+
+Run this code with
+
+    > invoke run "compaction:compact_all()"
+    > invoke run "compaction:compact('build/project_main.parquet')"
+"""
+
+import inspect
+import itertools
+from pathlib import Path
+import shutil
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+import config as cfg
+
+
+ROW_GROUP_MB = 64
+DICTIONARY_RATIO = 0.5  # max share of distinct values in dictionary encoded column
+BLOOM_FPP = 0.01
+
+
+def writer_supports(option):
+    """Check that pyarrow Parquet writer has option, newer options are missing in pyarrow for Python 3.7."""
+    return option in inspect.signature(pq.ParquetWriter.__init__).parameters
+
+
+def dictionary_columns(table, ratio=DICTIONARY_RATIO):
+    """Columns with few distinct values, worth dictionary encoding."""
+
+    columns = []
+    for name, column in zip(table.column_names, table.columns):
+        if len(column) and pc.count_distinct(column).as_py() <= ratio * len(column):
+            columns.append(name)
+    return columns
+
+
+def parquet_files(src):
+    """Parquet files of dataset, Spark writes folder of part files."""
+    return sorted(src.glob('*.parquet')) if src.is_dir() else [src]
+
+
+def column_compression(path, compression):
+    """Compression of columns: columns stored uncompressed (raw pages compressed already) stay uncompressed."""
+
+    metadata = pq.ParquetFile(path).metadata
+    if metadata.num_row_groups == 0:
+        return compression
+    group = metadata.row_group(0)
+    return {
+        group.column(i).path_in_schema: 'NONE' if group.column(i).compression == 'UNCOMPRESSED' else compression
+        for i in range(group.num_columns)
+        }
+
+
+def sorted_runs(files, key, run_bytes, runs_dir):
+    """Split dataset to runs sorted by key of about run_bytes each, rows without key go to the last run."""
+
+    runs, nulls, chunk, size = [], [], [], 0
+
+    def write_run(table):
+        path = runs_dir / f'run-{len(runs):05d}.parquet'
+        pq.write_table(table, path, compression='ZSTD')
+        runs.append(path)
+
+    def flush():
+        table = pa.concat_tables(chunk)
+        missing = pc.is_null(table[key])
+        nulls.append(table.filter(missing))
+        keyed = table.filter(pc.invert(missing))
+        if keyed.num_rows:
+            write_run(keyed.sort_by(key))
+
+    for path in files:
+        reader = pq.ParquetFile(path)
+        metadata = reader.metadata
+        row_bytes = sum(metadata.row_group(g).total_byte_size for g in range(metadata.num_row_groups)) / max(metadata.num_rows, 1)
+        for batch in reader.iter_batches(batch_size=max(1, int(run_bytes / 16 / max(row_bytes, 1)))):
+            chunk.append(pa.Table.from_batches([batch]))
+            size += batch.nbytes
+            if size >= run_bytes:
+                flush()
+                chunk, size = [], 0
+    if chunk:
+        flush()
+    nulls = pa.concat_tables(nulls) if nulls else None
+    return runs, nulls if nulls is not None and nulls.num_rows else None
+
+
+def merge_runs(runs, key, batch_rows):
+    """Merge sorted runs into sorted tables, only one batch of every run is in memory."""
+
+    readers = [pq.ParquetFile(path).iter_batches(batch_size=batch_rows) for path in runs]
+
+    def refill(i):
+        for batch in readers[i]:
+            if batch.num_rows:
+                return pa.Table.from_batches([batch])
+        return None
+
+    buffers = [refill(i) for i in range(len(readers))]
+    while any(b is not None for b in buffers):
+        # rows up to the smallest of last keys of buffers are complete in all runs
+        bound = min(b[key][-1].as_py() for b in buffers if b is not None)
+        parts = []
+        for i, buffer in enumerate(buffers):
+            if buffer is None:
+                continue
+            below = pc.less_equal(buffer[key], bound)
+            parts.append(buffer.filter(below))
+            rest = buffer.filter(pc.invert(below))
+            buffers[i] = rest if rest.num_rows else refill(i)
+        yield pa.concat_tables(parts).sort_by(key)
+
+
+def compact(src, dst=None, key='symbol', row_group_mb=ROW_GROUP_MB, compression='ZSTD'):
+    """Rewrite Parquet file or folder sorted by key into row groups of target size.
+
+    Dataset is sorted out of core: runs of about row_group_mb are sorted in memory and
+    written to temporary files, then merged. Columns stored uncompressed stay uncompressed.
+    """
+
+    src = Path(src)
+    dst = Path(dst or src)
+    files = parquet_files(src)
+
+    schema = pq.read_schema(files[0])
+    if key not in schema.names:
+        print(f'Skipped {src}: no {key} column')
+        return
+
+    runs_dir = dst.with_name(dst.name + '.runs')
+    shutil.rmtree(runs_dir, ignore_errors=True)
+    runs_dir.mkdir(parents=True)
+    tmp = dst.with_name(dst.name + '.tmp')
+    try:
+        runs, nulls = sorted_runs(files, key, row_group_mb * 2**20, runs_dir)
+
+        # encoding and row group size are chosen on the first run with rows, a sample of about one row group
+        sample = next((table for table in map(pq.read_table, runs) if table.num_rows), nulls)
+        if sample is None:
+            print(f'Skipped {src}: no rows')
+            return
+        rows = max(1, int(sample.num_rows * row_group_mb * 2**20 / max(sample.nbytes, 1)))
+        options = dict(
+            use_dictionary=dictionary_columns(sample),
+            compression=column_compression(files[0], compression),
+            flavor={'spark'},
+            )
+        if writer_supports('write_page_index'):
+            options['write_page_index'] = True
+        if writer_supports('sorting_columns'):
+            options['sorting_columns'] = [pq.SortingColumn(schema.names.index(key))]
+        if writer_supports('bloom_filter_options'):
+            ndv = sum(pq.ParquetFile(run).metadata.num_rows for run in runs)  # upper bound is enough
+            options['bloom_filter_options'] = {key: {'ndv': max(1, ndv), 'fpp': BLOOM_FPP}}
+
+        with pq.ParquetWriter(tmp, sample.schema, **options) as writer:
+            pending = None
+            for table in itertools.chain(merge_runs(runs, key, max(1, rows // max(len(runs), 1))), [nulls] if nulls else []):
+                pending = table if pending is None else pa.concat_tables([pending, table])
+                while pending.num_rows >= rows:
+                    writer.write_table(pending.slice(0, rows), row_group_size=rows)
+                    pending = pending.slice(rows)
+            if pending is not None and pending.num_rows:
+                writer.write_table(pending, row_group_size=rows)
+    finally:
+        shutil.rmtree(runs_dir, ignore_errors=True)
+
+    if dst.is_dir():
+        shutil.rmtree(dst)
+    tmp.replace(dst)
+
+    metadata = pq.ParquetFile(dst).metadata
+    print(f'Compacted {src} -> {dst}: {metadata.num_rows} rows in {metadata.num_row_groups} row groups from {len(runs)} sorted runs, '
+          f'dictionary: {", ".join(options["use_dictionary"]) or "none"}')
+
+
+def compact_all(pattern='*.parquet', key='symbol', row_group_mb=ROW_GROUP_MB):
+    """Compact all Parquet datasets in build folder."""
+    for path in sorted(cfg.BUILDDIR.glob(pattern)):
+        compact(path, key=key, row_group_mb=row_group_mb)
+
+
+def row_groups_of(metadata, value, key='symbol'):
+    """Row groups which may contain key value according to statistics."""
+
+    column = metadata.schema.to_arrow_schema().get_field_index(key)
+    groups = []
+    for g in range(metadata.num_row_groups):
+        stats = metadata.row_group(g).column(column).statistics
+        if stats is None or not stats.has_min_max or stats.min <= value <= stats.max:
+            groups.append(g)
+    return groups
+
+
+def read_symbol(src, symbol, columns=None, key='symbol'):
+    """Read rows of one symbol without full scan of compacted Parquet file."""
+
+    reader = pq.ParquetFile(src)
+    groups = row_groups_of(reader.metadata, symbol, key)
+    if not groups:
+        return reader.schema_arrow.empty_table() if columns is None else reader.schema_arrow.empty_table().select(columns)
+
+    table = reader.read_row_groups(groups, columns=None if columns is None else list(dict.fromkeys([key] + list(columns))))
+    table = table.filter(pc.equal(table[key], symbol))
+    return table if columns is None else table.select(columns)
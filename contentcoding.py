@@ -0,0 +1,73 @@
+"""
+HTTP content codings of raw (not inflated) response bodies.
+
+Raw pages are stored as received from the server, the codec is kept next to the
+body (file suffix in HTML folders and archives, `codec` column in Parquet),
+and pages are decoded only when parsed.
+"""
+
+import gzip
+import zlib
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, "br" is not requested without it
+    brotli = None
+
+
+SUFFIXES = {
+    'identity': '',
+    'gzip': '.gz',
+    'deflate': '.zz',
+    'br': '.br',
+    }
+
+
+def accept_encoding():
+    """Value of Accept-Encoding header for supported codecs."""
+    return ', '.join(codec for codec in SUFFIXES if codec != 'identity' and (codec != 'br' or brotli is not None))
+
+
+def filename(symbol, codec, extension='.html'):
+    """File name of raw page."""
+    return f'{symbol}{extension}{SUFFIXES[codec]}'
+
+
+def split_filename(name, extension='.html'):
+    """Split file name of raw page to symbol and codec."""
+
+    for codec, suffix in SUFFIXES.items():
+        if suffix and name.endswith(extension + suffix):
+            return name[:-len(extension + suffix)], codec
+    if name.endswith(extension):
+        return name[:-len(extension)], 'identity'
+    raise ValueError(f'Unsupported file name: {name}')
+
+
+def normalize(content_encoding):
+    """Codec name from Content-Encoding header."""
+
+    codec = (content_encoding or 'identity').strip().lower()
+    codec = {'x-gzip': 'gzip', '': 'identity'}.get(codec, codec)
+    if codec not in SUFFIXES:
+        raise ValueError(f'Unsupported content encoding: {content_encoding}')
+    return codec
+
+
+def decode(body, codec):
+    """Inflate raw response body."""
+
+    if codec is None or codec == 'identity':
+        return body
+    elif codec == 'gzip':
+        return gzip.decompress(body)
+    elif codec == 'deflate':
+        try:
+            return zlib.decompress(body)
+        except zlib.error:  # some servers send raw deflate stream without zlib header
+            return zlib.decompress(body, -zlib.MAX_WBITS)
+    elif codec == 'br':
+        if brotli is None:
+            raise RuntimeError('Package "brotli" is required to decode "br" content')
+        return brotli.decompress(body)
+    raise ValueError(f'Unsupported codec: {codec}')
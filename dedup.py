@@ -0,0 +1,151 @@
+"""
+Near-duplicate detection with MinHash and LSH.
+
+Texts are converted to sets of character shingles, MinHash signatures estimate
+Jaccard similarity of the sets, and LSH banding finds candidate pairs without
+comparing all pairs. Candidates with estimated similarity above threshold are
+joined into clusters, every text gets id of its cluster (index or id of
+the first text of the cluster).
+
+cluster_ids() is a local NumPy implementation, spark_cluster_ids() works on
+Spark dataframes using MinHashLSH from Spark ML.
+"""
+
+from collections import defaultdict
+import re
+import zlib
+
+import numpy as np
+
+
+PRIME = 4294967291  # largest prime below 2^32, (a * h + b) fits into uint64
+
+
+def shingles(text, k=5):
+    """Set of character k-grams of normalized text."""
+    text = re.sub(r'\s+', ' ', (text or '').lower()).strip()
+    if len(text) <= k:
+        return {text} if text else set()
+    return {text[i:i + k] for i in range(len(text) - k + 1)}
+
+
+def signatures(texts, num_perm=128, k=5, seed=1):
+    """MinHash signatures of texts, array of shape (len(texts), num_perm)."""
+
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, PRIME, size=num_perm, dtype=np.uint64)
+    b = rng.randint(0, PRIME, size=num_perm, dtype=np.uint64)
+
+    result = np.full((len(texts), num_perm), PRIME, dtype=np.uint64)
+    for i, text in enumerate(texts):
+        hashes = np.fromiter((zlib.crc32(s.encode('utf-8')) for s in shingles(text, k)), dtype=np.uint64)
+        if len(hashes):
+            result[i] = ((hashes[:, None] * a + b) % PRIME).min(axis=0)
+    return result
+
+
+def lsh_params(threshold, num_perm=128, fp_weight=0.5):
+    """Number of bands and rows per band minimizing weighted false positive and negative rates."""
+
+    x = np.linspace(0, 1, 201)
+    best, best_error = None, None
+    for bands in range(1, num_perm + 1):
+        rows = num_perm // bands
+        p = 1 - (1 - x ** rows) ** bands  # probability to become a candidate
+        fp = np.where(x < threshold, p, 0).mean()
+        fn = np.where(x >= threshold, 1 - p, 0).mean()
+        error = fp_weight * fp + (1 - fp_weight) * fn
+        if best_error is None or error < best_error:
+            best, best_error = (bands, rows), error
+    return best
+
+
+def cluster_ids(texts, threshold=0.8, num_perm=128, k=5, seed=1):
+    """Cluster near-duplicate texts, returns index of the first text of cluster for every text."""
+
+    sig = signatures(texts, num_perm=num_perm, k=k, seed=seed)
+    bands, rows = lsh_params(threshold, num_perm)
+    empty = (sig == PRIME).all(axis=1)
+
+    parent = np.arange(len(texts))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for band in range(bands):
+        buckets = defaultdict(list)
+        part = np.ascontiguousarray(sig[:, band * rows:(band + 1) * rows])
+        for i in np.flatnonzero(~empty):
+            buckets[part[i].tobytes()].append(i)
+        for members in buckets.values():
+            # all candidate pairs of bucket are compared, similarity is not transitive
+            for n, i in enumerate(members[:-1]):
+                others = np.array(members[n + 1:])
+                similar = others[(sig[others] == sig[i]).mean(axis=1) >= threshold]
+                for j in similar:
+                    ri, rj = find(i), find(j)
+                    if ri != rj:
+                        parent[max(ri, rj)] = min(ri, rj)
+
+    return np.array([find(i) for i in range(len(texts))])
+
+
+def spark_cluster_ids(df, textCol, idCol, threshold=0.8, numHashTables=10, numFeatures=1 << 20, k=5):
+    """Add cluster_id column with id of the smallest id of near-duplicate texts.
+
+    Candidate pairs are found by MinHashLSH on Spark, pairs are joined into
+    clusters on the driver, which is fine as long as duplicates are not the majority.
+    """
+
+    from pyspark.ml import Pipeline
+    from pyspark.ml.feature import HashingTF, MinHashLSH, NGram, RegexTokenizer
+    import pyspark.sql.functions as F
+    from pyspark.sql.types import BooleanType
+
+    chars = RegexTokenizer(inputCol=textCol, outputCol='_chars', pattern='', gaps=True, minTokenLength=1)
+    grams = NGram(n=k, inputCol='_chars', outputCol='_shingles')
+    tf = HashingTF(inputCol='_shingles', outputCol='_features', numFeatures=numFeatures, binary=True)
+    lsh = MinHashLSH(inputCol='_features', outputCol='_hashes', numHashTables=numHashTables, seed=1)
+
+    non_empty = F.udf(lambda v: v.numNonzeros() > 0, BooleanType())
+    features = (Pipeline(stages=[chars, grams, tf])
+        .fit(df)
+        .transform(df.select(idCol, textCol))
+        .filter(non_empty('_features'))
+        .select(idCol, '_features')
+        .cache()
+        )
+    model = lsh.fit(features)
+
+    pairs = (model
+        .approxSimilarityJoin(features, features, 1 - threshold, distCol='_distance')
+        .select(F.col(f'datasetA.{idCol}').alias('a'), F.col(f'datasetB.{idCol}').alias('b'))
+        .filter(F.col('a') < F.col('b'))
+        .collect()
+        )
+
+    parent = {}
+
+    def find(i):
+        parent.setdefault(i, i)
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for a, b in pairs:
+        ra, rb = find(a), find(b)
+        if ra != rb:
+            parent[max(ra, rb)] = min(ra, rb)
+
+    spark = df.sql_ctx.sparkSession
+    clusters = spark.createDataFrame([(i, find(i)) for i in parent], schema=[idCol, 'cluster_id'])
+    features.unpersist()
+
+    return (df
+        .join(F.broadcast(clusters), on=idCol, how='left')
+        .withColumn('cluster_id', F.coalesce('cluster_id', idCol))
+        )
@@ -0,0 +1,248 @@
+"""
+Shared scraping and parsing engine
+==================================
+
+Every scraped site is described by a Site adapter: where page ids come from,
+URL template of pages, extractors of page fields and build outputs. Modules of
+sites (yahoo.py, project_main.py, project01.py) define their adapter and keep
+their functions as thin wrappers over the engine, so fetch backends,
+concurrency, batching, raw pages and Parquet layout are the same everywhere:
+
+* scrape() – fetch pages asynchronously to <name>_html, see fetchers.py,
+* archive() – pack pages to <name>.tbz2 (raw pages to <name>_raw.tar),
+* compress() / decompress() – convert archive to Parquet <name>.parquet and back,
+* extract_pages() – decode pages of Parquet and run extractors of site (memoized, see parsecache.py),
+* scrape_parsed() – fetch and parse pages directly to Parquet, see scrapeparse.py.
+"""
+
+import asyncio
+from collections import defaultdict
+import concurrent.futures
+import csv
+import io
+import itertools
+from pathlib import Path
+import sys
+import tarfile
+
+import aiofiles
+import pyarrow as pa
+import pyarrow.parquet as pq
+from tqdm import tqdm
+
+import config as cfg
+import contentcoding
+import fetchers
+import htmlreduce
+import parsecache
+import scrapeparse
+
+
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/75.0.3770.142 Safari/537.36',
+    }
+
+
+class Site:
+    """Adapter of scraped site.
+
+    ids are read from id_column of CSV id_files, url is template with {symbol},
+    extractors are versioned functions of page (see extractors.versioned()), one per
+    group of fields, so changing one of them parses only its fields again. parse converts
+    whole page to row for scrape_parsed() (first extractor by default).
+    columns are fields of parsed rows, sections are XPaths kept with reduce=True
+    (see htmlreduce.reduce_html()). Build outputs are named after the site
+    unless given.
+    """
+
+    def __init__(self, name, url, id_files, id_column, extractors=(), parse=None, columns=(), sections=(), headers=None,
+            htmls=None, arch=None, raw_arch=None, parquet=None, member_dir=None):
+        self.name = name
+        self.url = url
+        self.id_files = tuple(id_files)
+        self.id_column = id_column
+        self.extractors = tuple(extractors)
+        self.parse = parse or (self.extractors[0] if self.extractors else None)
+        self.columns = tuple(columns)
+        self.sections = tuple(sections)
+        self.headers = headers or HEADERS
+        self.htmls = htmls or cfg.BUILDDIR / f'{name}_html'
+        self.arch = arch or cfg.BUILDDIR / f'{name}.tbz2'
+        self.raw_arch = raw_arch or cfg.BUILDDIR / f'{name}_raw.tar'
+        self.parquet = parquet or cfg.BUILDDIR / f'{name}.parquet'
+        self.member_dir = member_dir or name  # folder of pages in archive
+
+    def read_ids(self):
+        """Read unique page ids."""
+
+        ids = set()
+        for filename in self.id_files:
+            with open(filename) as f:
+                for row in csv.DictReader(f):
+                    ids.add(row[self.id_column].upper().strip())
+        return sorted(ids)
+
+
+def scrape(site, reduce=False, raw=False, symbols=None, url=None, dst=None, protocol='http1', cafile=None, parsers=None):
+    """Scrape pages asynchronously.
+
+    With reduce=True only page sections of site are stored, pages are reduced by pool of parsers processes,
+    so parsing does not block the event loop.
+    With raw=True compressed response bodies are stored as received, see contentcoding.
+    protocol='http2' multiplexes requests over a few connections, see fetchers.py.
+    """
+
+    if reduce and raw:
+        raise ValueError('Raw pages can not be reduced')
+
+    symbols = symbols or site.read_ids()
+    dst = dst or site.htmls
+    progress = tqdm(total=len(symbols), file=sys.stdout, disable=False)
+    dst.mkdir(parents=True, exist_ok=True)
+
+    headers = dict(site.headers)
+    if raw:
+        headers['Accept-Encoding'] = contentcoding.accept_encoding()
+
+    async def fetch(symbol, get, pool):
+        page = await get(symbol)
+        text = page.body
+        if reduce:
+            text = await asyncio.get_event_loop().run_in_executor(pool, htmlreduce.reduce_html, text, site.sections)
+        if raw:
+            name = contentcoding.filename(symbol, contentcoding.normalize(page.content_encoding))
+        else:
+            name = f'{symbol}.html'
+        async with aiofiles.open(dst / name, 'wb') as f:
+            await f.write(text)
+        progress.update(1)
+
+    async def run(symbols, pool):
+        async with fetchers.fetcher(protocol, url or site.url, headers=headers, decompress=not raw, cafile=cafile) as get:
+            tasks = (asyncio.ensure_future(fetch(symbol, get, pool)) for symbol in symbols)
+            await asyncio.gather(*tasks)
+
+    loop = asyncio.get_event_loop()
+    loop.set_exception_handler(lambda x, y: None)  # suppress exceptions because of bug in Python 3.7.3 + aiohttp + asyncio
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=parsers) if reduce else None
+    try:
+        loop.run_until_complete(asyncio.ensure_future(run(symbols, pool)))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    progress.close()
+
+
+def archive(site, raw=False):
+    """Pack scraped pages to tarfile"""
+
+    # raw pages are compressed already, so they are packed without compression
+    arch, mode, pattern = (site.raw_arch, 'w', '*.html*') if raw else (site.arch, 'w:bz2', '*.html')
+    with tarfile.open(arch, mode) as archive:
+        for path in tqdm(sorted(site.htmls.glob(pattern)), file=sys.stdout):
+            archive.add(path, arcname=f'{site.member_dir}/{path.name}')
+
+
+def compress(site, encoding='utf-8', batch_size=1000, compression='BROTLI', raw=False):
+    """Convert tarfile to parquet
+
+    With raw=True pages are read from the archive of raw pages and stored with their codec,
+    html column is not compressed again.
+    """
+
+    names = ('symbol', 'html', 'codec') if raw else ('symbol', 'html')
+
+    def read_incremental():
+        """Incremental generator of batches"""
+        with tarfile.open(site.raw_arch if raw else site.arch) as archive:
+            batch = defaultdict(list)
+            for member in tqdm(archive):
+                if member.isfile() and raw and '.html' in member.name:
+                    symbol, codec = contentcoding.split_filename(Path(member.name).name)
+                    batch['symbol'].append(symbol)
+                    batch['codec'].append(codec)
+                    batch['html'].append(archive.extractfile(member).read())
+                elif member.isfile() and not raw and member.name.endswith('.html'):
+                    batch['symbol'].append(Path(member.name).stem)
+                    batch['html'].append(archive.extractfile(member).read().decode(encoding))
+                else:
+                    continue
+                if len(batch['symbol']) >= batch_size:
+                    yield pa.Table.from_arrays([pa.array(batch[n]) for n in names], names)
+                    batch = defaultdict(list)
+            if batch:
+                yield pa.Table.from_arrays([pa.array(batch[n]) for n in names], names)  # last partial batch
+
+    if raw:
+        compression = {'symbol': compression, 'html': 'NONE', 'codec': compression}
+
+    writer = None
+    for batch in read_incremental():
+        if writer is None:
+            writer = pq.ParquetWriter(site.parquet, batch.schema, use_dictionary=False, compression=compression, flavor={'spark'})
+        writer.write_table(batch)
+    writer.close()
+
+
+def decompress(site, encoding='utf-8'):
+    """Convert parquet to tarfile"""
+
+    pf = pq.ParquetFile(site.parquet)
+
+    progress = tqdm(file=sys.stdout, disable=False)
+
+    # raw pages are written as received, with codec in file name
+    raw = 'codec' in pf.schema.names
+
+    with tarfile.open(site.raw_arch if raw else site.arch, 'w' if raw else 'w:bz2') as archive:
+        for i in range(pf.metadata.num_row_groups):
+            columns = pf.read_row_group(i).to_pydict()
+            for symbol, html, codec in zip(columns['symbol'], columns['html'], columns.get('codec', itertools.repeat(None))):
+                data = html if raw else html.encode(encoding)
+                name = contentcoding.filename(symbol, codec) if raw else f'{symbol}.html'
+                tarinfo = tarfile.TarInfo(name=f'{site.member_dir}/{name}')
+                tarinfo.size = len(data)
+                archive.addfile(tarinfo=tarinfo, fileobj=io.BytesIO(data))
+                progress.update(1)
+
+    progress.close()
+
+
+def extract_pages(site, src=None, partial=False, cache=True):
+    """Run extractors of site on pages of Parquet, yield symbol and results by extractor name.
+
+    Raw pages are inflated only here. With partial=True pages are parsed incrementally,
+    see extractors.iter_sections(). With cache=True results are memoized, see parsecache.py.
+    """
+
+    reader = pq.ParquetFile(src or site.parquet)
+    memo = parsecache.ParseCache(site.name) if cache else None
+
+    with tqdm(total=reader.metadata.num_rows) as progress:
+        for g in range(reader.metadata.num_row_groups):
+            table = reader.read_row_group(g).to_pydict()
+            for symbol, html, codec in zip(table['symbol'], table['html'], table.get('codec', itertools.repeat(None))):
+                page = contentcoding.decode(html, codec)
+                key = parsecache.content_hash(page) if memo is not None else None
+                results = {}
+                for extractor in site.extractors:
+                    if memo is not None:
+                        results[extractor.__name__] = memo.extract(extractor, page, key=key, partial=partial)
+                    else:
+                        results[extractor.__name__] = extractor(page, partial=partial)
+                yield symbol.strip(), results
+                progress.update()
+
+    if memo is not None:
+        memo.save()
+
+
+def scrape_parsed(site, dst, parse=None, columns=None, compression='BROTLI', fetchers=100, parsers=None,
+        protocol='http1', cafile=None):
+    """Scrape pages of site and parse them directly to Parquet file, see scrapeparse.py.
+
+    parse (parse function of site by default) converts page to dict of columns (columns of site by default).
+    """
+
+    return scrapeparse.scrape_parsed(site.read_ids(), site.url, parse or site.parse, columns or site.columns, dst,
+        headers=site.headers, compression=compression, fetchers=fetchers, parsers=parsers, protocol=protocol, cafile=cafile)
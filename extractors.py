@@ -0,0 +1,277 @@
+"""
+Extractors of data fields from scraped pages.
+
+Extractors depend only on lxml (and optionally orjson), so they can be shipped
+to Spark executors (see spark_parse.py) and used by local parsers alike.
+"""
+
+import datetime
+import json
+import lxml.etree
+import lxml.html
+import re
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, state is decoded by json module without it
+    orjson = None
+
+
+# page state embedded by Yahoo into script: root.App.main = {...};\n}(this));
+YAHOO_STATE_START = 'root.App.main = '
+YAHOO_STATE_END = ';\n}(this));'
+
+# active page of forum topic pagination: <li class="ipsPagination_page ipsPagination_active"><a ... data-page="2">
+FORUM_PAGE = re.compile(rb'ipsPagination_active[^>]*>\s*<a[^>]*data-page=["\']?(\d+)')
+
+# fields of Yahoo profile, sector, industry and employees are read from one paragraph
+PROFILE_FIELDS = ('description', 'sector', 'industry', 'employees')
+INFO_FIELDS = ('sector', 'industry', 'employees')
+
+
+def versioned(version):
+    """Set version of extractor, it is bumped when extracted values change, see parsecache.py."""
+    def decorate(extractor):
+        extractor.version = version
+        return extractor
+    return decorate
+
+
+@versioned(2)
+def yahoo_profile(html, partial=False, state=True, fields=PROFILE_FIELDS):
+    """Extract company profile from Yahoo profile page.
+
+    Profile is read from embedded page state (see yahoo_state_profile()), page markup
+    is parsed only if there is no state or state=False. With partial=True only sections
+    with profile fields are built, see iter_sections(). Only given fields are extracted.
+    """
+
+    row = yahoo_state_profile(html) if state else None
+    if row is not None:
+        return {k: v for k, v in row.items() if k in fields}
+    if partial:
+        return partial_yahoo_profile(html, fields)
+
+    tree = lxml.html.fromstring(html)
+
+    row = {}
+    if 'description' in fields:
+        row['description'] = '\n'.join(tree.xpath('//section[h2//*[text()="Description"]]/p/text()'))
+    info = (tree.xpath('//div[@class="asset-profile-container"]//p[span[text()="Sector"]]') or [None])[0] \
+        if set(INFO_FIELDS) & set(fields) else None
+    if info is not None:
+        row.update((k, v) for k, v in profile_info(info).items() if k in fields)
+    return row
+
+
+@versioned(1)
+def yahoo_description(html, partial=False):
+    """Company description from Yahoo profile page, see yahoo_profile()."""
+    return yahoo_profile(html, partial=partial, fields=('description',))
+
+
+@versioned(1)
+def yahoo_company_info(html, partial=False):
+    """Sector, industry and employees from Yahoo profile page, see yahoo_profile()."""
+    return yahoo_profile(html, partial=partial, fields=INFO_FIELDS)
+
+
+def yahoo_state(html):
+    """Decode page state embedded into Yahoo page, None if there is no state."""
+
+    start_marker, end_marker = (YAHOO_STATE_START, YAHOO_STATE_END) if isinstance(html, str) \
+        else (YAHOO_STATE_START.encode(), YAHOO_STATE_END.encode())
+    start = html.find(start_marker)
+    if start < 0:
+        return None
+    start += len(start_marker)
+    end = html.find(end_marker, start)
+    try:
+        if end >= 0:
+            return orjson.loads(html[start:end]) if orjson is not None else json.loads(html[start:end])
+        # unknown end of script, decode the first JSON value (start is offset in html, bytes are decoded after it)
+        text = html[start:] if isinstance(html, str) else html[start:].decode('utf-8', errors='replace')
+        return json.JSONDecoder().raw_decode(text)[0]
+    except ValueError:
+        return None
+
+
+_last_state_profile = None, None  # (page, profile) of the last page
+
+
+def yahoo_state_profile(html):
+    """Extract company profile from Yahoo page state, None if there is no profile in state.
+
+    Profile of the last page is kept, so extractors of the same page (yahoo_description(),
+    yahoo_company_info()) decode its state once.
+    """
+
+    global _last_state_profile
+    last_html, last_profile = _last_state_profile
+    if html is last_html:
+        return last_profile
+
+    state = yahoo_state(html)
+    try:
+        profile = state['context']['dispatcher']['stores']['QuoteSummaryStore']['assetProfile']
+    except (KeyError, TypeError):
+        profile = None
+    if isinstance(profile, dict):
+        employees = profile.get('fullTimeEmployees')
+        profile = {
+            'description': profile.get('longBusinessSummary') or '',
+            'sector': profile.get('sector') or '',
+            'industry': profile.get('industry') or '',
+            'employees': '' if employees is None else str(employees),
+            }
+    else:
+        profile = None
+    _last_state_profile = html, profile
+    return profile
+
+
+def profile_info(info):
+    """Extract sector, industry and employees from Yahoo profile paragraph."""
+    return {
+        'sector': (info.xpath('./span[text()="Sector"]/following-sibling::span[1]/text()') or [''])[0],
+        'industry': (info.xpath('./span[text()="Industry"]/following-sibling::span[1]/text()') or [''])[0],
+        'employees': (info.xpath('./span[text()="Full Time Employees"]/following-sibling::span[1]/span/text()') or [''])[0].replace(',', ''),
+        }
+
+
+@versioned(1)
+def forum_comments(html, partial=False):
+    """Extract comments from forum topic page.
+
+    With partial=True only articles are built, see iter_sections().
+    """
+
+    rows = []
+    articles = iter_sections(html, ('article',), lambda el: el.tag == 'article', container=True) if partial else lxml.html.fromstring(html).xpath('//article')
+    for info in articles:
+        row = {}
+        row['comment_id'] = (info.xpath('./@id') or [''])[0]
+        row['comment_date'] = (info.xpath('.//time/@datetime') or [''])[0]
+        row['comment_text'] = text((info.xpath('.//div[@data-role="commentContent"]') or [''])[0])
+        row['comment_author'] = text((info.xpath('.//*[contains(concat(" ", @class, " "), " cAuthorPane_author ")]') or [''])[0])
+        rows.append(row)
+    return rows
+
+
+@versioned(1)
+def forum_page_number(html, partial=False):
+    """Number of forum topic page, 1 if there is no pagination (page is searched by regular expression, partial is ignored)."""
+    m = FORUM_PAGE.search(html if isinstance(html, bytes) else html.encode())
+    return int(m.group(1)) if m else 1
+
+
+def forum_rows(html):
+    """Comments of forum topic page as rows with page number (string, as other fields), parse function of forum site."""
+    page_number = str(forum_page_number(html))
+    return [{'page_number': page_number, **comment} for comment in forum_comments(html)]
+
+
+def comment_number(comment_id):
+    """Number of comment from its id (elComment_123456 -> 123456), None if there is no number."""
+    m = re.search(r'\d+', comment_id or '')
+    return int(m.group()) if m else None
+
+
+def parse_datetime(value):
+    """Timezone-aware datetime of ISO date string, None if unknown."""
+    if not value:
+        return None
+    try:
+        dt = datetime.datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    return dt if dt.tzinfo is not None else dt.replace(tzinfo=datetime.timezone.utc)
+
+
+# elements dropped by iter_sections() outside of matching ones, with all their content
+DROPPED_TAGS = ('div', 'script', 'style', 'ul', 'ol', 'table', 'form', 'nav', 'header', 'footer', 'svg')
+
+
+def iter_sections(html, tags, match, container=False, chunk_size=2**16):
+    """Parse page incrementally, yield complete elements with given tags matching at start event.
+
+    Events are reported only for these tags and DROPPED_TAGS, the latter are dropped
+    as soon as they end outside of matching elements, so mostly matching subtrees are
+    kept in memory. Reading stops when generator is closed or, with container=True,
+    when parent of matched elements ends.
+    """
+
+    parser = lxml.etree.HTMLPullParser(events=('start', 'end'), tag=tuple(tags) + DROPPED_TAGS)
+    matching = 0  # depth inside of matching element
+    parent = None
+
+    def chunks():
+        for start in range(0, len(html), chunk_size):
+            parser.feed(html[start:start + chunk_size])
+            yield parser.read_events()
+        parser.close()
+        yield parser.read_events()
+
+    for events in chunks():
+        for event, el in events:
+            if event == 'start':
+                if matching or (el.tag in tags and match(el)):
+                    matching += 1
+                continue
+            if matching:
+                matching -= 1
+                if matching:
+                    continue
+                parent = el.getparent()
+                yield el
+            elif container and el is parent:
+                return
+            el.clear(keep_tail=False)
+            while el.getprevious() is not None:
+                del el.getparent()[0]
+
+
+def partial_yahoo_profile(html, fields=PROFILE_FIELDS):
+    """Extract company profile, stop parsing as soon as all given fields are found."""
+
+    need_description = 'description' in fields
+    need_info = bool(set(INFO_FIELDS) & set(fields))
+
+    def match(el):
+        return el.tag == 'section' or (el.tag == 'div' and el.get('class') == 'asset-profile-container')
+
+    row = {}
+    sections = iter_sections(html, ('section', 'div'), match)
+    found_info = False
+    for el in sections:
+        if need_description and 'description' not in row:
+            description = el.xpath('descendant-or-self::section[h2//*[text()="Description"]]')
+            if description:
+                row['description'] = '\n'.join(description[0].xpath('./p/text()'))
+        if need_info and not found_info:
+            info = (el.xpath('descendant-or-self::div[@class="asset-profile-container"]//p[span[text()="Sector"]]') or [None])[0]
+            if info is not None:
+                row.update((k, v) for k, v in profile_info(info).items() if k in fields)
+                found_info = True
+        if (not need_description or 'description' in row) and (not need_info or found_info):
+            sections.close()
+    if need_description:
+        row.setdefault('description', '')
+    return row
+
+
+def text(node, separator=' '):
+    """Convert node to text"""
+    if node is None:
+        return ''
+    elif isinstance(node, str):
+        return node.strip()
+    elif isinstance(node, list):
+        return separator.join(text(t) for t in node)
+    else:
+        return re.sub(r'\s+', ' ',
+            separator.join(
+                [text(getattr(node, 'text', ''))]
+                + [text(c) for c in node.getchildren()]
+                + [text(getattr(node, 'tail', ''))]
+                )).strip()
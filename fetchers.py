@@ -0,0 +1,104 @@
+"""
+Fetch backends of asynchronous scrapers
+=======================================
+
+Scrapers get pages through a backend with the same contract:
+
+    async with fetchers.fetcher(protocol, url, headers=headers) as fetch:
+        page = await fetch(symbol)  # Page(status, body, content_encoding)
+
+* http1 – aiohttp, HTTP/1.1 over up to `connections` connections (one request per connection at a time),
+* http2 – httpx, HTTP/2 multiplexing many concurrent requests (streams) over a few connections,
+  so sites limiting handshakes or connections per client see only `connections` of them.
+
+With decompress=False body is returned as received, with its Content-Encoding, see contentcoding.
+Errors of failed requests are listed in `errors` attribute of the backend.
+"""
+
+import asyncio
+import ssl
+from typing import NamedTuple, Optional
+
+import aiohttp
+try:
+    import httpx
+except ImportError:  # HTTP/2 backend is optional
+    httpx = None
+
+
+class Page(NamedTuple):
+    status: int
+    body: bytes
+    content_encoding: Optional[str]
+
+
+class Http1Fetcher:
+    """aiohttp session, HTTP/1.1."""
+
+    errors = (aiohttp.ClientError, asyncio.TimeoutError)
+
+    def __init__(self, url, headers=None, decompress=True, connections=100, cafile=None):
+        self.url = url
+        self.headers = headers
+        self.decompress = decompress
+        self.connections = connections
+        self.cafile = cafile
+        self.session = None
+
+    async def __aenter__(self):
+        context = ssl.create_default_context(cafile=self.cafile) if self.cafile else None
+        self.session = aiohttp.ClientSession(headers=self.headers, auto_decompress=self.decompress,
+            connector=aiohttp.TCPConnector(limit=self.connections, ssl=context))
+        return self.fetch
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+
+    async def fetch(self, symbol):
+        async with self.session.get(self.url.format(symbol=symbol)) as response:
+            return Page(response.status, await response.read(), response.headers.get('Content-Encoding'))
+
+
+class Http2Fetcher:
+    """httpx client, HTTP/2 (falls back to HTTP/1.1 if server does not negotiate h2)."""
+
+    errors = (httpx.HTTPError, httpx.StreamError) if httpx is not None else ()
+
+    def __init__(self, url, headers=None, decompress=True, connections=2, cafile=None, timeout=60):
+        if httpx is None:
+            raise ImportError('HTTP/2 backend requires httpx with h2: pip install httpx[http2]')
+        self.url = url
+        self.headers = headers
+        self.decompress = decompress
+        self.connections = connections
+        self.cafile = cafile
+        self.timeout = timeout
+        self.client = None
+
+    async def __aenter__(self):
+        self.client = httpx.AsyncClient(http2=True, headers=self.headers, timeout=self.timeout,
+            verify=ssl.create_default_context(cafile=self.cafile) if self.cafile else True,
+            limits=httpx.Limits(max_connections=self.connections, max_keepalive_connections=self.connections))
+        return self.fetch
+
+    async def __aexit__(self, *exc):
+        await self.client.aclose()
+
+    async def fetch(self, symbol):
+        async with self.client.stream('GET', self.url.format(symbol=symbol)) as response:
+            chunks = response.aiter_bytes() if self.decompress else response.aiter_raw()
+            body = b''.join([chunk async for chunk in chunks])
+            return Page(response.status_code, body, response.headers.get('Content-Encoding'))
+
+
+FETCHERS = {
+    'http1': Http1Fetcher,
+    'http2': Http2Fetcher,
+    }
+
+
+def fetcher(protocol, url, **options):
+    """Create fetch backend for protocol, use it as async context manager."""
+    if protocol not in FETCHERS:
+        raise ValueError(f'Unsupported protocol: {protocol}')
+    return FETCHERS[protocol](url, **options)
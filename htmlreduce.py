@@ -0,0 +1,50 @@
+"""
+Reduce scraped pages to the parts used by parsers.
+
+Pages are mostly scripts, styles and navigation, while parsers only read a few
+sections. Reduced page keeps the matching subtrees in document order plus the
+hash and size of the original page for provenance, so existing XPath queries
+keep working on reduced pages.
+"""
+
+import hashlib
+import lxml.etree
+import lxml.html
+
+
+def reduce_html(html, sections, encoding='utf-8'):
+    """Keep only subtrees matched by XPath expressions."""
+
+    try:
+        tree = lxml.html.fromstring(html)
+    except (lxml.etree.ParserError, ValueError):
+        return html  # empty or broken page, keep as is
+
+    # collect matching elements, skipping the ones nested in already matched
+    matched = set()
+    for xpath in sections:
+        matched.update(tree.xpath(xpath))
+    keep = [el for el in tree.iter() if el in matched
+        and not any(parent in matched for parent in el.iterancestors())]
+
+    raw = html if isinstance(html, bytes) else html.encode(encoding)
+    page = lxml.html.Element('html')
+    head = lxml.etree.SubElement(page, 'head')
+    lxml.etree.SubElement(head, 'meta', charset=encoding)
+    lxml.etree.SubElement(head, 'meta', name='source-sha256', content=hashlib.sha256(raw).hexdigest())
+    lxml.etree.SubElement(head, 'meta', name='source-length', content=str(len(raw)))
+    body = lxml.etree.SubElement(page, 'body')
+    for el in keep:
+        el.tail = None
+        body.append(el)
+
+    return lxml.html.tostring(page, encoding=encoding, doctype='<!DOCTYPE html>')
+
+
+def source_info(html):
+    """Read provenance of reduced page: (sha256, length) or None for original pages."""
+
+    tree = lxml.html.fromstring(html)
+    sha = tree.xpath('/html/head/meta[@name="source-sha256"]/@content')
+    length = tree.xpath('/html/head/meta[@name="source-length"]/@content')
+    return (sha[0], int(length[0])) if sha and length else None
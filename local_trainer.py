@@ -0,0 +1,255 @@
+"""
+Single-node sector classifier
+=============================
+
+Trains the same multinomial logistic regression as naics.py without Spark.
+Parsed profiles are streamed from Parquet (build/yahoo_data.parquet written by
+spark_parse.py) row group by row group, pool of processes tokenizes descriptions
+(tokens.words(), the same tokens as naics.text_stages()) and hashes terms to
+sparse CSR blocks of NUM_FEATURES columns. Term frequencies are weighted by IDF
+of training companies (the same formula and MIN_DF as naics.py) and L2 normalized.
+The main process fits weights by mini-batch SGD with AdaGrad steps while next
+blocks are prepared. Blocks are not kept, every epoch streams Parquet again, so
+memory is bounded by weights and a few blocks.
+
+Every fifth company is held out for testing, the same companies as naics.is_test(),
+accuracy and time of every epoch are printed. Accuracy is comparable with TF-IDF
+model of naics.py, but not equal to it: terms are hashed by crc32 to more features
+than Spark HashingTF uses and the model is fitted by SGD instead of L-BFGS.
+
+Run this code with
+
+    > invoke run "local_trainer:train()"
+    > invoke run "local_trainer:train(epochs=10, workers=4)"
+"""
+
+import collections
+import concurrent.futures
+import math
+import os
+import time
+from typing import NamedTuple
+import zlib
+
+import numpy as np
+import pyarrow.parquet as pq
+
+import config as cfg
+import tokens
+from yahoo import YAHOO_DATA_PARQUET
+
+
+LOCAL_MODEL = cfg.BUILDDIR / 'model_local.npz'
+
+NUM_FEATURES = 2**18
+BATCH_ROWS = 2048  # rows of block prepared by one task
+MINI_BATCH = 128
+LEARNING_RATE = 0.5
+REG = 1e-5
+TEST_SHARE = 5  # every fifth company is held out, the same as naics.TEST_SHARE
+MIN_DF = 5  # terms of fewer training companies get zero IDF, the same as naics.MIN_DF
+
+
+class Block(NamedTuple):
+    """Rows of CSR matrix with their labels."""
+    indptr: np.ndarray
+    indices: np.ndarray
+    data: np.ndarray
+    labels: np.ndarray
+
+    def rows(self, start, stop):
+        """Block of rows [start, stop)."""
+        begin, end = self.indptr[start], self.indptr[stop]
+        return Block(self.indptr[start:stop + 1] - begin, self.indices[begin:end], self.data[begin:end], self.labels[start:stop])
+
+
+def parquet_files(src):
+    """Parquet files of dataset, Spark writes folder of part files."""
+    return sorted(src.glob('*.parquet')) if src.is_dir() else [src]
+
+
+def read_batches(src, columns, batch_rows=BATCH_ROWS):
+    """Stream columns of dataset as dicts of lists with up to batch_rows rows."""
+    for path in parquet_files(src):
+        reader = pq.ParquetFile(path)
+        for g in range(reader.metadata.num_row_groups):
+            table = reader.read_row_group(g, columns=columns)
+            for start in range(0, table.num_rows, batch_rows):
+                yield table.slice(start, batch_rows).to_pydict()
+
+
+def read_labels(src):
+    """Sectors ordered by frequency, the same order as StringIndexer uses."""
+    counts = collections.Counter()
+    for batch in read_batches(src, ['sector'], batch_rows=2**16):
+        counts.update(s for s in batch['sector'] if s)
+    return [s for s, c in sorted(counts.items(), key=lambda sc: (-sc[1], sc[0]))]
+
+
+def is_test(symbol):
+    """Deterministic holdout of companies, the same as naics.is_test() (Spark crc32 of UTF-8 symbol)."""
+    return zlib.crc32(symbol.encode()) % TEST_SHARE == 0
+
+
+def hash_terms(description, num_features=NUM_FEATURES):
+    """Hashed terms of description and their frequencies, None if there are no terms."""
+    counts = collections.Counter(zlib.crc32(t.encode()) % num_features for t in tokens.words(description))
+    if not counts:
+        return None
+    return np.fromiter(counts, dtype=np.int64, count=len(counts)), np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+
+
+def tfidf(block, idf):
+    """Block with term frequencies weighted by idf, rows L2 normalized."""
+    data = block.data * idf[block.indices]
+    if len(data):  # rows have at least one term, see hash_terms()
+        norms = np.sqrt(np.add.reduceat(data ** 2, block.indptr[:-1]))
+        data = data / np.repeat(np.where(norms > 0, norms, 1), np.diff(block.indptr))
+    return block._replace(data=data)
+
+
+def document_frequencies(src, labels, pool, workers, num_features=NUM_FEATURES, min_df=MIN_DF):
+    """IDF of hashed terms of training companies, the same formula as Spark IDF uses."""
+    df = np.zeros(num_features)
+    docs = 0
+    for block in stream_blocks(src, labels, False, pool, workers, num_features):
+        df += np.bincount(block.indices, minlength=num_features)  # terms of row are unique
+        docs += len(block.labels)
+    return np.where(df >= min_df, np.log((docs + 1) / (df + 1)), 0.0)
+
+
+def to_block(rows, targets):
+    """CSR block of hashed rows."""
+    return Block(
+        np.cumsum([0] + [len(indices) for indices, values in rows], dtype=np.int64),
+        np.concatenate([indices for indices, values in rows]) if rows else np.zeros(0, dtype=np.int64),
+        np.concatenate([values for indices, values in rows]) if rows else np.zeros(0, dtype=np.float32),
+        np.array(targets, dtype=np.int64))
+
+
+def featurize(batch, labels, test, num_features=NUM_FEATURES):
+    """CSR block of training or testing rows of batch, rows without sector or terms are skipped."""
+
+    label_index = {label: i for i, label in enumerate(labels)}
+    rows, targets = [], []
+    for symbol, sector, description in zip(batch['symbol'], batch['sector'], batch['description']):
+        if sector not in label_index or is_test(symbol or '') != test:
+            continue
+        row = hash_terms(description, num_features)
+        if row is not None:
+            rows.append(row)
+            targets.append(label_index[sector])
+    return to_block(rows, targets)
+
+
+def stream_blocks(src, labels, test, pool, workers, num_features=NUM_FEATURES):
+    """Featurize batches in pool, keep at most two blocks per process in flight."""
+
+    pending = collections.deque()
+    for batch in read_batches(src, ['symbol', 'sector', 'description']):
+        pending.append(pool.submit(featurize, batch, labels, test, num_features))
+        if len(pending) >= 2 * workers:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def logits(block, weights, bias):
+    """Scores of classes for rows of block."""
+    row_sums = np.add.reduceat(weights[block.indices] * block.data[:, None], block.indptr[:-1], axis=0)
+    return row_sums + bias
+
+
+def softmax(scores):
+    scores = scores - scores.max(axis=1, keepdims=True)
+    e = np.exp(scores)
+    return e / e.sum(axis=1, keepdims=True)
+
+
+def sgd_step(block, weights, bias, accumulated, accumulated_bias, learning_rate, reg):
+    """AdaGrad step on mini-batch, only weights of present features are updated. Returns loss."""
+
+    n, classes = len(block.labels), weights.shape[1]
+    probability = softmax(logits(block, weights, bias))
+    loss = -np.log(probability[np.arange(n), block.labels] + 1e-12).mean()
+    errors = probability
+    errors[np.arange(n), block.labels] -= 1
+    errors /= n
+
+    # gradient of weights of unique features of mini-batch
+    rows = np.repeat(np.arange(n), np.diff(block.indptr))
+    features, position = np.unique(block.indices, return_inverse=True)
+    contributions = block.data[:, None] * errors[rows]
+    gradient = np.stack([np.bincount(position, weights=contributions[:, k], minlength=len(features)) for k in range(classes)], axis=1)
+    gradient += reg * weights[features]
+
+    accumulated[features] += gradient ** 2
+    weights[features] -= learning_rate * gradient / (np.sqrt(accumulated[features]) + 1e-8)
+    bias_gradient = errors.sum(axis=0)
+    accumulated_bias += bias_gradient ** 2
+    bias -= learning_rate * bias_gradient / (np.sqrt(accumulated_bias) + 1e-8)
+    return loss
+
+
+def evaluate(src, labels, weights, bias, idf, pool, workers):
+    """Accuracy on held out companies."""
+    correct = total = 0
+    for block in stream_blocks(src, labels, True, pool, workers, weights.shape[0]):
+        if len(block.labels):
+            block = tfidf(block, idf)
+            correct += int((logits(block, weights, bias).argmax(axis=1) == block.labels).sum())
+            total += len(block.labels)
+    return correct / total if total else math.nan
+
+
+def train(src=YAHOO_DATA_PARQUET, epochs=5, workers=None, learning_rate=LEARNING_RATE, reg=REG,
+        mini_batch=MINI_BATCH, num_features=NUM_FEATURES, dst=LOCAL_MODEL):
+    """Fit sector classifier on one node, print accuracy and time of every epoch, save model."""
+
+    if not src.exists():
+        raise FileNotFoundError(f'{src} not found, parse pages with spark_parse.py first')
+    workers = workers or os.cpu_count()
+    labels = read_labels(src)
+    weights = np.zeros((num_features, len(labels)))
+    bias = np.zeros(len(labels))
+    accumulated = np.zeros_like(weights)
+    accumulated_bias = np.zeros_like(bias)
+    rng = np.random.default_rng(100500)
+    accuracy = math.nan
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        idf = document_frequencies(src, labels, pool, workers, num_features)
+        for epoch in range(1, epochs + 1):
+            started = time.perf_counter()
+            losses, rows = [], 0
+            for block in stream_blocks(src, labels, False, pool, workers, num_features):
+                block = tfidf(block, idf)
+                # shuffle mini-batches within block, blocks come in file order
+                starts = rng.permutation(np.arange(0, len(block.labels), mini_batch))
+                for start in starts:
+                    part = block.rows(start, min(start + mini_batch, len(block.labels)))
+                    losses.append(sgd_step(part, weights, bias, accumulated, accumulated_bias, learning_rate, reg))
+                rows += len(block.labels)
+            trained = time.perf_counter() - started
+            accuracy = evaluate(src, labels, weights, bias, idf, pool, workers)
+            print(f'Epoch {epoch}: {rows} companies, loss {np.mean(losses) if losses else math.nan:.4f}, '
+                  f'{trained:.2f}s training, test accuracy = {accuracy:.4f}')
+
+    print(f'Local logistic regression model accuracy = {accuracy}')
+    np.savez_compressed(dst, weights=weights, bias=bias, idf=idf, labels=np.array(labels))
+    return accuracy
+
+
+def predict(descriptions, path=LOCAL_MODEL):
+    """Sectors of company descriptions by saved model, None for descriptions without terms."""
+
+    model = np.load(path)
+    weights, labels = model['weights'], [str(label) for label in model['labels']]
+    rows = [hash_terms(d, weights.shape[0]) for d in descriptions]
+    known = [i for i, row in enumerate(rows) if row is not None]
+    result = [None] * len(descriptions)
+    if known:
+        block = tfidf(to_block([rows[i] for i in known], [0] * len(known)), model['idf'])
+        for i, k in zip(known, logits(block, weights, model['bias']).argmax(axis=1)):
+            result[i] = labels[k]
+    return result
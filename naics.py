@@ -1,40 +1,99 @@
+import json
+import math
 import pickle
-from pyspark import SparkContext
-from pyspark.ml import Pipeline
-from pyspark.ml.classification import LogisticRegression
+from py4j.protocol import Py4JError
+import pyspark
+from pyspark.ml import Pipeline, PipelineModel
+from pyspark.ml.classification import LogisticRegression, LogisticRegressionModel
 from pyspark.ml.evaluation import MulticlassClassificationEvaluator
-from pyspark.ml.feature import CountVectorizer, HashingTF, IDF, RegexTokenizer, StopWordsRemover, StringIndexer
+from pyspark.ml.feature import CountVectorizer, CountVectorizerModel, ElementwiseProduct, HashingTF, IDF, \
+    RegexTokenizer, StopWordsRemover, StringIndexer, StringIndexerModel
+from pyspark.ml.linalg import DenseVector
 from pyspark.ml.tuning import ParamGridBuilder, CrossValidator, CrossValidatorModel
-from pyspark.sql import SQLContext
+import pyspark.sql.functions as F
+from pyspark.sql.window import Window
+import shutil
 
-from config import BUILDDIR, DATADIR
+import catalog
+from config import BUILDDIR
+from dedup import spark_cluster_ids
+from sketch_vocabulary import SketchCountVectorizer
+import sparksession
+import tokens
+from yahoo import YAHOO_DATA, YAHOO_DATA_PARQUET
 
 FINAL_MODEL = BUILDDIR / 'model_cv'
+MODEL_LR = BUILDDIR / 'model_lr'
+MODEL_STATE = BUILDDIR / 'model_state'
 
+VOCAB_SIZE = 700
+MIN_DF = 5
+FEATURES = 'words_tfidf'  # features of incrementally trained model
+TEST_SHARE = 5  # every fifth company (by hash of symbol) is held out of incrementally trained models
 
-spark = SQLContext(SparkContext.getOrCreate())
 
+def read_yahoo():
+    """Read parsed Yahoo profiles."""
 
-def main():
+    # table registered by catalog.py is preferred, then typed Parquet written by spark_parse.py, then CSV
+    spark = sparksession.session()
+    if catalog.table_exists(spark, 'yahoo_profiles'):
+        return sparksession.session(inputs=[catalog.WAREHOUSE / 'yahoo_profiles']).table('yahoo_profiles')
+    elif YAHOO_DATA_PARQUET.exists():
+        return sparksession.session(inputs=[YAHOO_DATA_PARQUET]).read.parquet(str(YAHOO_DATA_PARQUET))
+    else:
+        return sparksession.session(inputs=[YAHOO_DATA]).read.csv(str(YAHOO_DATA), header=True)
 
-    # read data
-    yahoo = spark.read.csv(f'{BUILDDIR}/yahoo.csv', header=True)
-    data = yahoo.select(['sector', 'description']).dropna()
+
+def text_stages(column='description', pattern='\\W'):
+    """Stages converting text column (description by default) to list of clean words.
+
+    Java '\\W' matches non-ASCII letters too, pattern='(?U)\\W' keeps Unicode words (Cyrillic comments).
+    """
 
     # tokenize texts based on regular expression
-    tokenize = RegexTokenizer(inputCol='description', outputCol='words_all', pattern='\\W')
+    tokenize = RegexTokenizer(inputCol=column, outputCol='words_all', pattern=pattern)
 
     # remove stop words
-    stopwords = '\n'.join((DATADIR/'stopwords'/f).read_text().strip() for f in ('mysql.txt', 'nltk.txt')).splitlines()
-    remove_stopwords = StopWordsRemover(inputCol='words_all', outputCol='words_clean').setStopWords(stopwords)
+    remove_stopwords = StopWordsRemover(inputCol='words_all', outputCol='words_clean').setStopWords(sorted(tokens.stopwords()))
+
+    return [tokenize, remove_stopwords]
+
+
+def main(vocabulary='exact', duplicates=None, threshold=0.8):
+    """Train sector classifiers.
+
+    vocabulary='sketch' builds vocabulary with one-pass sketches,
+    duplicates='drop' or 'weight' drops or down-weights near-duplicate descriptions.
+    """
+
+    # read data
+    data = read_yahoo().select(['symbol', 'sector', 'description']).dropna()
+
+    # near-duplicate descriptions (e.g. share classes of one company)
+    data = data.withColumn('weight', F.lit(1.0))
+    if duplicates is not None:
+        data = spark_cluster_ids(data, 'description', 'symbol', threshold=threshold)
+        if duplicates == 'drop':
+            data = data.filter(F.col('symbol') == F.col('cluster_id'))
+        elif duplicates == 'weight':
+            data = data.withColumn('weight', 1.0 / F.count('*').over(Window.partitionBy('cluster_id')))
+        else:
+            raise ValueError(f'Unsupported duplicates handling: {duplicates}')
+
+    # tokenize texts and remove stop words
+    tokenize, remove_stopwords = text_stages()
 
     # get words frequency using simple count (bag of words)
-    add_wordcount = CountVectorizer(inputCol='words_clean', outputCol='words_count', vocabSize=700, minDF=5)
+    if vocabulary == 'sketch':
+        add_wordcount = SketchCountVectorizer(inputCol='words_clean', outputCol='words_count', vocabSize=VOCAB_SIZE, minDF=MIN_DF)
+    else:
+        add_wordcount = CountVectorizer(inputCol='words_clean', outputCol='words_count', vocabSize=VOCAB_SIZE, minDF=MIN_DF)
 
     # get tf-idf words frequencies
 
-    add_wordtf = HashingTF(inputCol='words_clean', outputCol='words_tf', numFeatures=700)
-    add_wordidf = IDF(inputCol='words_tf', outputCol='words_tfidf', minDocFreq=5)
+    add_wordtf = HashingTF(inputCol='words_clean', outputCol='words_tf', numFeatures=VOCAB_SIZE)
+    add_wordidf = IDF(inputCol='words_tf', outputCol='words_tfidf', minDocFreq=MIN_DF)
 
     # prepare output values
     index_target = StringIndexer(inputCol='sector', outputCol='label')
@@ -57,10 +116,10 @@ def main():
 
     # fit logistic regression models
 
-    logistic_wordcount = LogisticRegression(regParam=0.3, elasticNetParam=0,
+    logistic_wordcount = LogisticRegression(regParam=0.3, elasticNetParam=0, weightCol='weight',
         featuresCol='words_count', labelCol='label', predictionCol='prediction', probabilityCol='probability')
 
-    logistic_tfidf = LogisticRegression(regParam=0.3, elasticNetParam=0,
+    logistic_tfidf = LogisticRegression(regParam=0.3, elasticNetParam=0, weightCol='weight',
         featuresCol='words_tfidf', labelCol='label', predictionCol='prediction', probabilityCol='probability')
 
     evaluator = MulticlassClassificationEvaluator(predictionCol='prediction', metricName='accuracy')
@@ -95,5 +154,186 @@ def main():
     breakpoint()
 
 
+def count_terms(words):
+    """Term counts (tf) and document frequencies (df) of clean words."""
+    return (words
+        .select('symbol', F.explode('words_clean').alias('term'))
+        .groupBy('term')
+        .agg(F.count('*').alias('tf'), F.countDistinct('symbol').alias('df'))
+        )
+
+
+def select_vocabulary(terms, vocab_size=VOCAB_SIZE, min_df=MIN_DF):
+    """Most frequent terms, the same way as CountVectorizer selects them."""
+    rows = terms.filter(F.col('df') >= min_df).orderBy(F.desc('tf'), 'term').limit(vocab_size).collect()
+    return [row['term'] for row in rows]
+
+
+def idf_vector(terms, vocabulary, num_docs, min_df=MIN_DF):
+    """IDF weights of vocabulary terms, the same formula as IDF uses."""
+    df = {row['term']: row['df'] for row in terms.filter(F.col('term').isin(vocabulary)).collect()}
+    return DenseVector([
+        math.log((num_docs + 1) / (df.get(t, 0) + 1)) if df.get(t, 0) >= min_df else 0.0
+        for t in vocabulary
+        ])
+
+
+def is_test(symbol='symbol'):
+    """Deterministic holdout of companies, the same as local_trainer.is_test()."""
+    return F.crc32(F.col(symbol)) % TEST_SHARE == 0
+
+
+def replace_dir(df, path):
+    """Write dataframe as parquet instead of the one it may be computed from."""
+    tmp = path.with_name(path.name + '.tmp')
+    df.write.parquet(str(tmp), mode='overwrite')
+    if path.exists():
+        shutil.rmtree(path)
+    tmp.rename(path)
+
+
+def warm_start(logistic, model):
+    """Start logistic regression from coefficients of model, False if Spark does not support it.
+
+    setInitialModel() is not exposed in PySpark, it is called on JVM object (Spark 2.0+).
+    """
+
+    if int(pyspark.__version__.split('.')[0]) < 2:
+        return False
+    try:
+        logistic._java_obj.setInitialModel(model._java_obj)
+    except Py4JError:
+        return False
+    return True
+
+
+def train_incremental(drift_threshold=0.1, max_iter=20):
+    """Update sector classifier with companies which were not used for training yet.
+
+    Only featurization is incremental: document frequencies and term counts are updated
+    from new companies only. Logistic regression is still fitted on all training companies
+    (TF-IDF features with updated idf), it is warm-started from coefficients saved in MODEL_LR,
+    so it converges in fewer iterations; without warm start support (see warm_start())
+    model is retrained. Held out companies (see is_test()) are never used for training,
+    so accuracy is comparable between runs.
+    Vocabulary and labels are kept, if vocabulary drift (share of terms which would
+    leave the vocabulary) exceeds threshold or new sectors appear, model is retrained.
+    """
+
+    if not (MODEL_STATE / 'state.json').exists() or not MODEL_LR.exists():
+        return train_full()
+
+    state = json.loads((MODEL_STATE / 'state.json').read_text())
+    if state.get('features') != FEATURES:
+        print('Saved model was trained on other features, retraining model')
+        return train_full()
+    data = read_yahoo().select(['symbol', 'sector', 'description']).dropna()
+    spark = sparksession.session()
+    trained = spark.read.parquet(str(MODEL_STATE / 'symbols.parquet'))
+
+    # update counts from new companies only
+    delta = data.join(trained, on='symbol', how='left_anti')
+    delta = PipelineModel(text_stages()).transform(delta).cache()
+    num_delta = delta.count()
+    if num_delta == 0:
+        print('Model is up to date')
+        return
+    terms = (spark.read.parquet(str(MODEL_STATE / 'terms.parquet'))
+        .unionByName(count_terms(delta))
+        .groupBy('term')
+        .agg(F.sum('tf').alias('tf'), F.sum('df').alias('df'))
+        )
+    num_docs = state['num_docs'] + num_delta
+
+    # check drift of vocabulary and labels
+    vocabulary = select_vocabulary(terms)
+    drift = 1 - len(set(vocabulary) & set(state['vocabulary'])) / max(len(state['vocabulary']), 1)
+    new_labels = {row['sector'] for row in delta.select('sector').distinct().collect()} - set(state['labels'])
+    print(f'New companies: {num_delta}, vocabulary drift: {drift:.3f}, new sectors: {len(new_labels)}')
+    if drift > drift_threshold or new_labels:
+        print('Vocabulary or sectors have changed, retraining model')
+        return train_full()
+
+    # prepare all data with frozen vocabulary, labels and updated idf
+    prepare = PipelineModel(text_stages() + [
+        CountVectorizerModel.from_vocabulary(state['vocabulary'], inputCol='words_clean', outputCol='words_count'),
+        ElementwiseProduct(inputCol='words_count', outputCol='words_tfidf',
+            scalingVec=idf_vector(terms, state['vocabulary'], num_docs)),
+        StringIndexerModel.from_labels(state['labels'], inputCol='sector', outputCol='label'),
+        ])
+    prepared = prepare.transform(data)
+    training, testing = prepared.filter(~is_test()), prepared.filter(is_test())
+
+    previous = LogisticRegressionModel.load(str(MODEL_LR))
+    logistic = LogisticRegression(maxIter=max_iter, **best_params(),
+        featuresCol=FEATURES, labelCol='label', predictionCol='prediction', probabilityCol='probability')
+    if not warm_start(logistic, previous):
+        print(f'Warm start is not supported by Spark {pyspark.__version__}, retraining model')
+        return train_full()
+
+    model = logistic.fit(training)
+    evaluator = MulticlassClassificationEvaluator(predictionCol='prediction', metricName='accuracy')
+    print(f'Incremental logistic regression model accuracy = {evaluator.evaluate(model.transform(testing))}')
+
+    model.write().overwrite().save(str(MODEL_LR))
+    replace_dir(terms, MODEL_STATE / 'terms.parquet')
+    replace_dir(data.select('symbol'), MODEL_STATE / 'symbols.parquet')
+    state['num_docs'] = num_docs
+    (MODEL_STATE / 'state.json').write_text(json.dumps(state))
+
+
+def prepare_full(data):
+    """Count terms of all companies and prepare features and labels."""
+
+    words = PipelineModel(text_stages()).transform(data).cache()
+
+    terms = count_terms(words).cache()
+    vocabulary = select_vocabulary(terms)
+    num_docs = words.count()
+    labels = StringIndexer(inputCol='sector', outputCol='label').fit(data).labels
+
+    prepare = PipelineModel([
+        CountVectorizerModel.from_vocabulary(vocabulary, inputCol='words_clean', outputCol='words_count'),
+        ElementwiseProduct(inputCol='words_count', outputCol='words_tfidf',
+            scalingVec=idf_vector(terms, vocabulary, num_docs)),
+        StringIndexerModel.from_labels(labels, inputCol='sector', outputCol='label'),
+        ])
+    return prepare.transform(words), terms, vocabulary, num_docs, labels
+
+
+def train_full():
+    """Train sector classifier on all companies and save state for incremental training."""
+
+    data = read_yahoo().select(['symbol', 'sector', 'description']).dropna()
+    prepared, terms, vocabulary, num_docs, labels = prepare_full(data)
+    training, testing = prepared.filter(~is_test()), prepared.filter(is_test())
+
+    logistic = LogisticRegression(**best_params(),
+        featuresCol=FEATURES, labelCol='label', predictionCol='prediction', probabilityCol='probability')
+    model = logistic.fit(training)
+    evaluator = MulticlassClassificationEvaluator(predictionCol='prediction', metricName='accuracy')
+    print(f'Full logistic regression model accuracy = {evaluator.evaluate(model.transform(testing))}')
+
+    model.write().overwrite().save(str(MODEL_LR))
+    MODEL_STATE.mkdir(parents=True, exist_ok=True)
+    replace_dir(terms, MODEL_STATE / 'terms.parquet')
+    replace_dir(data.select('symbol'), MODEL_STATE / 'symbols.parquet')
+    (MODEL_STATE / 'state.json').write_text(json.dumps({
+        'num_docs': num_docs,
+        'vocabulary': vocabulary,
+        'labels': labels,
+        'features': FEATURES,
+        }))
+
+
+def best_params():
+    """Regularization found by cross-validation in main(), defaults if there is no saved model."""
+
+    if not FINAL_MODEL.exists():
+        return {'regParam': 0.3, 'elasticNetParam': 0.0}
+    best = CrossValidatorModel.load(str(FINAL_MODEL)).bestModel
+    return {'regParam': best.getOrDefault('regParam'), 'elasticNetParam': best.getOrDefault('elasticNetParam')}
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,171 @@
+"""
+Parquet layout advisor
+======================
+
+Samples row groups of a Parquet dataset, writes the sample in memory with every
+combination of codec and level, row group size and dictionary encoding, and
+measures compression ratio, encode and decode throughput. Best layout is
+recommended for the objective:
+
+* size – smallest file (archiving),
+* write – fastest encoding (nightly scraping),
+* scan – fastest decoding (Spark training),
+
+write and scan only consider layouts at most SIZE_TOLERANCE times larger than
+the smallest one. With apply=True dataset is rewritten with recommended layout.
+
+Run this code with
+
+    > invoke run "parquetadvisor:advise('build/yahoo.parquet', objective='scan')"
+    > invoke run "parquetadvisor:advise('build/project_main.parquet', objective='size', apply=True)"
+"""
+
+import io
+import itertools
+import json
+from pathlib import Path
+import shutil
+import time
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import compaction
+import config as cfg
+
+
+CODECS = (
+    ('NONE', None),
+    ('SNAPPY', None),
+    ('LZ4', None),
+    ('ZSTD', 1),
+    ('ZSTD', 3),
+    ('ZSTD', 9),
+    ('ZSTD', 19),
+    ('BROTLI', 1),
+    ('BROTLI', 5),
+    ('BROTLI', 9),
+    )
+ROW_GROUP_MB = (8, 32, 128)
+OBJECTIVES = ('size', 'write', 'scan')
+SIZE_TOLERANCE = 2.0
+ADVICE = cfg.BUILDDIR / 'parquet_advice.json'
+
+
+def sample(src, sample_mb=64):
+    """Read row groups spread over dataset (file or folder) up to sample size."""
+
+    readers = [pq.ParquetFile(path) for path in compaction.parquet_files(Path(src))]
+    groups = [(reader, g) for reader in readers for g in range(reader.metadata.num_row_groups)]
+    sizes = [reader.metadata.row_group(g).total_byte_size for reader, g in groups]
+    take = max(1, min(len(groups), round(len(groups) * sample_mb * 2**20 / max(sum(sizes), 1))))
+    picked = [groups[i] for i in sorted({g * len(groups) // take for g in range(take)})]
+    return pa.concat_tables([reader.read_row_group(g) for reader, g in picked]), sum(sizes)
+
+
+def measure(table, compression, level, row_group_rows, dictionary):
+    """Write and read table in memory, return size and throughputs."""
+
+    buffer = io.BytesIO()
+    started = time.perf_counter()
+    pq.write_table(table, buffer, compression=compression, compression_level=level,
+        row_group_size=row_group_rows, use_dictionary=dictionary, flavor={'spark'})
+    encode = time.perf_counter() - started
+
+    data = buffer.getvalue()
+    started = time.perf_counter()
+    pq.read_table(pa.BufferReader(data))
+    decode = time.perf_counter() - started
+
+    mb = table.nbytes / 2**20
+    return {
+        'bytes': len(data),
+        'ratio': table.nbytes / max(len(data), 1),
+        'encode_mb_s': mb / encode,
+        'decode_mb_s': mb / decode,
+        }
+
+
+def recommend(results, objective):
+    """Best layout for objective."""
+
+    if objective not in OBJECTIVES:
+        raise ValueError(f'Unsupported objective: {objective}')
+    if objective == 'size':
+        return min(results, key=lambda r: (r['bytes'], -r['decode_mb_s']))
+    smallest = min(r['bytes'] for r in results)
+    candidates = [r for r in results if r['bytes'] <= smallest * SIZE_TOLERANCE]
+    key = 'encode_mb_s' if objective == 'write' else 'decode_mb_s'
+    return max(candidates, key=lambda r: r[key])
+
+
+def apply_layout(src, layout, dst=None):
+    """Rewrite dataset (file or folder) with layout into one file, row groups are regrouped to layout size.
+
+    Columns stored uncompressed (raw pages compressed already) stay uncompressed.
+    """
+
+    src = Path(src)
+    dst = Path(dst or src)
+    files = compaction.parquet_files(src)
+    tmp = dst.with_name(dst.name + '.tmp')
+    compression, level = compaction.column_compression(files[0], layout['compression']), layout['level']
+    if isinstance(compression, dict) and level is not None:
+        # uncompressed columns don't accept compression level
+        level = {column: level for column, codec in compression.items() if codec != 'NONE'}
+    options = dict(compression=compression, compression_level=level, use_dictionary=layout['dictionary'], flavor={'spark'})
+
+    with pq.ParquetWriter(tmp, pq.read_schema(files[0]), **options) as writer:
+        batches, rows = [], 0
+        for path in files:
+            reader = pq.ParquetFile(path)
+            for g in range(reader.metadata.num_row_groups):
+                batch = reader.read_row_group(g)
+                batches.append(batch)
+                rows += batch.num_rows
+                if rows >= layout['row_group_rows']:
+                    writer.write_table(pa.concat_tables(batches), row_group_size=layout['row_group_rows'])
+                    batches, rows = [], 0
+        if batches:
+            writer.write_table(pa.concat_tables(batches), row_group_size=layout['row_group_rows'])
+
+    if dst.is_dir():
+        shutil.rmtree(dst)
+    tmp.replace(dst)
+
+
+def advise(src, objective='scan', sample_mb=64, apply=False, dst=None):
+    """Measure layouts on sample of dataset, print and save recommendation, optionally apply it."""
+
+    table, dataset_bytes = sample(src, sample_mb)
+    bytes_per_row = table.nbytes / max(table.num_rows, 1)
+    dictionaries = {'none': False, 'auto': compaction.dictionary_columns(table) or False}
+
+    results = []
+    for (compression, level), row_group_mb, (dictionary, columns) in itertools.product(CODECS, ROW_GROUP_MB, dictionaries.items()):
+        row_group_rows = max(1, int(row_group_mb * 2**20 / bytes_per_row))
+        result = measure(table, compression, level, row_group_rows, columns)
+        results.append({
+            'compression': compression, 'level': level, 'row_group_mb': row_group_mb,
+            'row_group_rows': row_group_rows, 'dictionary': columns, 'dictionary_mode': dictionary,
+            **result,
+            })
+
+    print(f'{"codec":>10} {"level":>5} {"rg MB":>5} {"dict":>4} {"ratio":>7} {"enc MB/s":>9} {"dec MB/s":>9}')
+    for r in sorted(results, key=lambda r: r['bytes']):
+        print(f'{r["compression"]:>10} {r["level"] or "":>5} {r["row_group_mb"]:>5} {r["dictionary_mode"]:>4} '
+              f'{r["ratio"]:>7.2f} {r["encode_mb_s"]:>9.1f} {r["decode_mb_s"]:>9.1f}')
+
+    best = recommend(results, objective)
+    print(f'Recommended for {objective}: compression={best["compression"]!r}, compression_level={best["level"]}, '
+          f'row_group_size={best["row_group_rows"]} ({best["row_group_mb"]} MB), use_dictionary={best["dictionary"]!r}, '
+          f'ratio {best["ratio"]:.2f} (sample of {table.nbytes / 2**20:.1f} MB from {dataset_bytes / 2**20:.1f} MB)')
+
+    advice = json.loads(ADVICE.read_text()) if ADVICE.exists() else {}
+    advice[f'{Path(src).name}:{objective}'] = best
+    ADVICE.write_text(json.dumps(advice, indent=1))
+
+    if apply:
+        apply_layout(src, best, dst)
+        print(f'Rewritten {dst or src}')
+    return best
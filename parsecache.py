@@ -0,0 +1,107 @@
+"""
+Memoized parsing
+================
+
+Results of extractors are cached in side-car Parquet files build/parse_cache/<name>.parquet
+keyed by (content hash of page and extractor options, extractor name, extractor version):
+
+    cache = ParseCache('yahoo')
+    row = cache.extract(extractors.yahoo_description, html, partial=True)
+    cache.save()
+
+Extractors are versioned with extractors.versioned(), the version is bumped when
+extracted values change. So on rerun only pages with changed content and
+extractors with changed version are parsed, results of other extractors are
+taken from the cache. Entries of old versions are dropped, the rest is evicted
+least recently used first, when cache is larger than max_mb.
+"""
+
+import hashlib
+import json
+import shutil
+import time
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import config as cfg
+
+
+CACHE_DIR = cfg.BUILDDIR / 'parse_cache'
+CACHE_MB = 512
+
+SCHEMA = pa.schema([
+    ('key', pa.string()),
+    ('extractor', pa.string()),
+    ('version', pa.int32()),
+    ('result', pa.string()),
+    ('used', pa.float64()),
+    ])
+
+
+def content_hash(html):
+    """Hash of page content."""
+    return hashlib.blake2b(html if isinstance(html, bytes) else html.encode(), digest_size=16).hexdigest()
+
+
+class ParseCache:
+    """Cache of extractor results, kept in memory while parsing."""
+
+    def __init__(self, name, path=CACHE_DIR, max_mb=CACHE_MB):
+        self.path = path / f'{name}.parquet'
+        self.max_bytes = max_mb * 2**20
+        self.entries = {}  # (key, extractor, version) -> [result json, last used]
+        self.versions = {}  # extractor -> version used in this run
+        self.hits = self.misses = 0
+        if self.path.exists():
+            table = pq.read_table(self.path).to_pydict()
+            for key, extractor, version, result, used in zip(*(table[c] for c in SCHEMA.names)):
+                self.entries[key, extractor, version] = [result, used]
+        self.started = time.time()
+
+    def extract(self, extractor, html, key=None, **options):
+        """Result of extractor for page, parsed only if it is not cached.
+
+        key is content hash of the page, it is computed if not given. Options (like partial)
+        are a part of the key, so results of different modes are never mixed.
+        """
+
+        self.versions[extractor.__name__] = extractor.version
+        variant = ''.join(f'|{k}={v!r}' for k, v in sorted(options.items()))
+        cache_key = ((key or content_hash(html)) + variant, extractor.__name__, extractor.version)
+        entry = self.entries.get(cache_key)
+        if entry is not None:
+            self.hits += 1
+            entry[1] = self.started
+            return json.loads(entry[0])
+        self.misses += 1
+        result = extractor(html, **options)
+        self.entries[cache_key] = [json.dumps(result), self.started]
+        return result
+
+    def save(self):
+        """Write cache without entries of old versions of used extractors and least recently used entries over size."""
+
+        entries = sorted(
+            ((k, e) for k, e in self.entries.items() if self.versions.get(k[1], k[2]) == k[2]),
+            key=lambda ke: ke[1][1], reverse=True)
+        kept, size = [], 0
+        for key, entry in entries:
+            entry_size = len(entry[0]) + len(key[0]) + len(key[1])
+            if size + entry_size > self.max_bytes:
+                break
+            kept.append((key, entry))
+            size += entry_size
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        pq.write_table(pa.Table.from_arrays([
+            pa.array([k[0] for k, e in kept], pa.string()),
+            pa.array([k[1] for k, e in kept], pa.string()),
+            pa.array([k[2] for k, e in kept], pa.int32()),
+            pa.array([e[0] for k, e in kept], pa.string()),
+            pa.array([e[1] for k, e in kept], pa.float64()),
+            ], schema=SCHEMA), tmp, compression='ZSTD')
+        shutil.move(str(tmp), str(self.path))
+        print(f'Parse cache {self.path.name}: {self.hits} hits, {self.misses} misses, '
+              f'{len(kept)} entries ({size / 2**20:.1f} MB), {len(self.entries) - len(kept)} dropped')
@@ -1,17 +1,5 @@
-import aiofiles
-from aiohttp import ClientSession
-import asyncio
-from collections import defaultdict
-import csv
-import io
-from pathlib import Path
-import pyarrow as pa
-import pyarrow.parquet as pq
-import sys
-import tarfile
-from tqdm import tqdm
-
 import config as cfg
+import engine
 
 PROJECT_ARCH = cfg.BUILDDIR / 'project01.tbz2'
 PROJECT_HTMLS = cfg.BUILDDIR / 'project01_html'
@@ -22,98 +10,28 @@ PROJECT_LIST_FILES = (
     cfg.DATADIR / 'project01' / 'forum_list.csv',
     )
 
+SITE = engine.Site('project01', 'https://forum.bits.media/index.php?/topic/{symbol}/', PROJECT_LIST_FILES, 'topic_id',
+    htmls=PROJECT_HTMLS, arch=PROJECT_ARCH, parquet=PROJECT_PARQUET, member_dir='topic')
+
 
 def read_symbols():
     """Read symbols from FORUM Lists dataset"""
+    return SITE.read_ids()
 
-    symbols = set()
-
-    for filename in PROJECT_LIST_FILES:
-        with open(filename) as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                symbols.add(row['topic_id'].upper().strip())
-
-    return list(sorted(symbols))
 
-
-def scrape_descriptions_async():
+def scrape_descriptions_async(protocol='http1'):
     """Scrape companies descriptions asynchronously."""
-
-    symbols = read_symbols()
-    progress = tqdm(total=len(symbols), file=sys.stdout, disable=False)
-    PROJECT_HTMLS.mkdir(parents=True, exist_ok=True)
-
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/75.0.3770.142 Safari/537.36',
-        }
-
-    async def fetch(symbol, session):
-        async with session.get(f'https://forum.bits.media/index.php?/topic/{symbol}/') as response:
-            text = await response.read()
-            async with aiofiles.open(PROJECT_HTMLS / f'{symbol}.html', 'wb') as f:
-                await f.write(text)
-            progress.update(1)
-
-
-    async def run(symbols):
-        async with ClientSession(headers=headers) as session:
-            tasks = (asyncio.ensure_future(fetch(symbol, session)) for symbol in symbols)
-            await asyncio.gather(*tasks)
-
-    loop = asyncio.get_event_loop()
-    loop.set_exception_handler(lambda x, y: None)  # suppress exceptions because of bug in Python 3.7.3 + aiohttp + asyncio
-    loop.run_until_complete(asyncio.ensure_future(run(symbols)))
-    progress.close()
+    engine.scrape(SITE, protocol=protocol)
 
 
 def compress_descriptions(encoding='utf-8', batch_size=1000, compression='BROTLI'):
     """Convert tarfile to parquet"""
-
-    names = ('symbol', 'html')
-
-    def read_incremental():
-        """Incremental generator of batches"""
-        with tarfile.open(PROJECT_ARCH) as archive:
-            batch = defaultdict(list)
-            for member in tqdm(archive):
-                if member.isfile() and member.name.endswith('.html'):
-                    batch['symbol'].append(Path(member.name).stem)
-                    batch['html'].append(archive.extractfile(member).read().decode(encoding))
-                    if len(batch['symbol']) >= batch_size:
-                        yield pa.Table.from_arrays([pa.array(batch[n]) for n in names], names)
-                        batch = defaultdict(list)
-            if batch:
-                yield pa.Table.from_arrays([pa.array(batch[n]) for n in names], names)  # last partial batch
-
-    writer = None
-    for batch in read_incremental():
-        if writer is None:
-            writer = pq.ParquetWriter(PROJECT_PARQUET, batch.schema, use_dictionary=False, compression=compression, flavor={'spark'})
-        writer.write_table(batch)
-    writer.close()
+    engine.compress(SITE, encoding=encoding, batch_size=batch_size, compression=compression)
 
 
 def decompress_descriptions(encoding='utf-8'):
     """Convert parquet to tarfile"""
-
-    pf = pq.ParquetFile(PROJECT_PARQUET)
-
-    progress = tqdm(file=sys.stdout, disable=False)
-
-    with tarfile.open(PROJECT_ARCH, 'w:bz2') as archive:
-        for i in range(pf.metadata.num_row_groups):
-            table = pf.read_row_group(i)
-            columns = table.to_pydict()
-            for symbol, html in zip(columns['symbol'], columns['html']):
-                bytes = html.encode(encoding)
-                s = io.BytesIO(bytes)
-                tarinfo = tarfile.TarInfo(name=f'topic/{symbol}.html')
-                tarinfo.size = len(bytes)
-                archive.addfile(tarinfo=tarinfo, fileobj=s)
-                progress.update(1)
-
-    progress.close()
+    engine.decompress(SITE, encoding=encoding)
 
 
 def main():
@@ -1,224 +1,210 @@
-import aiofiles
-from aiohttp import ClientSession
-import asyncio
-from collections import defaultdict
-from contextlib import closing
 import csv
-import io
-import lxml.html
-from pathlib import Path
-import pyarrow as pa
-import pyarrow.parquet as pq
-import re
+import datetime
+import json
+import shutil
 import sys
-import tarfile
-from tqdm import tqdm
 
 import config as cfg
+import engine
+import extractors
+import rollups
 
 
 PROJECT_ARCH = cfg.BUILDDIR / 'project_main_html.tbz2'
-PROJECT_DATA = cfg.BUILDDIR / 'project_main.csv'
+PROJECT_RAW_ARCH = cfg.BUILDDIR / 'project_main_raw.tar'
+PROJECT_DELTAS = cfg.BUILDDIR / 'project_main_deltas'
+PROJECT_FIELDS = ['symbol', 'page_number', 'comment_id', 'comment_date', 'comment_text', 'comment_author']
+PROJECT_DATA_PARQUET = cfg.BUILDDIR / 'project_main_data.parquet'
 PROJECT_HTMLS = cfg.BUILDDIR / 'project_main_html'
 PROJECT_PARQUET = cfg.BUILDDIR / 'project_main.parquet'
+PROJECT_SCRAPED = cfg.BUILDDIR / 'project_main_comments.parquet'
+
+# page sections read by parse_descriptions(), see htmlreduce.reduce_html()
+PROJECT_SECTIONS = (
+    '//article',
+    '//ul[contains(@class, "ipsPagination")]',  # active page, see extractors.forum_page_number()
+    )
 
 PROJECT_LIST_FILES = (
     cfg.DATADIR / 'project_main' / 'forum_list.csv',
     )
 
 
+SITE = engine.Site('project_main', 'https://forum.bits.media/index.php?/topic/{symbol}/', PROJECT_LIST_FILES, 'Symbol',
+    extractors=[extractors.forum_page_number, extractors.forum_comments], parse=extractors.forum_rows, columns=PROJECT_FIELDS,
+    sections=PROJECT_SECTIONS, htmls=PROJECT_HTMLS, arch=PROJECT_ARCH, raw_arch=PROJECT_RAW_ARCH, parquet=PROJECT_PARQUET,
+    member_dir='topic')
+
+
 def read_symbols():
-    """Read symbols from NASDAQ dataset"""
+    """Read topic ids of forum list"""
+    return SITE.read_ids()
 
-    symbols = set()
 
-    for filename in PROJECT_LIST_FILES:
-        with open(filename) as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                symbols.add(row['Symbol'].upper().strip())
+def scrape_descriptions_async(reduce=False, raw=False, protocol='http1'):
+    """Scrape forum topics asynchronously.
 
-    return list(sorted(symbols))
+    With reduce=True only page sections used by parse_descriptions() are stored.
+    With raw=True compressed response bodies are stored as received, see contentcoding.
+    protocol='http2' multiplexes requests over a few connections, see fetchers.py.
+    """
+    engine.scrape(SITE, reduce=reduce, raw=raw, protocol=protocol)
 
 
-def scrape_descriptions_async():
-    """Scrape companies descriptions asynchronously."""
+def archive_descriptions(raw=False):
+    """Pack scraped pages to tarfile"""
+    engine.archive(SITE, raw=raw)
 
-    symbols = read_symbols()
-    progress = tqdm(total=len(symbols), file=sys.stdout, disable=False)
-    PROJECT_HTMLS.mkdir(parents=True, exist_ok=True)
 
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/75.0.3770.142 Safari/537.36',
-        }
+def compress_descriptions(encoding='utf-8', batch_size=1000, compression='BROTLI', raw=False):
+    """Convert tarfile to parquet
 
-    async def fetch(symbol, session):
-        async with session.get(f'https://forum.bits.media/index.php?/topic/{symbol}/') as response:
-            text = await response.read()
-            async with aiofiles.open(PROJECT_HTMLS / f'{symbol}.html', 'wb') as f:
-                await f.write(text)
-            progress.update(1)
-
-    async def run(symbols):
-        async with ClientSession(headers=headers) as session:
-            tasks = (asyncio.ensure_future(fetch(symbol, session)) for symbol in symbols)
-            await asyncio.gather(*tasks)
-
-    loop = asyncio.get_event_loop()
-    loop.set_exception_handler(lambda x, y: None)  # suppress exceptions because of bug in Python 3.7.3 + aiohttp + asyncio
-    loop.run_until_complete(asyncio.ensure_future(run(symbols)))
-    progress.close()
-
-
-def compress_descriptions(encoding='utf-8', batch_size=1000, compression='BROTLI'):
-    """Convert tarfile to parquet"""
-
-    names = ('symbol', 'html')
-
-    def read_incremental():
-        """Incremental generator of batches"""
-        with tarfile.open(PROJECT_ARCH) as archive:
-            batch = defaultdict(list)
-            for member in tqdm(archive):
-                if member.isfile() and member.name.endswith('.html'):
-                    batch['symbol'].append(Path(member.name).stem)
-                    batch['html'].append(archive.extractfile(member).read().decode(encoding))
-                    if len(batch['symbol']) >= batch_size:
-                        yield pa.Table.from_arrays([pa.array(batch[n]) for n in names], names)
-                        batch = defaultdict(list)
-            if batch:
-                yield pa.Table.from_arrays([pa.array(batch[n]) for n in names], names)  # last partial batch
-
-    writer = None
-    for batch in read_incremental():
-        if writer is None:
-            writer = pq.ParquetWriter(PROJECT_PARQUET, batch.schema, use_dictionary=False, compression=compression, flavor={'spark'})
-        writer.write_table(batch)
-    writer.close()
+    With raw=True pages are read from the archive of raw pages and stored with their codec,
+    html column is not compressed again.
+    """
+    engine.compress(SITE, encoding=encoding, batch_size=batch_size, compression=compression, raw=raw)
 
 
 def decompress_descriptions(encoding='utf-8'):
     """Convert parquet to tarfile"""
+    engine.decompress(SITE, encoding=encoding)
+
+
+def scrape_data(dst=PROJECT_SCRAPED, compression='BROTLI', fetchers=100, parsers=None):
+    """Scrape forum topics directly to comments.
+
+    Pages are parsed by pool of processes while next pages are fetched, see scrapeparse.py.
+    """
+    return engine.scrape_parsed(SITE, dst, compression=compression, fetchers=fetchers, parsers=parsers)
+
+
+def watermarks_path(part):
+    """Watermarks published with delta partition (part-<time>.watermarks.json)."""
+    return part.with_suffix('.watermarks.json')
+
+
+def read_watermarks(dst):
+    """Read last parsed comment of every topic, as of the latest published delta partition."""
 
-    pf = pq.ParquetFile(PROJECT_PARQUET)
+    parts = sorted(dst.glob('part-*.csv'))
+    path = watermarks_path(parts[-1]) if parts else None
+    if path is None or not path.exists():
+        path = dst / 'watermarks.json'  # deltas written before watermarks were kept with partitions
+    return json.loads(path.read_text()) if path.exists() else {}
 
-    progress = tqdm(file=sys.stdout, disable=False)
 
-    with tarfile.open(PROJECT_ARCH, 'w:bz2') as archive:
-        for i in range(pf.metadata.num_row_groups):
-            table = pf.read_row_group(i)
-            columns = table.to_pydict()
-            for symbol, html in zip(columns['symbol'], columns['html']):
-                bytes = html.encode(encoding)
-                s = io.BytesIO(bytes)
-                tarinfo = tarfile.TarInfo(name=f'yahoo/{symbol}.html')
-                tarinfo.size = len(bytes)
-                archive.addfile(tarinfo=tarinfo, fileobj=s)
-                progress.update(1)
+def generation(dst=PROJECT_DELTAS):
+    """Id of deltas since the last full parse (name of the first delta partition), None if there are none.
 
-    progress.close()
+    full=True drops deltas and parses all comments again, so it changes and consumers adding
+    new partitions incrementally (catalog.py, topics.py) start over instead of adding duplicates.
+    """
+    parts = sorted(dst.glob('part-*.csv'))
+    return parts[0].name if parts else None
 
 
-def scrape_data(dst=PROJECT_PARQUET, compression='BROTLI'):
-    """Scrape custom data."""
-    #TODO Написать для моего проекта
+def write_watermarks(watermarks, path):
+    """Write last parsed comment of every topic."""
+    tmp = path.with_suffix('.tmp')
+    tmp.write_text(json.dumps(watermarks, indent=1, sort_keys=True))
+    tmp.replace(path)
 
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/75.0.3770.142 Safari/537.36',
+
+def is_new(comment, watermark):
+    """Check that comment is above topic watermark."""
+
+    if watermark is None:
+        return True
+    number = extractors.comment_number(comment['comment_id'])
+    if number is not None and watermark.get('comment_number') is not None:
+        return number > watermark['comment_number']
+    date, last = extractors.parse_datetime(comment['comment_date']), extractors.parse_datetime(watermark.get('comment_date'))
+    if date is not None and last is not None:
+        return date > last
+    # comments without number and date can't be ordered, so their ids are tracked in watermark
+    return comment['comment_id'] not in watermark.get('unordered_ids', ())
+
+
+def update_watermark(watermark, comment):
+    """Return watermark of topic after parsed comment."""
+
+    number = extractors.comment_number(comment['comment_id'])
+    unordered_ids = list(watermark.get('unordered_ids', ())) if watermark else []
+    if number is None and extractors.parse_datetime(comment['comment_date']) is None:
+        watermark = dict(watermark or {'comment_id': None, 'comment_number': None, 'comment_date': None})
+        watermark['unordered_ids'] = unordered_ids + [comment['comment_id']]
+        return watermark
+    if not is_new(comment, watermark):
+        return watermark
+    return {
+        'comment_id': comment['comment_id'],
+        'comment_number': number,
+        'comment_date': comment['comment_date'],
+        'unordered_ids': unordered_ids,
         }
 
-    symbols = read_symbols()
-    columns = ('symbol', 'sector', 'industry', 'employees', 'description')
-    schema = pa.schema([(col, pa.string()) for col in columns])
-
-    def parse(text):
-        tree = lxml.html.fromstring(text)
-        row = {}
-        row['description'] = '\n'.join(tree.xpath('//section[h2//*[text()="Description"]]/p/text()'))
-        info = (tree.xpath('//div[@class="asset-profile-container"]//p[span[text()="Sector"]]') or [None])[0]
-        if info is not None:
-            row['sector'] = (info.xpath('./span[text()="Sector"]/following-sibling::span[1]/text()') or [''])[0]
-            row['industry'] = (info.xpath('./span[text()="Industry"]/following-sibling::span[1]/text()') or [''])[0]
-            row['employees'] = (info.xpath('./span[text()="Full Time Employees"]/following-sibling::span[1]/span/text()') or [''])[0].replace(',', '')
-        return row
-
-    async def fetch(symbol, session, progress):
-        async with session.get(f'https://forum.bits.media/index.php?/topic/{symbol}/') as response:
-            text = await response.read()
-            row = {'symbol': symbol}
-            row.update(parse(text))
-            progress.update()
-            return row
-
-    async def run(symbols, writer, progress, batch_size=1000):
-        async with aiohttp.ClientSession(headers=headers) as session:
-            start, stop = 0, batch_size
-            while start < len(symbols):
-                tasks = (asyncio.ensure_future(fetch(symbol, session, progress)) for symbol in symbols[start:stop])
-                rows = await asyncio.gather(*tasks)
-                table = pa.Table.from_arrays([pa.array(row.get(col, '') for row in rows) for col in columns], schema=schema)
-                writer.write_table(table)
-                start, stop = stop, stop + batch_size
-
-    with tqdm(total=len(symbols)) as progress:
-        loop = asyncio.get_event_loop()
-        loop.set_exception_handler(lambda x, y: None)  # suppress exceptions because of bug in Python 3.7.3 + aiohttp + asyncio
-        with closing(pq.ParquetWriter(dst, schema, use_dictionary=False, compression=compression, flavor={'spark'})) as writer:
-            loop.run_until_complete(asyncio.ensure_future(run(symbols, writer, progress)))
-
-
-def parse_descriptions(src=PROJECT_PARQUET, dst=PROJECT_DATA):
-    """Parse scraped pages."""
-
-    reader = pq.ParquetFile(src)
-
-    with tqdm(total=reader.metadata.num_rows) as progress:
-
-        with open(dst, "w") as f:
-            writer = csv.DictWriter(f, fieldnames=['symbol', 'page_number', 'comment_id', 'comment_date', 'comment_text'])
-            writer.writeheader()
-            for g in range(reader.metadata.num_row_groups):
-                table = reader.read_row_group(g).to_pydict()
-                for symbol, html in zip(table['symbol'],table['html']):
-
-                    tree = lxml.html.fromstring(html)
-                    row = {'symbol':symbol.strip()}
-                    row['page_number'] = 1      #todo add page_number functional
-
-                    infos = (tree.xpath('//article') or [None])
-
-                    for info in infos:
-                        if info is not None:
-                            row['comment_id'] = (info.xpath('./@id') or [''])[0]
-                            row['comment_date'] = (info.xpath('.//time/@datetime') or [''])[0]
-                            row['comment_text'] = text((info.xpath('.//div[@data-role="commentContent"]') or [''])[0])
-                            writer.writerow(row)
-
-
-                    #row['text'] = '\n'.join(tree.xpath('//section[h2//*[text()="Description"]]/p/text()'))
-                    #info = (tree.xpath('//div[@class="asset-profile-container"]//p[span[text()="Sector"]]') or [None])[0]
-                    #if info is not None:
-                    #   row['sector'] = (info.xpath('./span[text()="Sector"]/following-sibling::span[1]/text()') or [''])[0]
-                    #    row['industry'] = (info.xpath('./span[text()="Industry"]/following-sibling::span[1]/text()') or [''])[0]
-                    #    row['employees'] = (info.xpath('./span[text()="Full Time Employees"]/following-sibling::span[1]/span/text()') or [''])[0].replace(',', '')
-
-                    progress.update()
-
-def text(node, separator=' '):
-    """Convert node to text"""
-    if node is None:
-        return ''
-    elif isinstance(node, str):
-        return node.strip()
-    elif isinstance(node, list):
-        return separator.join(text(t) for t in node)
+
+def parse_descriptions(src=PROJECT_PARQUET, dst=PROJECT_DELTAS, rollup=True, full=False, partial=False, cache=True):
+    """Parse new comments of scraped pages.
+
+    Forum topics are append-only, so only comments above the last parsed comment
+    of the topic are written to new delta partition dst/part-<time>.csv. Watermarks
+    are written next to the partition before it is published, so they always match
+    the latest published partition. With full=True deltas and watermarks are dropped and
+    all comments are parsed again.
+    With rollup=True activity rollups are updated with new comments, see rollups.py.
+    With partial=True pages are parsed incrementally until comments end, see extractors.iter_sections().
+    With cache=True only pages, which are not parsed by current extractor versions yet, are parsed,
+    see parsecache.py, so full=True after changing one extractor parses only its fields again.
+    """
+
+    if full:
+        shutil.rmtree(dst, ignore_errors=True)
+
+    watermarks = read_watermarks(dst)
+    activity = rollups.Rollups() if rollup else None
+    dst.mkdir(parents=True, exist_ok=True)
+    part = dst / f'part-{datetime.datetime.utcnow():%Y%m%dT%H%M%S%f}.csv'
+    tmp = part.with_suffix('.tmp')
+    parsed = 0
+
+    with open(tmp, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=PROJECT_FIELDS)
+        writer.writeheader()
+        for symbol, results in engine.extract_pages(SITE, src, partial=partial, cache=cache):
+            row = {'symbol': symbol, 'page_number': results['forum_page_number']}
+
+            watermark = watermarks.get(row['symbol'])
+            for comment in results['forum_comments']:
+                if not is_new(comment, watermark):
+                    continue
+                row.update(comment)
+                writer.writerow(row)
+                parsed += 1
+                if activity is not None:
+                    activity.add(row)
+                watermarks[row['symbol']] = update_watermark(watermarks.get(row['symbol']), comment)
+
+    # watermarks of unpublished delta (interrupted run) are ignored, so its comments are parsed again
+    if parsed:
+        write_watermarks(watermarks, watermarks_path(part))
+        tmp.replace(part)
     else:
-        return re.sub('\s+', ' ',
-            separator.join(
-                [text(getattr(node, 'text', ''))]
-                + [text(c) for c in node.getchildren()]
-                + [text(getattr(node, 'tail', ''))]
-                )).strip()
+        tmp.unlink()
+    print(f'Parsed {parsed} new comments')
+
+    if activity is not None:
+        activity.save()
+
+
+def read_comments(src=PROJECT_DELTAS):
+    """Read parsed comments from all delta partitions in order of parsing."""
+
+    csv.field_size_limit(sys.maxsize)
+    for part in (sorted(src.glob('part-*.csv')) if src.is_dir() else [src]):
+        with open(part, encoding='utf-8') as f:
+            yield from csv.DictReader(f)
+
 
 def main():
     #parse_descriptions()
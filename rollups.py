@@ -0,0 +1,292 @@
+"""
+Activity rollups of forum topics
+================================
+
+Materialized rollups are kept in build/rollups as small Parquet files, partitioned
+by day or, for per topic tables, by bucket of topics (see topic_bucket()):
+
+* topic_hour/<day>.parquet – symbol, hour, comments
+* topic_day/<day>.parquet – symbol, comments
+* topic_summary/<bucket>.parquet – symbol, first_activity, last_activity, comments, authors, last_comment
+* topic_authors/<bucket>.parquet – symbol, comment_author (distinct pairs behind `authors` count)
+* topic_day_sketches/<day>.parquet – symbol, authors (HyperLogLog), terms (Space-Saving top terms)
+* day_terms/<day>.parquet – terms (Count-Min sketch of term counts)
+
+Saving rewrites only partitions of days and topics with new comments. New files are
+written aside and replaced together through commit journal (commit.json), which is
+completed on the next start if saving was interrupted, so tables stay consistent
+with watermarks in topic_summary.
+
+Sketches are merged over any topics and days, see distinct_authors(), top_terms()
+and term_count(): distinct authors are estimated with relative standard error
+sketches.HyperLogLog.error, top terms are exact for terms with counts above
+the floor of merged summary, term counts overestimate by at most
+COUNT_MIN_EPS * number of terms (with probability 1 - COUNT_MIN_DELTA).
+
+Rollups are updated from newly parsed rows only. Comments with number at or below
+`last_comment` of their topic are already counted and skipped, so repeated parsing
+of the same pages does not inflate counts.
+
+Rollups are updated by project_main.parse_descriptions(), or rebuilt with
+
+    > invoke run "rollups:rebuild()"
+
+Sketches are queried with
+
+    > invoke run "rollups:distinct_authors(since='2019-10-01', until='2019-10-31')"
+    > invoke run "rollups:top_terms(20, symbols=['AAPL'])"
+"""
+
+from collections import defaultdict
+import datetime
+import json
+import os
+import shutil
+import zlib
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import config as cfg
+import extractors
+import sketches
+import tokens
+
+
+ROLLUPS_DIR = cfg.BUILDDIR / 'rollups'
+
+HLL_PRECISION = 12
+TOP_TERMS = 200  # Space-Saving capacity per topic and day
+COUNT_MIN_EPS = 1e-3
+COUNT_MIN_DELTA = 1e-2
+TOPIC_BUCKETS = 64
+
+
+def topic_bucket(symbol):
+    """Partition of per topic tables."""
+    return f'{zlib.crc32(symbol.encode()) % TOPIC_BUCKETS:02d}'
+
+
+class Rollups:
+    """Incremental updater of topic activity rollups."""
+
+    def __init__(self, path=ROLLUPS_DIR):
+        self.path = path
+        self._recover()
+        summary = read_table('topic_summary', path)
+        self.watermarks = dict(zip(summary['symbol'], summary['last_comment'])) if summary is not None else {}
+        self.hours = defaultdict(int)
+        self.days = defaultdict(int)
+        self.topics = {}  # symbol -> [first, last, comments, last_comment]
+        self.authors = set()
+        self.sketches = {}  # (symbol, day) -> [HyperLogLog of authors, SpaceSaving of terms]
+        self.day_terms = {}  # day -> CountMinSketch of terms
+
+    def _read(self, name, part):
+        path = self.path / name / f'{part}.parquet'
+        return pq.read_table(path).to_pandas() if path.exists() else None
+
+    def add(self, row):
+        """Count parsed comment, unless it is counted already."""
+
+        symbol, number = row['symbol'], extractors.comment_number(row.get('comment_id'))
+        if number is None or number <= self.watermarks.get(symbol, -1):
+            return
+
+        date = extractors.parse_datetime(row.get('comment_date'))
+        if date is not None:
+            date = date.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+            self.hours[symbol, date.replace(minute=0, second=0, microsecond=0)] += 1
+            self.days[symbol, date.date()] += 1
+
+        topic = self.topics.setdefault(symbol, [date, date, 0, number])
+        if date is not None:
+            topic[0] = min(topic[0] or date, date)
+            topic[1] = max(topic[1] or date, date)
+        topic[2] += 1
+        topic[3] = max(topic[3], number)
+
+        if row.get('comment_author'):
+            self.authors.add((symbol, row['comment_author']))
+
+        if date is not None:
+            day = date.date()
+            authors, terms = self.sketches.setdefault((symbol, day),
+                [sketches.HyperLogLog(HLL_PRECISION), sketches.SpaceSaving(TOP_TERMS)])
+            if row.get('comment_author'):
+                authors.add(row['comment_author'])
+            counts = self.day_terms.get(day)
+            if counts is None:
+                counts = self.day_terms[day] = sketches.CountMinSketch.from_error(COUNT_MIN_EPS, COUNT_MIN_DELTA)
+            for term in tokens.words(row.get('comment_text')):
+                terms.add(term)
+                counts.add(term)
+
+    def save(self):
+        """Merge counted comments into rollups, only touched partitions are rewritten."""
+
+        if not self.topics:
+            return
+        staged = []
+
+        def stage(table, name, part):
+            path = self.path / name / f'{part}.parquet'
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(path.name + '.tmp')
+            if isinstance(table, pd.DataFrame):
+                table = pa.Table.from_pandas(table, preserve_index=False)
+            pq.write_table(table, tmp, compression='ZSTD')
+            staged.append((tmp, path))
+
+        def merge(name, part, delta, keys, aggregate):
+            current = self._read(name, part)
+            if current is not None:
+                delta = pd.concat([current, delta], ignore_index=True)
+            merged = delta.groupby(keys, as_index=False).agg(aggregate) if aggregate else delta.drop_duplicates(keys)
+            return merged.sort_values(keys).reset_index(drop=True)
+
+        hours, days = defaultdict(list), defaultdict(list)
+        for (symbol, hour), comments in self.hours.items():
+            hours[hour.date()].append((symbol, hour, comments))
+        for (symbol, day), comments in self.days.items():
+            days[day].append((symbol, comments))
+        for day, rows in hours.items():
+            stage(merge('topic_hour', day.isoformat(), pd.DataFrame(rows, columns=['symbol', 'hour', 'comments']),
+                ['symbol', 'hour'], {'comments': 'sum'}), 'topic_hour', day.isoformat())
+        for day, rows in days.items():
+            stage(merge('topic_day', day.isoformat(), pd.DataFrame(rows, columns=['symbol', 'comments']),
+                ['symbol'], {'comments': 'sum'}), 'topic_day', day.isoformat())
+
+        topics, authors = defaultdict(list), defaultdict(list)
+        for symbol, topic in self.topics.items():
+            topics[topic_bucket(symbol)].append((symbol, *topic, 0))
+        for symbol, author in self.authors:
+            authors[topic_bucket(symbol)].append((symbol, author))
+        for bucket, rows in topics.items():
+            bucket_authors = merge('topic_authors', bucket,
+                pd.DataFrame(sorted(authors[bucket]), columns=['symbol', 'comment_author']),
+                ['symbol', 'comment_author'], None)
+            stage(bucket_authors, 'topic_authors', bucket)
+            summary = merge('topic_summary', bucket,
+                pd.DataFrame(rows, columns=['symbol', 'first_activity', 'last_activity', 'comments', 'last_comment', 'authors']),
+                ['symbol'], {'first_activity': 'min', 'last_activity': 'max', 'comments': 'sum', 'last_comment': 'max', 'authors': 'max'})
+            summary['authors'] = summary['symbol'].map(bucket_authors.groupby('symbol').size()).fillna(0).astype('int64')
+            stage(summary, 'topic_summary', bucket)
+
+        self._save_sketches(stage)
+        self._commit(staged)
+
+        self.watermarks.update({s: t[3] for s, t in self.topics.items()})
+        self.hours, self.days, self.topics, self.authors = defaultdict(int), defaultdict(int), {}, set()
+        self.sketches, self.day_terms = {}, {}
+
+    def _commit(self, staged):
+        """Replace staged files together: journal of replacements is written first, so they are completed after crash."""
+        journal = self.path / 'commit.json'
+        tmp = journal.with_name(journal.name + '.tmp')
+        tmp.write_text(json.dumps([[str(t.relative_to(self.path)), str(p.relative_to(self.path))] for t, p in staged]))
+        os.replace(tmp, journal)
+        self._recover()
+
+    def _recover(self):
+        """Complete replacements of interrupted commit."""
+        journal = self.path / 'commit.json'
+        if not journal.exists():
+            return
+        for tmp, path in json.loads(journal.read_text()):
+            if (self.path / tmp).exists():
+                os.replace(self.path / tmp, self.path / path)
+        journal.unlink()
+
+    def _save_sketches(self, stage):
+        """Merge new sketches into saved ones, only files of days with new comments are rewritten."""
+
+        touched = defaultdict(dict)
+        for (symbol, day), sketch in self.sketches.items():
+            touched[day][symbol] = sketch
+        for day, new in touched.items():
+            path = self.path / 'topic_day_sketches' / f'{day.isoformat()}.parquet'
+            rows = {row['symbol']: row for row in pq.read_table(path).to_pylist()} if path.exists() else {}
+            for symbol, (authors, terms) in new.items():
+                row = rows.get(symbol)
+                if row is not None:  # only touched topics are deserialized, others are copied as they are
+                    authors.merge(sketches.HyperLogLog.from_bytes(row['authors']))
+                    terms.merge(sketches.SpaceSaving.from_dict(json.loads(row['terms'])))
+                rows[symbol] = {'symbol': symbol, 'authors': authors.to_bytes(), 'terms': json.dumps(terms.to_dict())}
+            symbols = sorted(rows)
+            stage(pa.table({
+                'symbol': pa.array(symbols, pa.string()),
+                'authors': pa.array([rows[s]['authors'] for s in symbols], pa.binary()),
+                'terms': pa.array([rows[s]['terms'] for s in symbols], pa.string()),
+                }), 'topic_day_sketches', day.isoformat())
+
+        for day, counts in self.day_terms.items():
+            path = self.path / 'day_terms' / f'{day.isoformat()}.parquet'
+            if path.exists():
+                counts = sketches.CountMinSketch.from_bytes(pq.read_table(path)['terms'][0].as_py()).merge(counts)
+            stage(pa.table({'terms': pa.array([counts.to_bytes()], pa.binary())}), 'day_terms', day.isoformat())
+
+
+def read_table(name, path=ROLLUPS_DIR):
+    """Read all partitions of rollup table as DataFrame, None if there is none."""
+    parts = sorted((path / name).glob('*.parquet'))
+    return pd.concat([pq.read_table(p).to_pandas() for p in parts], ignore_index=True) if parts else None
+
+
+def day_files(path, since=None, until=None):
+    """Days and files of per day partitions in day range (inclusive)."""
+    since = since and datetime.date.fromisoformat(str(since))
+    until = until and datetime.date.fromisoformat(str(until))
+    for f in sorted(path.glob('*.parquet')) if path.exists() else []:
+        day = datetime.date.fromisoformat(f.stem)
+        if (since is None or day >= since) and (until is None or day <= until):
+            yield day, f
+
+
+def read_sketches(path=ROLLUPS_DIR, since=None, until=None, symbols=None):
+    """Read topic and day sketches as dicts."""
+    rows = []
+    for day, f in day_files(path / 'topic_day_sketches', since, until):
+        table = pq.read_table(f, filters=[('symbol', 'in', list(symbols))] if symbols is not None else None)
+        rows.extend(dict(row, day=day) for row in table.to_pylist())
+    return rows
+
+
+def read_day_terms(path=ROLLUPS_DIR, since=None, until=None):
+    """Read per day term count sketches as dicts."""
+    return [{'day': day, 'terms': pq.read_table(f)['terms'][0].as_py()} for day, f in day_files(path / 'day_terms', since, until)]
+
+
+def distinct_authors(symbols=None, since=None, until=None, path=ROLLUPS_DIR):
+    """Estimated number of distinct comment authors of topics in day range, and its relative error."""
+    merged = sketches.HyperLogLog(HLL_PRECISION)
+    for row in read_sketches(path, since, until, symbols):
+        merged.merge(sketches.HyperLogLog.from_bytes(row['authors']))
+    return merged.count(), merged.error
+
+
+def top_terms(k=100, symbols=None, since=None, until=None, path=ROLLUPS_DIR):
+    """Most frequent comment terms of topics in day range as (term, count) pairs."""
+    merged = sketches.SpaceSaving(max(k, TOP_TERMS))
+    for row in read_sketches(path, since, until, symbols):
+        merged.merge(sketches.SpaceSaving.from_dict(json.loads(row['terms'])))
+    return merged.top(k)
+
+
+def term_count(term, since=None, until=None, path=ROLLUPS_DIR):
+    """Estimated number of occurrences of term in comments of day range (all topics)."""
+    return sum(sketches.CountMinSketch.from_bytes(row['terms']).estimate(term) for row in read_day_terms(path, since, until))
+
+
+def rebuild(src=None, dst=ROLLUPS_DIR):
+    """Rebuild rollups from parsed comments."""
+
+    import project_main
+
+    if dst.exists():
+        shutil.rmtree(dst)
+    rollups = Rollups(dst)
+    for row in project_main.read_comments(src or project_main.PROJECT_DELTAS):
+        rollups.add(row)
+    rollups.save()
@@ -0,0 +1,166 @@
+"""
+Fused scraping and parsing
+==========================
+
+Pages are fetched by coroutines and parsed by pool of processes, so CPU-heavy
+lxml parsing does not block the event loop. Stages are connected by bounded
+queue: fetchers wait when parsers are behind, so memory stays bounded.
+
+    symbols -> fetchers (event loop) -> pages queue -> parsers (processes) -> Parquet
+
+scrape_parsed() prints stage report: event loop lag (how late timers fire, high
+lag means blocked loop), utilization of fetchers and parse processes, and mean
+queue fill. parsers=0 parses pages in the event loop, for comparison.
+protocol selects fetch backend (HTTP/1.1 or multiplexed HTTP/2), see fetchers.py.
+"""
+
+import asyncio
+import concurrent.futures
+from contextlib import closing
+import os
+import statistics
+import sys
+import time
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from tqdm import tqdm
+
+from fetchers import fetcher
+
+
+def timed_call(function, *args):
+    """Call function, return result and time spent (in parser process)."""
+    started = time.perf_counter()
+    return function(*args), time.perf_counter() - started
+
+
+async def run_stages(symbols, backend, parse, columns, writer, fetchers, parsers, pool, queue_size, batch_size, progress):
+    """Run fetch and parse stages, return stage statistics."""
+
+    loop = asyncio.get_event_loop()
+    schema = pa.schema([(col, pa.string()) for col in columns])
+    todo = asyncio.Queue()
+    for symbol in symbols:
+        todo.put_nowait(symbol)
+    pages = asyncio.Queue(maxsize=queue_size)
+    write_lock = asyncio.Lock()
+    rows = []
+    stats = {'pages': 0, 'errors': 0, 'fetch_busy': 0.0, 'parse_busy': 0.0, 'lags': [], 'fill': []}
+
+    async def flush():
+        nonlocal rows
+        batch, rows = rows, []
+        if batch:
+            table = pa.Table.from_arrays([pa.array(row.get(col, '') for row in batch) for col in columns], schema=schema)
+            async with write_lock:
+                await loop.run_in_executor(None, writer.write_table, table)
+
+    async def fetch(get):
+        while not todo.empty():
+            symbol = todo.get_nowait()
+            started = loop.time()
+            try:
+                text = (await get(symbol)).body
+            except backend.errors as e:
+                stats['errors'] += 1
+                progress.update()
+                tqdm.write(f'Error occured during web request {symbol}: {e!r}')
+                continue
+            finally:
+                stats['fetch_busy'] += loop.time() - started
+            await pages.put((symbol, text))  # waits while parsers are behind
+
+    async def parse_pages():
+        while True:
+            item = await pages.get()
+            if item is None:
+                return
+            symbol, text = item
+            try:
+                if pool is None:
+                    row, busy = timed_call(parse, text)
+                else:
+                    row, busy = await loop.run_in_executor(pool, timed_call, parse, text)
+            except Exception as e:
+                row, busy = {}, 0.0
+                stats['errors'] += 1
+                tqdm.write(f'Error occured during parsing {symbol}: {e!r}')
+            stats['parse_busy'] += busy
+            stats['pages'] += 1
+            for row in (row if isinstance(row, list) else [row]):
+                row['symbol'] = symbol
+                rows.append(row)
+            progress.update()
+            if len(rows) >= batch_size:
+                await flush()
+
+    async def monitor(interval=0.05):
+        while True:
+            started = loop.time()
+            await asyncio.sleep(interval)
+            stats['lags'].append(max(0.0, loop.time() - started - interval))
+            stats['fill'].append(pages.qsize() / queue_size)
+
+    started = loop.time()
+    monitoring = asyncio.ensure_future(monitor())
+    # two parse coroutines per process keep every process busy while results are handled
+    parsing = [asyncio.ensure_future(parse_pages()) for _ in range(max(parsers, 1) * 2)]
+    async with backend as get:
+        await asyncio.gather(*(fetch(get) for _ in range(fetchers)))
+    for _ in parsing:
+        await pages.put(None)
+    await asyncio.gather(*parsing)
+    await flush()
+    monitoring.cancel()
+    stats['elapsed'] = loop.time() - started
+    return stats
+
+
+def report(stats, fetchers, parsers):
+    """Summary of stage statistics."""
+
+    lags = sorted(stats['lags']) or [0.0]
+    return {
+        'pages': stats['pages'],
+        'errors': stats['errors'],
+        'seconds': stats['elapsed'],
+        'pages_per_second': stats['pages'] / stats['elapsed'] if stats['elapsed'] else 0.0,
+        'loop_lag_mean_ms': statistics.mean(lags) * 1000,
+        'loop_lag_p99_ms': lags[int(0.99 * (len(lags) - 1))] * 1000,
+        'loop_lag_max_ms': lags[-1] * 1000,
+        'fetch_utilization': stats['fetch_busy'] / (fetchers * stats['elapsed']) if stats['elapsed'] else 0.0,
+        'parse_utilization': stats['parse_busy'] / (max(parsers, 1) * stats['elapsed']) if stats['elapsed'] else 0.0,
+        'queue_fill': statistics.mean(stats['fill']) if stats['fill'] else 0.0,
+        }
+
+
+def scrape_parsed(symbols, url, parse, columns, dst, headers=None, compression='BROTLI',
+        fetchers=100, parsers=None, queue_size=None, batch_size=1000, protocol='http1', cafile=None):
+    """Scrape pages and parse them to Parquet file, print and return stage report.
+
+    url is template with {symbol}, parse is module level function (it is sent to
+    parser processes) converting page to dict of columns, or to list of them
+    for pages with many rows.
+    """
+
+    parsers = os.cpu_count() if parsers is None else parsers
+    queue_size = queue_size or max(parsers, 1) * 4
+    schema = pa.schema([(col, pa.string()) for col in columns])
+
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=parsers) if parsers else None
+    try:
+        with tqdm(total=len(symbols), file=sys.stdout) as progress:
+            loop = asyncio.get_event_loop()
+            loop.set_exception_handler(lambda x, y: None)  # suppress exceptions because of bug in Python 3.7.3 + aiohttp + asyncio
+            with closing(pq.ParquetWriter(dst, schema, use_dictionary=False, compression=compression, flavor={'spark'})) as writer:
+                backend = fetcher(protocol, url, headers=headers, cafile=cafile)
+                stats = loop.run_until_complete(asyncio.ensure_future(run_stages(
+                    symbols, backend, parse, columns, writer, fetchers, parsers, pool, queue_size, batch_size, progress)))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    summary = report(stats, fetchers, parsers)
+    print(', '.join(f'{k}={v:.3f}' if isinstance(v, float) else f'{k}={v}' for k, v in summary.items()))
+    return summary
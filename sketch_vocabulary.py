@@ -0,0 +1,82 @@
+"""
+Vocabulary estimator backed by mergeable sketches.
+
+SketchCountVectorizer replaces CountVectorizer in Spark ML pipelines. Instead of
+an exact global term-count shuffle, every partition builds Space-Saving summary
+of term counts and Count-Min sketch of document frequencies in a single pass,
+sketches are merged with treeReduce and the vocabulary (top vocabSize terms
+with document frequency at least minDF) is picked on the driver.
+Memory is bounded by capacity, width and depth regardless of corpus size.
+
+Module sketches.py must be available on executors (spark-submit --py-files sketches.py).
+"""
+
+from pyspark import keyword_only
+from pyspark.ml import Estimator
+from pyspark.ml.feature import CountVectorizerModel
+from pyspark.ml.param import Param, Params, TypeConverters
+from pyspark.ml.param.shared import HasInputCol, HasOutputCol
+
+from sketches import CountMinSketch, SpaceSaving
+
+
+class SketchCountVectorizer(Estimator, HasInputCol, HasOutputCol):
+    """Approximate CountVectorizer, fitted in one pass over data."""
+
+    vocabSize = Param(Params._dummy(), 'vocabSize', 'max size of the vocabulary',
+        typeConverter=TypeConverters.toInt)
+    minDF = Param(Params._dummy(), 'minDF', 'min number (>= 1) or fraction (< 1) of documents a term must appear in',
+        typeConverter=TypeConverters.toFloat)
+    capacity = Param(Params._dummy(), 'capacity', 'number of heavy hitter candidates, defaults to 4 * vocabSize',
+        typeConverter=TypeConverters.toInt)
+    width = Param(Params._dummy(), 'width', 'width of Count-Min sketch of document frequencies',
+        typeConverter=TypeConverters.toInt)
+    depth = Param(Params._dummy(), 'depth', 'depth of Count-Min sketch of document frequencies',
+        typeConverter=TypeConverters.toInt)
+
+    @keyword_only
+    def __init__(self, inputCol=None, outputCol=None, vocabSize=1 << 18, minDF=1.0, capacity=None,
+            width=1 << 16, depth=4):
+        super().__init__()
+        self._setDefault(vocabSize=1 << 18, minDF=1.0, width=1 << 16, depth=4)
+        self.setParams(**self._input_kwargs)
+
+    @keyword_only
+    def setParams(self, inputCol=None, outputCol=None, vocabSize=1 << 18, minDF=1.0, capacity=None,
+            width=1 << 16, depth=4):
+        """Set params of the estimator."""
+        kwargs = {k: v for k, v in self._input_kwargs.items() if v is not None}
+        return self._set(**kwargs)
+
+    def _fit(self, dataset):
+        vocab_size = self.getOrDefault('vocabSize')
+        min_df = self.getOrDefault('minDF')
+        capacity = self.getOrDefault('capacity') if self.isDefined('capacity') else 4 * vocab_size
+        width, depth = self.getOrDefault('width'), self.getOrDefault('depth')
+
+        def sketch_partition(rows):
+            docs, tf, df = 0, SpaceSaving(capacity), CountMinSketch(width, depth)
+            for row in rows:
+                words = row[0] or []
+                docs += 1
+                for word in words:
+                    tf.add(word)
+                for word in set(words):
+                    df.add(word)
+            yield docs, tf, df
+
+        def merge(a, b):
+            return a[0] + b[0], a[1].merge(b[1]), a[2].merge(b[2])
+
+        docs, tf, df = (dataset
+            .select(self.getInputCol())
+            .rdd
+            .mapPartitions(sketch_partition)
+            .treeReduce(merge)
+            )
+
+        threshold = min_df if min_df >= 1.0 else min_df * docs
+        vocabulary = [term for term, count in tf.top() if df.estimate(term) >= threshold][:vocab_size]
+
+        return CountVectorizerModel.from_vocabulary(
+            vocabulary, inputCol=self.getInputCol(), outputCol=self.getOutputCol())
@@ -0,0 +1,207 @@
+"""
+Mergeable sketches for approximate counting with bounded memory.
+
+Sketches are built independently (per partition, per file, per day) and merged
+afterwards, hashes are deterministic, so sketches built in different processes
+are compatible.
+"""
+
+import array
+import hashlib
+import math
+
+
+def hash64(item, salt=b''):
+    """Deterministic 64-bit hash of string or bytes."""
+    if isinstance(item, str):
+        item = item.encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(item, digest_size=8, salt=salt).digest(), 'little')
+
+
+class CountMinSketch:
+    """Count-Min sketch, estimates never underestimate true counts.
+
+    With width = e/eps and depth = ln(1/delta) error is at most eps * total
+    with probability 1 - delta.
+    """
+
+    def __init__(self, width=1 << 16, depth=4):
+        self.width = width
+        self.depth = depth
+        self.total = 0
+        self.table = array.array('q', bytes(8 * width * depth))
+
+    @classmethod
+    def from_error(cls, eps=1e-4, delta=1e-3):
+        """Sketch with given relative error and failure probability."""
+        return cls(width=int(math.ceil(math.e / eps)), depth=int(math.ceil(math.log(1 / delta))))
+
+    def _cells(self, item):
+        h = hash64(item)
+        h1, h2 = h & 0xffffffff, h >> 32
+        return [row * self.width + (h1 + row * h2) % self.width for row in range(self.depth)]
+
+    def add(self, item, count=1):
+        """Add item occurrences."""
+        for cell in self._cells(item):
+            self.table[cell] += count
+        self.total += count
+
+    def estimate(self, item):
+        """Estimated count of item."""
+        return min(self.table[cell] for cell in self._cells(item))
+
+    def merge(self, other):
+        """Add counts of other sketch of the same shape."""
+        if (self.width, self.depth) != (other.width, other.depth):
+            raise ValueError('Sketches of different shape can not be merged')
+        for i, value in enumerate(other.table):
+            self.table[i] += value
+        self.total += other.total
+        return self
+
+    def to_bytes(self):
+        """Serialize sketch."""
+        header = array.array('q', [self.width, self.depth, self.total])
+        return header.tobytes() + self.table.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Deserialize sketch."""
+        width, depth, total = array.array('q', data[:24])
+        sketch = cls(width, depth)
+        sketch.total = total
+        sketch.table = array.array('q')
+        sketch.table.frombytes(data[24:])
+        return sketch
+
+
+class SpaceSaving:
+    """Space-Saving heavy hitters summary.
+
+    Keeps at most `capacity` counters (up to twice as many between prunings).
+    Counts of tracked items are overestimated by at most `error` of the item,
+    any item with true count above `floor` is tracked.
+    """
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.floor = 0
+        self.counters = {}  # item -> [count, error]
+
+    def add(self, item, count=1):
+        """Add item occurrences."""
+        counter = self.counters.get(item)
+        if counter is not None:
+            counter[0] += count
+        else:
+            # new item may have been evicted before, so it gets the eviction floor
+            self.counters[item] = [self.floor + count, self.floor]
+            if len(self.counters) > 2 * self.capacity:
+                self._prune()
+
+    def _prune(self):
+        if len(self.counters) <= self.capacity:
+            return
+        ranked = sorted(self.counters.items(), key=lambda kv: kv[1][0], reverse=True)
+        self.floor = max(self.floor, ranked[self.capacity][1][0])
+        self.counters = dict(ranked[:self.capacity])
+
+    def merge(self, other):
+        """Merge summary of other data."""
+        for item, (count, error) in other.counters.items():
+            counter = self.counters.get(item)
+            if counter is not None:
+                counter[0] += count
+                counter[1] += error
+            else:
+                self.counters[item] = [count + self.floor, error + self.floor]
+        for item, counter in self.counters.items():
+            if item not in other.counters:
+                counter[0] += other.floor
+                counter[1] += other.floor
+        self.floor += other.floor
+        self._prune()
+        return self
+
+    def top(self, k=None):
+        """Most frequent items as (item, count) pairs."""
+        ranked = sorted(self.counters.items(), key=lambda kv: (-kv[1][0], kv[0]))
+        return [(item, count) for item, (count, error) in ranked[:k]]
+
+    def to_dict(self):
+        """Serializable representation of summary."""
+        return {'capacity': self.capacity, 'floor': self.floor, 'counters': self.counters}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Summary from serializable representation."""
+        summary = cls(data['capacity'])
+        summary.floor = data['floor']
+        summary.counters = {item: list(counter) for item, counter in data['counters'].items()}
+        return summary
+
+
+class HyperLogLog:
+    """HyperLogLog distinct counter.
+
+    Relative standard error is 1.04 / sqrt(2 ** precision), e.g. 1.6% with
+    precision 12 (4 KB of registers). Small sketches are serialized sparse.
+    """
+
+    def __init__(self, precision=12):
+        if not 4 <= precision <= 16:
+            raise ValueError(f'Unsupported precision: {precision}')
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    @property
+    def error(self):
+        """Relative standard error of count."""
+        return 1.04 / math.sqrt(len(self.registers))
+
+    def add(self, item):
+        """Add item."""
+        h = hash64(item, salt=b'hll')
+        bits = 64 - self.precision
+        index, rest = h >> bits, h & ((1 << bits) - 1)
+        rank = bits - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self):
+        """Estimated number of distinct items."""
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)  # linear counting is more precise for small counts
+        return int(round(estimate))
+
+    def merge(self, other):
+        """Merge sketch of the same precision."""
+        if self.precision != other.precision:
+            raise ValueError('Sketches of different precision can not be merged')
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+        return self
+
+    def to_bytes(self):
+        """Serialize sketch, as (index, rank) pairs if most registers are empty."""
+        used = [i for i, r in enumerate(self.registers) if r]
+        if 3 * len(used) < len(self.registers):
+            return bytes([self.precision, 1]) + array.array('H', used).tobytes() + bytes(self.registers[i] for i in used)
+        return bytes([self.precision, 0]) + bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Deserialize sketch."""
+        sketch = cls(data[0])
+        if data[1]:
+            n = (len(data) - 2) // 3
+            used = array.array('H')
+            used.frombytes(data[2:2 + 2 * n])
+            for i, rank in zip(used, data[2 + 2 * n:]):
+                sketch.registers[i] = rank
+        else:
+            sketch.registers = bytearray(data[2:])
+        return sketch
@@ -0,0 +1,85 @@
+"""
+Parse scraped pages on Spark cluster
+====================================
+
+Pages are read from Parquet written by compress_descriptions(), parsed in Arrow
+batches by parse function of site (engine.Site.parse, extractors are shipped to
+executors, mapInPandas) and written as typed Parquet, which is read by naics.py.
+
+Run this code on docker-compose cluster with
+
+    > invoke submit "--master spark://master:7077 spark_parse.py yahoo"
+    > invoke submit "--master spark://master:7077 spark_parse.py project_main"
+"""
+
+import itertools
+import sys
+
+import config as cfg
+import project_main
+import sparksession
+import yahoo
+
+
+# output of sites, columns of parsed rows are typed by schema
+SITES = {
+    'yahoo': (yahoo.SITE, yahoo.YAHOO_DATA_PARQUET,
+        'symbol string, sector string, industry string, employees int, description string'),
+    'project_main': (project_main.SITE, project_main.PROJECT_DATA_PARQUET,
+        'symbol string, page_number int, comment_id string, comment_date timestamp, comment_text string, comment_author string'),
+    }
+
+
+def batch_parser(parse, schema):
+    """Parser of batches of pages by parse function of site (page to row or list of rows), shipped to executors."""
+
+    fields = [field.split() for field in schema.split(', ')]
+
+    def parse_batches(batches):
+        import pandas as pd
+        import contentcoding
+
+        for batch in batches:
+            rows = []
+            codecs = batch['codec'] if 'codec' in batch else itertools.repeat(None)
+            for symbol, html, codec in zip(batch['symbol'], batch['html'], codecs):
+                parsed = parse(contentcoding.decode(html, codec))
+                for row in (parsed if isinstance(parsed, list) else [parsed]):
+                    rows.append({**row, 'symbol': symbol.strip()})
+            frame = pd.DataFrame(rows, columns=[name for name, kind in fields])
+            for name, kind in fields:
+                if kind == 'int':
+                    frame[name] = pd.to_numeric(frame[name], errors='coerce')
+                elif kind == 'timestamp':
+                    frame[name] = pd.to_datetime(frame[name], errors='coerce', utc=True)
+            yield frame
+
+    return parse_batches
+
+
+def parse_descriptions(site='yahoo', batch_size=100, partitions=None):
+    """Parse scraped pages of the site on Spark cluster."""
+
+    site, dst, schema = SITES[site]
+    src = site.parquet
+
+    spark = sparksession.session(inputs=[src], app_name=f'parse_{site.name}')
+    for module in ('contentcoding.py', 'extractors.py'):
+        spark.sparkContext.addPyFile(str(cfg.HOMEDIR / module))
+
+    # pages are large, so Arrow batches are kept small
+    spark.conf.set('spark.sql.execution.arrow.maxRecordsPerBatch', batch_size)
+
+    # few large row groups are read by few tasks, spread pages over all executor cores
+    pages = spark.read.parquet(str(src))
+    pages = pages.repartition(partitions or spark.sparkContext.defaultParallelism * 3)
+
+    pages.mapInPandas(batch_parser(site.parse, schema), schema=schema).write.parquet(str(dst), mode='overwrite')
+
+
+def main():
+    parse_descriptions(*sys.argv[1:2])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""
+Performance reports of Spark runs
+=================================
+
+Sessions created by sparksession.py write Spark event logs (events of Spark
+listener bus) to build/spark_events, so metrics survive the container and the
+Spark UI. report() reads event log of a run, aggregates per stage:
+
+* task time (executor run time), GC time, input, shuffle read and write, spill,
+* median and max task duration, skew = max / median,
+
+writes them to build/spark_runs/<app id>.json and prints summary with the worst
+stage and comparison to the previous run of the same application.
+
+Run this code with
+
+    > invoke run "sparkmetrics:report()"
+    > invoke run "sparkmetrics:report('build/spark_events/local-1571234567890')"
+"""
+
+import json
+from pathlib import Path
+import statistics
+
+import config as cfg
+
+
+SPARK_EVENTS = cfg.BUILDDIR / 'spark_events'
+SPARK_RUNS = cfg.BUILDDIR / 'spark_runs'
+
+SKEW_THRESHOLD = 3.0  # max / median task duration worth reporting
+
+
+def read_events(path):
+    """Read Spark event log (JSON lines)."""
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def stage_metrics(events):
+    """Aggregate task metrics of event log per stage attempt."""
+
+    app = {}
+    stages = {}
+    durations = {}
+
+    for event in events:
+        kind = event['Event']
+        if kind == 'SparkListenerApplicationStart':
+            app = {'app_id': event.get('App ID'), 'app_name': event.get('App Name'), 'started': event.get('Timestamp')}
+        elif kind == 'SparkListenerApplicationEnd':
+            app['finished'] = event.get('Timestamp')
+        elif kind == 'SparkListenerTaskEnd':
+            key = (event['Stage ID'], event['Stage Attempt ID'])
+            stage = stages.setdefault(key, dict.fromkeys(
+                ['tasks', 'task_time', 'gc_time', 'input_bytes', 'shuffle_read', 'shuffle_write', 'spill_memory', 'spill_disk'], 0))
+            info, metrics = event['Task Info'], event.get('Task Metrics') or {}
+            shuffle_read = metrics.get('Shuffle Read Metrics') or {}
+            stage['tasks'] += 1
+            stage['task_time'] += metrics.get('Executor Run Time', 0)
+            stage['gc_time'] += metrics.get('JVM GC Time', 0)
+            stage['input_bytes'] += (metrics.get('Input Metrics') or {}).get('Bytes Read', 0)
+            stage['shuffle_read'] += shuffle_read.get('Remote Bytes Read', 0) + shuffle_read.get('Local Bytes Read', 0)
+            stage['shuffle_write'] += (metrics.get('Shuffle Write Metrics') or {}).get('Shuffle Bytes Written', 0)
+            stage['spill_memory'] += metrics.get('Memory Bytes Spilled', 0)
+            stage['spill_disk'] += metrics.get('Disk Bytes Spilled', 0)
+            durations.setdefault(key, []).append(info['Finish Time'] - info['Launch Time'])
+        elif kind == 'SparkListenerStageCompleted':
+            info = event['Stage Info']
+            stage = stages.setdefault((info['Stage ID'], info['Stage Attempt ID']), {})
+            stage['name'] = info.get('Stage Name')
+            if info.get('Submission Time') and info.get('Completion Time'):
+                stage['duration'] = info['Completion Time'] - info['Submission Time']
+
+    rows = []
+    for (stage_id, attempt), stage in sorted(stages.items()):
+        times = durations.get((stage_id, attempt), [0])
+        median = statistics.median(times)
+        rows.append({
+            'stage_id': stage_id,
+            'attempt': attempt,
+            **stage,
+            'task_median': median,
+            'task_max': max(times),
+            'skew': max(times) / median if median else 0.0,
+            })
+    return app, rows
+
+
+def summarize(stages):
+    """Totals of all stages."""
+    keys = ['tasks', 'task_time', 'gc_time', 'input_bytes', 'shuffle_read', 'shuffle_write', 'spill_memory', 'spill_disk']
+    return {k: sum(s.get(k, 0) for s in stages) for k in keys}
+
+
+def latest_log(path=SPARK_EVENTS):
+    """Most recently modified event log."""
+    logs = [p for p in path.iterdir() if p.is_file()]
+    if not logs:
+        raise FileNotFoundError(f'No event logs in {path}')
+    return max(logs, key=lambda p: p.stat().st_mtime)
+
+
+def previous_run(app_name, app_id, path=SPARK_RUNS):
+    """Previous saved run of the same application."""
+    runs = [json.loads(p.read_text()) for p in path.glob('*.json')]
+    runs = [r for r in runs if r.get('app_name') == app_name and r.get('app_id') != app_id and r.get('started')]
+    return max(runs, key=lambda r: r['started']) if runs else None
+
+
+def report(log=None, dst=SPARK_RUNS):
+    """Save per-stage metrics of Spark run and print summary."""
+
+    log = Path(log) if log else latest_log()
+    app, stages = stage_metrics(read_events(log))
+    run = {**app, 'event_log': str(log), 'totals': summarize(stages), 'stages': stages}
+
+    dst.mkdir(parents=True, exist_ok=True)
+    previous = previous_run(run.get('app_name'), run.get('app_id'), dst)
+    (dst / f'{run.get("app_id") or log.name}.json').write_text(json.dumps(run, indent=1))
+
+    totals = run['totals']
+    mb = 2**20
+    print(f'{run.get("app_name")} ({run.get("app_id")}): {len(stages)} stages, {totals["tasks"]} tasks, '
+          f'task time {totals["task_time"] / 1000:.1f}s, GC {totals["gc_time"] / 1000:.1f}s, '
+          f'shuffle {totals["shuffle_read"] / mb:.1f}/{totals["shuffle_write"] / mb:.1f} MB, '
+          f'spill {(totals["spill_memory"] + totals["spill_disk"]) / mb:.1f} MB')
+
+    if stages:
+        worst = max(stages, key=lambda s: s.get('task_time', 0))
+        print(f'Worst stage {worst["stage_id"]} ({worst.get("name")}): task time {worst.get("task_time", 0) / 1000:.1f}s '
+              f'of {totals["task_time"] / 1000:.1f}s, GC {worst.get("gc_time", 0) / 1000:.1f}s, '
+              f'skew {worst["skew"]:.1f} (max {worst["task_max"] / 1000:.1f}s, median {worst["task_median"] / 1000:.1f}s)')
+        for stage in stages:
+            if stage['skew'] >= SKEW_THRESHOLD and stage['task_max'] >= 1000:
+                print(f'Skewed stage {stage["stage_id"]} ({stage.get("name")}): skew {stage["skew"]:.1f}')
+            if stage.get('spill_disk'):
+                print(f'Spilling stage {stage["stage_id"]} ({stage.get("name")}): {stage["spill_disk"] / mb:.1f} MB on disk')
+
+    if previous is not None and previous['totals']['task_time']:
+        change = totals['task_time'] / previous['totals']['task_time'] - 1
+        print(f'Task time {change:+.1%} compared to run {previous["app_id"]}')
@@ -0,0 +1,126 @@
+"""
+Shared Spark session
+====================
+
+Session is created on first call of session(), so importing Spark modules does
+not start JVM. Profile selects cluster specific settings:
+
+* local – driver only, all cores of the laptop,
+* docker – docker-compose cluster (spark://master:7077),
+* dataproc – YARN cluster created by `invoke cluster create`.
+
+Without profile (argument or SPARK_PROFILE environment variable) master is left
+to spark-submit (or local[*] for plain python). All profiles use Kryo serializer,
+adaptive query execution and Arrow for pandas conversions; number of shuffle
+partitions is sized from input bytes, see shuffle_partitions(). Event logs are
+written to build/spark_events for sparkmetrics.py.
+"""
+
+import math
+import os
+
+from pyspark.sql import SparkSession
+
+import config as cfg
+
+
+TUNING = {
+    'spark.serializer': 'org.apache.spark.serializer.KryoSerializer',
+    'spark.kryoserializer.buffer.max': '256m',
+    'spark.sql.adaptive.enabled': 'true',
+    'spark.sql.adaptive.coalescePartitions.enabled': 'true',
+    'spark.sql.adaptive.skewJoin.enabled': 'true',
+    'spark.sql.execution.arrow.pyspark.enabled': 'true',
+    'spark.sql.execution.arrow.pyspark.fallback.enabled': 'true',
+    # statistics of tables registered by catalog.py
+    'spark.sql.cbo.enabled': 'true',
+    'spark.sql.cbo.joinReorder.enabled': 'true',
+    'spark.sql.statistics.histogram.enabled': 'true',
+    }
+
+PROFILES = {
+    'local': {
+        'spark.master': 'local[*]',
+        'spark.driver.memory': '4g',
+        },
+    'docker': {
+        'spark.master': 'spark://master:7077',
+        'spark.executor.memory': '1g',
+        },
+    'dataproc': {
+        'spark.master': 'yarn',
+        'spark.executor.cores': '2',
+        'spark.executor.memory': '4g',
+        'spark.dynamicAllocation.enabled': 'true',
+        },
+    }
+
+# event logs are read by sparkmetrics.py, Dataproc keeps its own history server logs
+EVENT_LOG = {
+    'spark.eventLog.enabled': 'true',
+    'spark.eventLog.dir': (cfg.BUILDDIR / 'spark_events').as_uri(),
+    }
+
+PARTITION_MB = 128
+
+_session = None
+_tuned = True
+
+
+def session(profile=None, inputs=(), app_name='bigdata19', tuned=True):
+    """Get Spark session, create it on first call.
+
+    With inputs (paths) number of shuffle partitions is sized from their size.
+    tuned=False leaves Spark defaults, which is used by benchmarks only.
+    """
+
+    global _session, _tuned
+    if _session is None:
+        profile = profile or os.environ.get('SPARK_PROFILE')
+        if profile is not None and profile not in PROFILES:
+            raise ValueError(f'Unsupported Spark profile: {profile}')
+
+        # tables are kept in metastore_db (Hive metastore on Dataproc), see catalog.py
+        builder = SparkSession.builder.appName(app_name).enableHiveSupport()
+        if profile != 'dataproc':
+            builder = builder.config('spark.sql.warehouse.dir', (cfg.BUILDDIR / 'warehouse').as_uri())  # catalog.WAREHOUSE
+        settings = dict(PROFILES.get(profile, {}))
+        if tuned:
+            settings.update(TUNING)
+        if profile != 'dataproc':
+            (cfg.BUILDDIR / 'spark_events').mkdir(parents=True, exist_ok=True)
+            settings.update(EVENT_LOG)
+        for key, value in settings.items():
+            builder = builder.config(key, value)
+        _session = builder.getOrCreate()
+        _tuned = tuned
+
+    if inputs and _tuned:
+        shuffle_partitions(_session, inputs)
+    return _session
+
+
+def input_bytes(spark, paths):
+    """Total size of files and folders, local or on cluster file system."""
+
+    jvm = spark.sparkContext._jvm
+    conf = spark.sparkContext._jsc.hadoopConfiguration()
+    total = 0
+    for path in paths:
+        path = jvm.org.apache.hadoop.fs.Path(str(path))
+        fs = path.getFileSystem(conf)
+        if fs.exists(path):
+            total += fs.getContentSummary(path).getLength()
+    return total
+
+
+def shuffle_partitions(spark, paths, partition_mb=PARTITION_MB):
+    """Set number of shuffle partitions to input size over partition size, at least parallelism."""
+
+    size = input_bytes(spark, paths)
+    partitions = max(spark.sparkContext.defaultParallelism, math.ceil(size / (partition_mb * 2**20)))
+    spark.conf.set('spark.sql.shuffle.partitions', partitions)
+    # adaptive execution starts from more partitions and coalesces small ones
+    spark.conf.set('spark.sql.adaptive.coalescePartitions.initialPartitionNum', partitions * 4)
+    spark.conf.set('spark.sql.adaptive.advisoryPartitionSizeInBytes', f'{partition_mb}m')
+    return partitions
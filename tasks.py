@@ -1,10 +1,17 @@
+import ast
+import concurrent.futures
+import datetime
+import hashlib
 import io
 from invoke import task
 import json
 import os
 from pathlib import Path
 import re
+import shutil
 import sys
+import threading
+import time
 
 import config as cfg
 
@@ -27,9 +34,8 @@ def init(c):
     c.run(f'docker pull {cfg.CLOUDSDK_IMAGE}', pty=PTY)
 
 
-@task
-def run(c, task):
-    """Run python script."""
+def command_line(task):
+    """Translate task definition to python command line."""
 
     # determine task type and run python script
     tasks = {
@@ -40,16 +46,17 @@ def run(c, task):
             re.compile(r'(?P<module>[a-zA-Z][a-zA-Z0-9_]*):(?P<function>[a-zA-Z][a-zA-Z0-9_]*)(?P<args>\(.*\))'),
             f'python -c \'import {{module}}; {{module}}.{{function}}{{args}}\''),
         }
-    cmdline = None
     for name, (rx, cmd) in tasks.items():
         m = rx.fullmatch(task)
         if m is not None:
-            cmdline = cmd.format(**m.groupdict())
-            break
-    if cmdline is not None:
-        c.run(cmdline, replace_env=False, pty=PTY)
-    else:
-        raise ValueError(f'Unsupported task definition: {task}')
+            return cmd.format(**m.groupdict())
+    raise ValueError(f'Unsupported task definition: {task}')
+
+
+@task
+def run(c, task):
+    """Run python script."""
+    c.run(command_line(task), replace_env=False, pty=PTY)
 
 
 @task
@@ -96,6 +103,248 @@ def pyspark(c):
 
 
 @task
-def submit(c, cmd):
-    """Run Spark command."""
-    c.run(f'docker-compose run --rm client spark-submit {cmd}', pty=PTY)
+def submit(c, cmd, report=True):
+    """Run Spark command, print performance report of the run."""
+    (cfg.BUILDDIR / 'spark_events').mkdir(exist_ok=True)
+    events = f'--conf spark.eventLog.enabled=true --conf spark.eventLog.dir=file:/code/{cfg.BUILDDIR.name}/spark_events'
+    c.run(f'docker-compose run --rm client spark-submit {events} {cmd}', pty=PTY)
+    if report:
+        run(c, 'sparkmetrics:report()')
+
+
+# Pipeline stages: python task to run, its inputs, outputs and code.
+# Code entries are 'module.py' files or 'module:function' functions (only their syntax tree is hashed,
+# so unrelated edits of the module do not invalidate the stage).
+# Outputs of stages with 'keep' are incremental state (append-only deltas, watermarks), they are not removed before run.
+# Stage dependencies are derived by matching inputs to outputs of other stages.
+STAGES = {
+    'yahoo_scrape': {
+        'task': 'yahoo:scrape_descriptions_async()',
+        'inputs': [cfg.DATADIR / 'nasdaq'],
+        'outputs': [cfg.BUILDDIR / 'yahoo_html'],
+        'code': ['yahoo:scrape_descriptions_async', 'engine:scrape', 'fetchers.py'],
+        },
+    'yahoo_archive': {
+        'task': 'yahoo:archive_descriptions()',
+        'inputs': [cfg.BUILDDIR / 'yahoo_html'],
+        'outputs': [cfg.BUILDDIR / 'yahoo.tbz2'],
+        'code': ['yahoo:archive_descriptions', 'engine:archive'],
+        },
+    'yahoo_compress': {
+        'task': 'yahoo:compress_descriptions()',
+        'inputs': [cfg.BUILDDIR / 'yahoo.tbz2'],
+        'outputs': [cfg.BUILDDIR / 'yahoo.parquet'],
+        'code': ['yahoo:compress_descriptions', 'engine:compress'],
+        },
+    'yahoo_parse': {
+        'task': 'yahoo:parse_descriptions()',
+        'inputs': [cfg.BUILDDIR / 'yahoo.parquet'],
+        'outputs': [cfg.BUILDDIR / 'yahoo.csv'],
+        'code': ['yahoo:parse_descriptions', 'engine:extract_pages', 'extractors.py', 'contentcoding.py'],
+        },
+    'naics': {
+        'task': 'naics:main()',
+        'inputs': [cfg.BUILDDIR / 'warehouse' / 'yahoo_profiles', cfg.DATADIR / 'stopwords'],
+        'outputs': [cfg.BUILDDIR / 'model_cv'],
+        'code': ['naics.py', 'tokens.py'],
+        },
+    'project_main_scrape': {
+        'task': 'project_main:scrape_descriptions_async()',
+        'inputs': [cfg.DATADIR / 'project_main'],
+        'outputs': [cfg.BUILDDIR / 'project_main_html'],
+        'code': ['project_main:scrape_descriptions_async', 'engine:scrape', 'fetchers.py'],
+        },
+    'project_main_archive': {
+        'task': 'project_main:archive_descriptions()',
+        'inputs': [cfg.BUILDDIR / 'project_main_html'],
+        'outputs': [cfg.BUILDDIR / 'project_main_html.tbz2'],
+        'code': ['project_main:archive_descriptions', 'engine:archive'],
+        },
+    'project_main_compress': {
+        'task': 'project_main:compress_descriptions()',
+        'inputs': [cfg.BUILDDIR / 'project_main_html.tbz2'],
+        'outputs': [cfg.BUILDDIR / 'project_main.parquet'],
+        'code': ['project_main:compress_descriptions', 'engine:compress'],
+        },
+    'project_main_parse': {
+        'task': 'project_main:parse_descriptions()',
+        'inputs': [cfg.BUILDDIR / 'project_main.parquet'],
+        'outputs': [cfg.BUILDDIR / 'project_main_deltas'],
+        'code': ['project_main.py', 'engine:extract_pages', 'extractors.py', 'contentcoding.py', 'rollups.py'],
+        'keep': True,
+        },
+    # tables are kept: metastore_db and build/catalog_comments.json refer to them, comments are inserted incrementally
+    'catalog_profiles': {
+        'task': 'catalog:refresh(comments=False)',
+        'inputs': [cfg.BUILDDIR / 'yahoo.csv', cfg.DATADIR / 'nasdaq'],
+        'outputs': [cfg.BUILDDIR / 'warehouse' / 'yahoo_profiles', cfg.BUILDDIR / 'warehouse' / 'nasdaq_symbols'],
+        'code': ['catalog:refresh', 'catalog:analyze', 'catalog:register_yahoo', 'catalog:register_nasdaq'],
+        'keep': True,
+        },
+    'catalog_comments': {
+        'task': 'catalog:refresh(profiles=False)',
+        'inputs': [cfg.BUILDDIR / 'project_main_deltas'],
+        'outputs': [cfg.BUILDDIR / 'warehouse' / 'forum_comments'],
+        'code': ['catalog:refresh', 'catalog:analyze', 'catalog:refresh_comments'],
+        'keep': True,
+        },
+    }
+
+PIPELINE_MANIFEST = cfg.BUILDDIR / 'pipeline.json'
+PIPELINE_LOGS = cfg.BUILDDIR / 'pipeline_logs'
+
+
+def code_digest(code):
+    """Hash of stage code: source of files, syntax tree of functions."""
+
+    h = hashlib.sha256()
+    for item in code:
+        module, _, function = item.partition(':')
+        source = (cfg.HOMEDIR / (module if module.endswith('.py') else f'{module}.py')).read_text(encoding='utf-8')
+        if function:
+            nodes = [n for n in ast.parse(source).body if isinstance(n, (ast.FunctionDef, ast.AsyncFunctionDef)) and n.name == function]
+            if not nodes:
+                raise ValueError(f'Function {function} not found in {module}')
+            source = ast.dump(nodes[0])  # without positions, so moving and formatting code do not matter
+        h.update(f'{item}\0{source}\n'.encode())
+    return h.hexdigest()
+
+
+def stage_dependencies(stages):
+    """Find stages producing inputs of every stage."""
+
+    producers = {}
+    for name, stage in stages.items():
+        for path in stage['outputs']:
+            producers[Path(path)] = name
+
+    return {
+        name: {producers[Path(path)] for path in stage['inputs'] if Path(path) in producers}
+        for name, stage in stages.items()
+        }
+
+
+def digest(paths, cache):
+    """Content hash of files and directories.
+
+    File hashes are cached by (size, mtime), so unchanged files are not read again.
+    Returns None if any path does not exist.
+    """
+
+    h = hashlib.sha256()
+    for path in paths:
+        path = Path(path)
+        if not path.exists():
+            return None
+        files = sorted(p for p in path.rglob('*') if p.is_file()) if path.is_dir() else [path]
+        for f in files:
+            if '__pycache__' in f.parts:
+                continue
+            st = f.stat()
+            key = str(f.relative_to(cfg.HOMEDIR))
+            cached = cache.get(key)
+            if cached is None or cached[:2] != [st.st_size, st.st_mtime_ns]:
+                fh = hashlib.sha256()
+                with open(f, 'rb') as stream:
+                    for chunk in iter(lambda: stream.read(1 << 20), b''):
+                        fh.update(chunk)
+                cached = cache[key] = [st.st_size, st.st_mtime_ns, fh.hexdigest()]
+            h.update(f'{key}\0{cached[2]}\n'.encode())
+    return h.hexdigest()
+
+
+@task(help={
+    'stages': 'Comma-separated stages to build (with their dependencies), default is all.',
+    'force': 'Rebuild stages even if they are up to date.',
+    'jobs': 'Number of stages to run concurrently.',
+    'dry': 'Only show what would be run.',
+    })
+def pipeline(c, stages='', force=False, jobs=2, dry=False):
+    """Run pipeline stages which are out of date."""
+
+    dependencies = stage_dependencies(STAGES)
+
+    # select requested stages and everything they depend on
+    selected, pending = set(), [s.strip() for s in stages.split(',') if s.strip()] or list(STAGES)
+    while pending:
+        name = pending.pop()
+        if name not in STAGES:
+            raise ValueError(f'Unsupported stage: {name}')
+        if name not in selected:
+            selected.add(name)
+            pending.extend(dependencies[name])
+
+    previous = json.loads(PIPELINE_MANIFEST.read_text()) if PIPELINE_MANIFEST.exists() else {}
+    cache = previous.get('files', {})
+    results = dict(previous.get('stages', {}))
+    lock = threading.Lock()
+    PIPELINE_LOGS.mkdir(parents=True, exist_ok=True)
+
+    def state(stage):
+        with lock:
+            inputs = digest(stage['inputs'], cache)
+            outputs = digest(stage['outputs'], cache)
+        code = code_digest(stage['code'])
+        return inputs and hashlib.sha256(f'{stage["task"]}\0{inputs}\0{code}'.encode()).hexdigest(), outputs
+
+    def build_stage(name):
+        stage = STAGES[name]
+        inputs, outputs = state(stage)
+        before = previous.get('stages', {}).get(name, {})
+        if not force and inputs is not None and outputs is not None \
+                and before.get('inputs') == inputs and before.get('outputs') == outputs:
+            return {'status': 'skipped', 'inputs': inputs, 'outputs': outputs, 'seconds': 0.0}
+        if dry:
+            return {'status': 'outdated'}
+
+        # remove stale outputs, stages like naics:main() reuse outputs if they exist
+        for path in ([] if stage.get('keep') else stage['outputs']):
+            if Path(path).is_dir():
+                shutil.rmtree(path)
+            elif Path(path).exists():
+                Path(path).unlink()
+
+        start = time.time()
+        print(f'[{name}] {stage["task"]}')
+        with open(PIPELINE_LOGS / f'{name}.log', 'w') as log:
+            result = c.run(command_line(stage['task']), replace_env=False, pty=False, warn=True,
+                env={'PYTHONBREAKPOINT': '0'}, out_stream=log, err_stream=log)
+        seconds = round(time.time() - start, 3)
+        if not result.ok:
+            return {'status': 'failed', 'seconds': seconds}
+        inputs, outputs = state(stage)
+        return {'status': 'ran', 'inputs': inputs, 'outputs': outputs, 'seconds': seconds}
+
+    # schedule stages as soon as all their dependencies are done
+    started = time.time()
+    done, running = {}, {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        while len(done) < len(selected):
+            for name in sorted(selected - set(done) - set(running.values())):
+                deps = dependencies[name] & selected
+                if any(done.get(d, {}).get('status') in ('failed', 'blocked') for d in deps):
+                    done[name] = {'status': 'blocked'}
+                elif any(done.get(d, {}).get('status') == 'outdated' for d in deps):
+                    done[name] = {'status': 'outdated'}
+                elif all(d in done for d in deps):
+                    running[executor.submit(build_stage, name)] = name
+            if not running:
+                continue
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                done[name] = future.result()
+                print(f'[{name}] {done[name]["status"]}')
+
+    if not dry:
+        results.update(done)
+        PIPELINE_MANIFEST.write_text(json.dumps({
+            'started': datetime.datetime.fromtimestamp(started).isoformat(timespec='seconds'),
+            'seconds': round(time.time() - started, 3),
+            'stages': results,
+            'files': cache,
+            }, indent=2))
+
+    failed = [name for name, result in done.items() if result['status'] in ('failed', 'blocked')]
+    if failed:
+        raise RuntimeError(f'Failed stages: {", ".join(sorted(failed))}, see logs in {PIPELINE_LOGS}')
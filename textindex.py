@@ -0,0 +1,401 @@
+"""
+Full-text inverted index of parsed forum comments
+=================================================
+
+Index is a folder of immutable segments, new comments are appended as new
+segments. Every segment has:
+
+* lexicon.json – term -> [docs offset, docs size, df, positions offset, positions size]
+* docs.bin – per term: delta-encoded document numbers and term frequencies (varints)
+* positions.bin – per term and document: delta-encoded token positions (varints)
+* dates.bin, lengths.bin – comment date (epoch seconds) and length in tokens per document
+* ids.txt – symbol and comment_id per document
+
+Binary files are memory-mapped at query time. Texts are split with tokens.words(),
+so stop words are not indexed and phrases match over remaining words.
+
+Run this code with
+
+    > invoke run "textindex:build_index()"
+    > invoke run "textindex:search('bitcoin AND (wallet OR \\"cold storage\\") NOT scam', since='2019-01-01')"
+"""
+
+from array import array
+from collections import defaultdict
+import datetime
+import heapq
+import json
+import math
+import mmap
+import re
+
+import config as cfg
+import extractors
+import tokens
+
+
+INDEX_DIR = cfg.BUILDDIR / 'comment_index'
+
+
+def encode_varints(values, out):
+    """Append unsigned LEB128 varints to bytearray."""
+    for value in values:
+        while value >= 0x80:
+            out.append((value & 0x7f) | 0x80)
+            value >>= 7
+        out.append(value)
+
+
+def decode_varints(buf, start, stop):
+    """Decode unsigned LEB128 varints from buffer slice."""
+    values, value, shift = [], 0, 0
+    for byte in buf[start:stop]:
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value, shift = 0, 0
+    return values
+
+
+def parse_date(value):
+    """Epoch seconds of ISO date, -1 if unknown."""
+    if isinstance(value, datetime.datetime):
+        dt = value if value.tzinfo is not None else value.replace(tzinfo=datetime.timezone.utc)
+    elif isinstance(value, datetime.date):
+        dt = datetime.datetime(value.year, value.month, value.day, tzinfo=datetime.timezone.utc)
+    else:
+        dt = extractors.parse_datetime(value)
+    return int(dt.timestamp()) if dt is not None else -1
+
+
+def write_segment(path, rows):
+    """Write index segment of comments."""
+
+    postings = defaultdict(list)  # term -> [(doc, positions)]
+    dates, lengths, ids = array('q'), array('i'), []
+    for doc, row in enumerate(rows):
+        words = tokens.words(row.get('comment_text'))
+        positions = defaultdict(list)
+        for pos, word in enumerate(words):
+            positions[word].append(pos)
+        for word, pos in positions.items():
+            postings[word].append((doc, pos))
+        dates.append(parse_date(row.get('comment_date')))
+        lengths.append(len(words))
+        ids.append(f'{row["symbol"]}\t{row["comment_id"]}')
+
+    lexicon, docs_buf, positions_buf = {}, bytearray(), bytearray()
+    for term in sorted(postings):
+        entries = postings[term]
+        docs_start, positions_start = len(docs_buf), len(positions_buf)
+        previous = 0
+        for doc, pos in entries:
+            encode_varints((doc - previous, len(pos)), docs_buf)
+            encode_varints([p - q for p, q in zip(pos, [0] + pos[:-1])], positions_buf)
+            previous = doc
+        lexicon[term] = [docs_start, len(docs_buf) - docs_start, len(entries),
+            positions_start, len(positions_buf) - positions_start]
+
+    path.mkdir(parents=True, exist_ok=True)
+    (path / 'lexicon.json').write_text(json.dumps(lexicon, ensure_ascii=False), encoding='utf-8')
+    (path / 'docs.bin').write_bytes(bytes(docs_buf) or b'\0')  # empty files can't be memory-mapped
+    (path / 'positions.bin').write_bytes(bytes(positions_buf) or b'\0')
+    (path / 'dates.bin').write_bytes(dates.tobytes() or b'\0' * 8)
+    (path / 'lengths.bin').write_bytes(lengths.tobytes() or b'\0' * 4)
+    (path / 'ids.txt').write_text('\n'.join(ids), encoding='utf-8')
+
+    return len(ids), sum(lengths)
+
+
+class Segment:
+    """Memory-mapped index segment."""
+
+    def __init__(self, path, docs):
+        self.path = path
+        self.docs = docs
+        self.lexicon = json.loads((path / 'lexicon.json').read_text(encoding='utf-8'))
+        self._maps = []
+        self.postings = self._map('docs.bin')
+        self.positions = self._map('positions.bin')
+        self.dates = memoryview(self._map('dates.bin')).cast('q')
+        self.lengths = memoryview(self._map('lengths.bin')).cast('i')
+        self._ids = None
+
+    def _map(self, name):
+        with open(self.path / name, 'rb') as f:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(m)
+        return m
+
+    def ids(self, doc):
+        """Symbol and comment id of document."""
+        if self._ids is None:
+            self._ids = (self.path / 'ids.txt').read_text(encoding='utf-8').split('\n')
+        return self._ids[doc].split('\t')
+
+    def df(self, term):
+        """Number of documents with term."""
+        entry = self.lexicon.get(term)
+        return entry[2] if entry else 0
+
+    def postings_of(self, term):
+        """Dictionary doc -> tf of term."""
+        entry = self.lexicon.get(term)
+        if entry is None:
+            return {}
+        values = decode_varints(self.postings, entry[0], entry[0] + entry[1])
+        result, doc = {}, 0
+        for i in range(0, len(values), 2):
+            doc += values[i]
+            result[doc] = values[i + 1]
+        return result
+
+    def positions_of(self, term, docs):
+        """Dictionary doc -> positions of term for selected docs."""
+        entry = self.lexicon.get(term)
+        if entry is None:
+            return {}
+        tfs = self.postings_of(term)
+        deltas = decode_varints(self.positions, entry[3], entry[3] + entry[4])
+        result, i = {}, 0
+        for doc, tf in tfs.items():
+            if doc in docs:
+                pos, current = [], 0
+                for delta in deltas[i:i + tf]:
+                    current += delta
+                    pos.append(current)
+                result[doc] = pos
+            i += tf
+        return result
+
+    def phrase(self, words, docs=None):
+        """Documents containing words as consecutive terms."""
+        candidates = set(self.postings_of(words[0]))
+        for word in words[1:]:
+            candidates &= set(self.postings_of(word))
+        if docs is not None:
+            candidates &= docs
+        positions = [self.positions_of(word, candidates) for word in words]
+        result = set()
+        for doc in candidates:
+            starts = set(positions[0][doc])
+            for offset, pos in enumerate(positions[1:], 1):
+                starts &= {p - offset for p in pos[doc]}
+            if starts:
+                result.add(doc)
+        return result
+
+    def close(self):
+        self.dates.release()
+        self.lengths.release()
+        for m in self._maps:
+            m.close()
+
+
+QUERY_TOKENS = re.compile(r'"[^"]*"|\(|\)|[^\s()"]+')
+
+
+def parse_query(query):
+    """Parse boolean query to tree of ('and'|'or'|'not'|'phrase', ...) nodes.
+
+    Words are joined with AND by default, OR and NOT are supported as well as
+    parentheses and "quoted phrases". Stop words are ignored.
+    """
+
+    items = QUERY_TOKENS.findall(query)
+    pos = 0
+
+    def peek():
+        return items[pos] if pos < len(items) else None
+
+    def take():
+        nonlocal pos
+        pos += 1
+        return items[pos - 1]
+
+    def parse_or():
+        nodes = [parse_and()]
+        while peek() == 'OR':
+            take()
+            nodes.append(parse_and())
+        nodes = [n for n in nodes if n is not None]
+        return nodes[0] if len(nodes) == 1 else (('or', *nodes) if nodes else None)
+
+    def parse_and():
+        nodes = [parse_not()]
+        while peek() not in (None, 'OR', ')'):
+            if peek() == 'AND':
+                take()
+            nodes.append(parse_not())
+        nodes = [n for n in nodes if n is not None]
+        return nodes[0] if len(nodes) == 1 else (('and', *nodes) if nodes else None)
+
+    def parse_not():
+        if peek() == 'NOT':
+            take()
+            node = parse_not()
+            return ('not', node) if node is not None else None
+        return parse_atom()
+
+    def parse_atom():
+        item = take()
+        if item == '(':
+            node = parse_or()
+            if peek() == ')':
+                take()
+            return node
+        words = tokens.words(item.strip('"'))
+        return ('phrase', *words) if words else None
+
+    return parse_or() if items else None
+
+
+class Index:
+    """Inverted index of comments."""
+
+    def __init__(self, path=INDEX_DIR):
+        self.path = path
+        meta = path / 'meta.json'
+        self.meta = json.loads(meta.read_text()) if meta.exists() else {'segments': [], 'docs': 0, 'length': 0}
+        self.segments = [Segment(path / s['name'], s['docs']) for s in self.meta['segments']]
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def indexed_ids(self):
+        """Set of indexed comment ids."""
+        return {segment.ids(doc)[1] for segment in self.segments for doc in range(segment.docs)}
+
+    def append(self, rows, segment_size=200000):
+        """Add comments which are not indexed yet as new segments."""
+
+        indexed = self.indexed_ids()
+        batch, added = [], 0
+
+        def flush():
+            name = f'seg-{len(self.meta["segments"]) + 1:06d}'
+            docs, length = write_segment(self.path / name, batch)
+            self.meta['segments'].append({'name': name, 'docs': docs})
+            self.meta['docs'] += docs
+            self.meta['length'] += length
+            self.segments.append(Segment(self.path / name, docs))
+            (self.path / 'meta.json').write_text(json.dumps(self.meta, indent=2))
+
+        for row in rows:
+            if row['comment_id'] and row['comment_id'] not in indexed:
+                indexed.add(row['comment_id'])
+                batch.append(row)
+                if len(batch) >= segment_size:
+                    flush()
+                    added, batch = added + len(batch), []
+        if batch:
+            flush()
+            added += len(batch)
+        return added
+
+    def search(self, query, since=None, until=None, k=10):
+        """Top k comments matching boolean query, ranked by tf-idf.
+
+        Returns list of dicts with symbol, comment_id, comment_date and score.
+        """
+
+        tree = parse_query(query)
+        if tree is None:
+            return []
+        since = parse_date(since) if since is not None else None
+        until = parse_date(until) if until is not None else None
+
+        # positive terms are used for ranking
+        def positive(node, negated=False):
+            if node[0] == 'phrase':
+                return [] if negated else list(node[1:])
+            return [t for child in node[1:] for t in positive(child, negated ^ (node[0] == 'not'))]
+        terms = set(positive(tree))
+        num_docs = max(self.meta['docs'], 1)
+        df = {t: sum(s.df(t) for s in self.segments) for t in terms}
+        idf = {t: math.log(1 + num_docs / df[t]) for t in terms if df[t]}
+
+        heap = []
+        for segment in self.segments:
+            docs = self._evaluate(segment, tree)
+            if since is not None or until is not None:
+                docs = {d for d in docs
+                    if (since is None or segment.dates[d] >= since) and (until is None or 0 <= segment.dates[d] < until)}
+            if not docs:
+                continue
+            scores = dict.fromkeys(docs, 0.0)
+            for term, weight in idf.items():
+                for doc, tf in segment.postings_of(term).items():
+                    if doc in scores:
+                        scores[doc] += (1 + math.log(tf)) * weight
+            for doc, score in scores.items():
+                score /= math.sqrt(max(segment.lengths[doc], 1))
+                item = (score, segment.path.name, doc)
+                if len(heap) < k:
+                    heapq.heappush(heap, item)
+                elif item > heap[0]:
+                    heapq.heapreplace(heap, item)
+
+        segments = {s.path.name: s for s in self.segments}
+        result = []
+        for score, name, doc in sorted(heap, reverse=True):
+            segment = segments[name]
+            symbol, comment_id = segment.ids(doc)
+            date = segment.dates[doc]
+            result.append({
+                'symbol': symbol,
+                'comment_id': comment_id,
+                'comment_date': datetime.datetime.fromtimestamp(date, datetime.timezone.utc).isoformat() if date >= 0 else '',
+                'score': score,
+                })
+        return result
+
+    def _evaluate(self, segment, node):
+        op = node[0]
+        if op == 'phrase':
+            words = node[1:]
+            return set(segment.postings_of(words[0])) if len(words) == 1 else segment.phrase(words)
+        elif op == 'and':
+            positives = [c for c in node[1:] if c[0] != 'not']
+            negatives = [c[1] for c in node[1:] if c[0] == 'not']
+            docs = set(range(segment.docs)) if not positives else None
+            for child in positives:
+                found = self._evaluate(segment, child)
+                docs = found if docs is None else docs & found
+                if not docs:
+                    return set()
+            for child in negatives:
+                docs -= self._evaluate(segment, child)
+            return docs
+        elif op == 'or':
+            return set().union(*(self._evaluate(segment, child) for child in node[1:]))
+        elif op == 'not':
+            return set(range(segment.docs)) - self._evaluate(segment, node[1])
+        raise ValueError(f'Unsupported query node: {op}')
+
+
+def build_index(src=None, dst=INDEX_DIR):
+    """Append parsed comments to index."""
+
+    import project_main
+
+    with Index(dst) as index:
+        added = index.append(project_main.read_comments(src or project_main.PROJECT_DELTAS))
+    print(f'Indexed {added} new comments')
+
+
+def search(query, since=None, until=None, k=10, path=INDEX_DIR):
+    """Print top comments matching query."""
+
+    with Index(path) as index:
+        for hit in index.search(query, since=since, until=until, k=k):
+            print(f'{hit["score"]:8.3f}  {hit["comment_date"]:25}  {hit["symbol"]:>8}  {hit["comment_id"]}')
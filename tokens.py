@@ -0,0 +1,36 @@
+"""
+Tokenizer and stop words shared by local text processing and naics.py.
+
+Texts are split the same way as RegexTokenizer(pattern='\\W') does, but with
+Unicode word characters, so Cyrillic forum comments are kept.
+"""
+
+import functools
+import re
+
+import config as cfg
+
+
+STOPWORD_FILES = (
+    cfg.DATADIR / 'stopwords' / 'mysql.txt',
+    cfg.DATADIR / 'stopwords' / 'nltk.txt',
+    )
+
+SPLIT = re.compile(r'\W+')
+
+
+@functools.lru_cache()
+def stopwords():
+    """Read stop words."""
+    return frozenset('\n'.join(f.read_text().strip() for f in STOPWORD_FILES).splitlines())
+
+
+def tokenize(text):
+    """Split text to lower case tokens."""
+    return [t for t in SPLIT.split((text or '').lower()) if t]
+
+
+def words(text):
+    """Tokens of text without stop words."""
+    skip = stopwords()
+    return [t for t in tokenize(text) if t not in skip]
@@ -0,0 +1,232 @@
+"""
+Online topic model of forum comments
+====================================
+
+Latent Dirichlet allocation trained by online variational Bayes (Hoffman, Blei,
+Bach 2010) on Spark. Comments of delta partitions of project_main.parse_descriptions(),
+which are not in the model yet, are split to mini-batches of about BATCH_DOCS
+comments. For every mini-batch executors run E-step on their partitions against
+broadcast topics, the driver sums sufficient statistics and blends them into
+topic-word weights with step (TAU0 + updates) ** -KAPPA. Then new comments get
+topic distributions, which are appended to build/comment_topics.
+
+Model (topic-word weights, vocabulary, number of updates and comments, trained
+partitions) is kept in build/topics_model, so refresh costs are proportional to
+new comments only. Vocabulary is selected on the first refresh with the same
+stop words as naics.py (tokens are Unicode words, so Cyrillic comments are kept)
+and kept afterwards, new terms are ignored; refresh(full=True) trains the model
+from scratch, as does refresh after project_main.parse_descriptions(full=True).
+
+Spark LDA(optimizer='online') is not used, because it can not continue from
+saved model.
+
+Run this code with
+
+    > invoke run "topics:refresh()"
+    > invoke run "topics:describe()"
+"""
+
+import json
+import shutil
+
+import numpy as np
+from pyspark.ml import PipelineModel
+from pyspark.ml.feature import CountVectorizer, CountVectorizerModel
+import pyspark.sql.functions as F
+from pyspark.sql.types import ArrayType, DoubleType, IntegerType, StringType, StructField, StructType
+
+import config as cfg
+import naics
+import project_main
+import sparksession
+
+
+TOPICS_MODEL = cfg.BUILDDIR / 'topics_model'
+COMMENT_TOPICS = cfg.BUILDDIR / 'comment_topics'
+
+NUM_TOPICS = 20
+VOCAB_SIZE = 5000
+MIN_DF = 5
+BATCH_DOCS = 4096
+TAU0 = 64.0  # down-weights early updates
+KAPPA = 0.7  # learning rate decay, (0.5, 1] for convergence
+E_STEP_ITER = 100
+E_STEP_TOL = 1e-3
+
+TOPICS_SCHEMA = StructType([
+    StructField('comment_id', StringType()),
+    StructField('symbol', StringType()),
+    StructField('comment_date', StringType()),
+    StructField('topic', IntegerType()),
+    StructField('topics', ArrayType(DoubleType())),
+    ])
+
+
+def digamma(x):
+    """Digamma function of positive values (numpy has none, scipy is not a dependency)."""
+
+    x = np.array(x, dtype=np.float64)
+    result = np.zeros_like(x)
+    for _ in range(6):  # shift arguments above 6, where asymptotic series is precise
+        small = x < 6
+        result[small] -= 1 / x[small]
+        x = np.where(small, x + 1, x)
+    f = 1 / (x * x)
+    return result + np.log(x) - 0.5 / x - f * (1 / 12 - f * (1 / 120 - f * (1 / 252 - f * (1 / 240 - f / 132))))
+
+
+def dirichlet_expectation(alpha):
+    """E[log theta] of theta ~ Dirichlet(alpha), for every row of alpha."""
+    return digamma(alpha) - digamma(alpha.sum(axis=-1, keepdims=True))
+
+
+def infer(ids, counts, exp_elog_beta, alpha, rng):
+    """Variational topic weights (gamma) of one document and its normalizer of word topics."""
+
+    beta = exp_elog_beta[:, ids]
+    gamma = rng.gamma(100.0, 0.01, exp_elog_beta.shape[0])
+    exp_elog_theta = np.exp(dirichlet_expectation(gamma))
+    norm = exp_elog_theta @ beta + 1e-100
+    for _ in range(E_STEP_ITER):
+        last = gamma
+        gamma = alpha + exp_elog_theta * ((counts / norm) @ beta.T)
+        exp_elog_theta = np.exp(dirichlet_expectation(gamma))
+        norm = exp_elog_theta @ beta + 1e-100
+        if np.mean(np.abs(gamma - last)) < E_STEP_TOL:
+            break
+    return gamma, exp_elog_theta, norm
+
+
+def e_step(docs, exp_elog_beta, alpha, seed=0):
+    """Sufficient statistics (topics x vocabulary) of documents given as (ids, counts)."""
+
+    rng = np.random.default_rng(seed)
+    stats = np.zeros_like(exp_elog_beta)
+    for ids, counts in docs:
+        gamma, exp_elog_theta, norm = infer(ids, counts, exp_elog_beta, alpha, rng)
+        stats[:, ids] += np.outer(exp_elog_theta, counts / norm)
+    return stats * exp_elog_beta
+
+
+def m_step(lam, stats, batch_docs, total_docs, updates, eta):
+    """Blend mini-batch estimate of topic-word weights into current ones."""
+    rho = (TAU0 + updates) ** -KAPPA
+    return (1 - rho) * lam + rho * (eta + total_docs / batch_docs * stats)
+
+
+def read_model(path=TOPICS_MODEL):
+    """Topic-word weights and model state, None if model is not trained yet."""
+    if not (path / 'state.json').exists():
+        return None, None
+    return np.load(path / 'lambda.npy'), json.loads((path / 'state.json').read_text())
+
+
+def write_model(lam, state, path=TOPICS_MODEL):
+    """Save model, state is replaced after weights, so both are consistent with trained partitions."""
+    path.mkdir(parents=True, exist_ok=True)
+    np.save(path / 'lambda.tmp.npy', lam)
+    (path / 'lambda.tmp.npy').replace(path / 'lambda.npy')
+    (path / 'state.tmp').write_text(json.dumps(state))
+    (path / 'state.tmp').replace(path / 'state.json')
+
+
+def documents(rows):
+    """Documents (ids, counts) of rows with sparse word counts, empty ones are skipped."""
+    for row in rows:
+        if row.words_count.numNonzeros():
+            yield row.words_count.indices, row.words_count.values
+
+
+def batch_stats(rows, exp_elog_beta, alpha, seed):
+    """Sufficient statistics and number of documents of partition."""
+    docs = list(documents(rows))
+    return [(e_step(docs, exp_elog_beta, alpha, seed), len(docs))]
+
+
+def refresh(full=False, num_topics=NUM_TOPICS, batch_docs=BATCH_DOCS):
+    """Train topic model on new comment partitions and assign topics to their comments.
+
+    Model is trained from scratch after full parse of comments (new deltas generation), see project_main.generation().
+    """
+
+    generation = project_main.generation()
+    lam, state = read_model()
+    if full or (state is not None and state.get('generation') != generation):
+        # comments were parsed again from scratch, model and topics of old deltas would duplicate them
+        shutil.rmtree(TOPICS_MODEL, ignore_errors=True)
+        shutil.rmtree(COMMENT_TOPICS, ignore_errors=True)
+        lam, state = None, None
+    trained = set(state['partitions']) if state else set()
+    parts = sorted(p for p in project_main.PROJECT_DELTAS.glob('part-*.csv') if p.name not in trained)
+    if not parts:
+        print('Topic model is up to date')
+        return
+
+    spark = sparksession.session(inputs=parts, app_name='topics')
+    comments = (spark.read.csv([str(p) for p in parts], header=True, multiLine=True, escape='"')
+        .select('comment_id', 'symbol', 'comment_date', F.coalesce('comment_text', F.lit('')).alias('comment_text')))
+    words = PipelineModel(naics.text_stages('comment_text', pattern='(?U)\\W')).transform(comments)
+
+    if state is None:
+        vocabulary = CountVectorizer(inputCol='words_clean', outputCol='words_count',
+            vocabSize=VOCAB_SIZE, minDF=MIN_DF).fit(words).vocabulary
+        rng = np.random.default_rng(100500)
+        lam = rng.gamma(100.0, 0.01, (num_topics, len(vocabulary)))
+        state = {'vocabulary': vocabulary, 'alpha': 1 / num_topics, 'eta': 1 / num_topics,
+            'updates': 0, 'documents': 0, 'partitions': [], 'generation': generation}
+    count = CountVectorizerModel.from_vocabulary(state['vocabulary'], inputCol='words_clean', outputCol='words_count')
+    vectors = (count.transform(words)
+        .select('comment_id', 'symbol', 'comment_date', 'words_count')
+        .withColumn('batch', F.floor(F.rand(seed=state['updates']) * 1e9))
+        .cache())
+    new_docs = vectors.count()
+    total_docs = state['documents'] + new_docs
+    batches = max(1, round(new_docs / batch_docs))
+    vectors = vectors.withColumn('batch', F.col('batch') % batches)
+    alpha, eta = state['alpha'], state['eta']
+
+    for batch in range(batches):
+        exp_elog_beta = spark.sparkContext.broadcast(np.exp(dirichlet_expectation(lam)))
+        seed = state['updates']
+        stats, docs = (vectors.filter(F.col('batch') == batch).rdd
+            .mapPartitionsWithIndex(lambda i, rows: batch_stats(rows, exp_elog_beta.value, alpha, [seed, i]))
+            .treeReduce(lambda a, b: (a[0] + b[0], a[1] + b[1])))
+        exp_elog_beta.unpersist()
+        if docs:
+            lam = m_step(lam, stats, docs, total_docs, state['updates'], eta)
+            state['updates'] += 1
+        print(f'Mini-batch {batch + 1}/{batches}: {docs} comments')
+
+    # topic distributions of new comments with updated model
+    exp_elog_beta = spark.sparkContext.broadcast(np.exp(dirichlet_expectation(lam)))
+
+    def assign(rows):
+        rng = np.random.default_rng(0)
+        for row in rows:
+            vector = row.words_count
+            if vector.numNonzeros():
+                gamma = infer(vector.indices, vector.values, exp_elog_beta.value, alpha, rng)[0]
+                theta = gamma / gamma.sum()
+                yield row.comment_id, row.symbol, row.comment_date, int(theta.argmax()), theta.tolist()
+            else:
+                yield row.comment_id, row.symbol, row.comment_date, None, None
+
+    spark.createDataFrame(vectors.rdd.mapPartitions(assign), TOPICS_SCHEMA).write.mode('append').parquet(str(COMMENT_TOPICS))
+    vectors.unpersist()
+
+    state['documents'] = total_docs
+    state['partitions'] = sorted(trained | {p.name for p in parts})
+    write_model(lam, state)
+    print(f'Trained on {new_docs} new comments ({total_docs} total) in {batches} mini-batches, {state["updates"]} updates')
+
+
+def describe(terms=10):
+    """Print top terms of every topic."""
+
+    lam, state = read_model()
+    if lam is None:
+        raise FileNotFoundError(f'No topic model in {TOPICS_MODEL}')
+    beta = lam / lam.sum(axis=1, keepdims=True)
+    for topic, weights in enumerate(beta):
+        top = np.argsort(weights)[::-1][:terms]
+        print(f'{topic:>3}: ' + ', '.join(f'{state["vocabulary"][i]} ({weights[i]:.3f})' for i in top))
@@ -1,23 +1,22 @@
-import aiofiles
-from aiohttp import ClientSession
-import asyncio
-from collections import defaultdict
 import csv
-import io
-import lxml.html
-from pathlib import Path
-import pyarrow as pa
-import pyarrow.parquet as pq
-import sys
-import tarfile
-from tqdm import tqdm
 
 import config as cfg
+import engine
+import extractors
 
 YAHOO_ARCH = cfg.BUILDDIR / 'yahoo.tbz2'
+YAHOO_RAW_ARCH = cfg.BUILDDIR / 'yahoo_raw.tar'
 YAHOO_DATA = cfg.BUILDDIR / 'yahoo.csv'
+YAHOO_DATA_PARQUET = cfg.BUILDDIR / 'yahoo_data.parquet'
 YAHOO_HTMLS = cfg.BUILDDIR / 'yahoo_html'
 YAHOO_PARQUET = cfg.BUILDDIR / 'yahoo.parquet'
+YAHOO_URL = 'https://finance.yahoo.com/quote/{symbol}/profile?p={symbol}'
+
+# page sections read by parse_descriptions(), see htmlreduce.reduce_html()
+YAHOO_SECTIONS = (
+    '//section[h2//*[text()="Description"]]',
+    '//div[@class="asset-profile-container"]',
+    )
 
 
 NASDAQ_FILES = (
@@ -26,155 +25,58 @@ NASDAQ_FILES = (
     cfg.DATADIR / 'nasdaq' / 'nyse.csv',
     )
 
+SITE = engine.Site('yahoo', YAHOO_URL, NASDAQ_FILES, 'Symbol',
+    extractors=[extractors.yahoo_description, extractors.yahoo_company_info], parse=extractors.yahoo_profile,
+    columns=['symbol', 'sector', 'industry', 'employees', 'description'],
+    sections=YAHOO_SECTIONS, htmls=YAHOO_HTMLS, arch=YAHOO_ARCH, raw_arch=YAHOO_RAW_ARCH, parquet=YAHOO_PARQUET)
+
 
 def read_symbols():
     """Read symbols from NASDAQ dataset"""
+    return SITE.read_ids()
 
-    symbols = set()
-
-    for filename in NASDAQ_FILES:
-        with open(filename) as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                symbols.add(row['Symbol'].upper().strip())
-
-    return list(sorted(symbols))
-
-
-def scrape_descriptions_async():
-    """Scrape companies descriptions asynchronously."""
 
-    symbols = read_symbols()
-    progress = tqdm(total=len(symbols), file=sys.stdout, disable=False)
-    YAHOO_HTMLS.mkdir(parents=True, exist_ok=True)
+def scrape_descriptions_async(reduce=False, raw=False, symbols=None, url=YAHOO_URL, dst=YAHOO_HTMLS, protocol='http1', cafile=None):
+    """Scrape companies descriptions asynchronously.
 
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_5) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/12.1.1 Safari/605.1.15',
-        }
+    With reduce=True only page sections used by parse_descriptions() are stored.
+    With raw=True compressed response bodies are stored as received, see contentcoding.
+    protocol='http2' multiplexes requests over a few connections, see fetchers.py.
+    """
+    engine.scrape(SITE, reduce=reduce, raw=raw, symbols=symbols, url=url, dst=dst, protocol=protocol, cafile=cafile)
 
-    async def fetch(symbol, session):
-        async with session.get(f'https://finance.yahoo.com/quote/{symbol}/profile?p={symbol}') as response:
-            text = await response.read()
-            async with aiofiles.open(YAHOO_HTMLS / f'{symbol}.html', 'wb') as f:
-                await f.write(text)
-            progress.update(1)
 
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/75.0.3770.142 Safari/537.36'
-    }
+def archive_descriptions(raw=False):
+    """Pack scraped pages to tarfile"""
+    engine.archive(SITE, raw=raw)
 
-    async def run(symbols):
-        async with ClientSession(headers=headers) as session:
-            tasks = (asyncio.ensure_future(fetch(symbol, session)) for symbol in symbols)
-            await asyncio.gather(*tasks)
 
-    loop = asyncio.get_event_loop()
-    loop.set_exception_handler(lambda x, y: None)  # suppress exceptions because of bug in Python 3.7.3 + aiohttp + asyncio
-    loop.run_until_complete(asyncio.ensure_future(run(symbols)))
-    progress.close()
+def compress_descriptions(encoding='utf-8', batch_size=1000, compression='BROTLI', raw=False):
+    """Convert tarfile to parquet
 
-
-def compress_descriptions(encoding='utf-8', batch_size=1000, compression='BROTLI'):
-    """Convert tarfile to parquet"""
-
-    names = ('symbol', 'html')
-
-    def read_incremental():
-        """Incremental generator of batches"""
-        with tarfile.open(YAHOO_ARCH) as archive:
-            batch = defaultdict(list)
-            for member in tqdm(archive):
-                if member.isfile() and member.name.endswith('.html'):
-                    batch['symbol'].append(Path(member.name).stem)
-                    batch['html'].append(archive.extractfile(member).read().decode(encoding))
-                    if len(batch['symbol']) >= batch_size:
-                        yield pa.Table.from_arrays([pa.array(batch[n]) for n in names], names)
-                        batch = defaultdict(list)
-            if batch:
-                yield pa.Table.from_arrays([pa.array(batch[n]) for n in names], names)  # last partial batch
-
-    writer = None
-    for batch in read_incremental():
-        if writer is None:
-            writer = pq.ParquetWriter(YAHOO_PARQUET, batch.schema, use_dictionary=False, compression=compression, flavor={'spark'})
-        writer.write_table(batch)
-    writer.close()
+    With raw=True pages are read from the archive of raw pages and stored with their codec,
+    html column is not compressed again.
+    """
+    engine.compress(SITE, encoding=encoding, batch_size=batch_size, compression=compression, raw=raw)
 
 
 def decompress_descriptions(encoding='utf-8'):
     """Convert parquet to tarfile"""
+    engine.decompress(SITE, encoding=encoding)
 
-    pf = pq.ParquetFile(YAHOO_PARQUET)
-
-    progress = tqdm(file=sys.stdout, disable=False)
-
-    with tarfile.open(YAHOO_ARCH, 'w:bz2') as archive:
-        for i in range(pf.metadata.num_row_groups):
-            table = pf.read_row_group(i)
-            columns = table.to_pydict()
-            for symbol, html in zip(columns['symbol'], columns['html']):
-                bytes = html.encode(encoding)
-                s = io.BytesIO(bytes)
-                tarinfo = tarfile.TarInfo(name=f'yahoo/{symbol}.html')
-                tarinfo.size = len(bytes)
-                archive.addfile(tarinfo=tarinfo, fileobj=s)
-                progress.update(1)
-
-    progress.close()
-
-def parse_descriptions(src=YAHOO_PARQUET, dst=YAHOO_DATA):
-    """Parse scraped pages."""
-
-    reader = pq.ParquetFile(src)
-
-    with tqdm(total=reader.metadata.num_rows) as progress:
-
-        with open(dst, "w") as f:
-            writer = csv.DictWriter(f, fieldnames=['symbol', 'sector', 'industry', 'employees', 'description'])
-            writer.writeheader()
-            for g in range(reader.metadata.num_row_groups):
-                table = reader.read_row_group(g).to_pydict()
-                for symbol, html in zip(table['symbol'],table['html']):
-                    tree = lxml.html.fromstring(html)
-
-                    row = {'symbol':symbol.strip()}
-                    row['description'] = '\n'.join(tree.xpath('//section[h2//*[text()="Description"]]/p/text()'))
-                    info = (tree.xpath('//div[@class="asset-profile-container"]//p[span[text()="Sector"]]') or [None])[0]
-                    if info is not None:
-                        row['sector'] = (info.xpath('./span[text()="Sector"]/following-sibling::span[1]/text()') or [''])[0]
-                        row['industry'] = (info.xpath('./span[text()="Industry"]/following-sibling::span[1]/text()') or [''])[0]
-                        row['employees'] = (info.xpath('./span[text()="Full Time Employees"]/following-sibling::span[1]/span/text()') or [''])[0].replace(',', '')
-
-                    writer.writerow(row)
-                    progress.update()
-
-
-def parse_descriptions(src=YAHOO_PARQUET, dst=YAHOO_DATA):
-    """Parse scraped pages."""
-
-    reader = pq.ParquetFile(src)
-
-    with tqdm(total=reader.metadata.num_rows) as progress:
-
-        with open(dst, 'w', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=['symbol', 'sector', 'industry', 'employees', 'description'])
-            writer.writeheader()
 
-            for g in range(reader.metadata.num_row_groups):
-                table = reader.read_row_group(g).to_pydict()
-                for symbol, html in zip(table['symbol'], table['html']):
-                    tree = lxml.html.fromstring(html)
+def parse_descriptions(src=YAHOO_PARQUET, dst=YAHOO_DATA, partial=False, cache=True):
+    """Parse scraped pages.
 
-                    row = {'symbol': symbol.strip()}
-                    row['description'] = '\n'.join(tree.xpath('//section[h2//*[text()="Description"]]/p/text()'))
-                    info = (tree.xpath('//div[@class="asset-profile-container"]//p[span[text()="Sector"]]') or [None])[0]
-                    if info is not None:
-                        row['sector'] = (info.xpath('./span[text()="Sector"]/following-sibling::span[1]/text()') or [''])[0]
-                        row['industry'] = (info.xpath('./span[text()="Industry"]/following-sibling::span[1]/text()') or [''])[0]
-                        row['employees'] = (info.xpath('./span[text()="Full Time Employees"]/following-sibling::span[1]/span/text()') or [''])[0].replace(',', '')
+    With partial=True pages are parsed incrementally until profile is found, see extractors.iter_sections().
+    With cache=True only pages, which are not parsed by current extractor version yet, are parsed, see parsecache.py.
+    """
 
-                    writer.writerow(row)
-                    progress.update()
+    with open(dst, 'w', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=SITE.columns)
+        writer.writeheader()
+        for symbol, results in engine.extract_pages(SITE, src, partial=partial, cache=cache):
+            writer.writerow({'symbol': symbol, **results['yahoo_description'], **results['yahoo_company_info']})
 
 
 def main():